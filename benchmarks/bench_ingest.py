@@ -0,0 +1,55 @@
+'''
+Micro-benchmark della scrittura di HistoricalData su un database SQLite temporaneo: righe al secondo
+del vecchio insert_many unico rispetto a Database.save_data_array a blocchi, con e senza bulk_ingest.
+
+    python3 benchmarks/bench_ingest.py [numero_righe]
+'''
+import os
+import sys
+import time
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from database import Database, HistoricalData, HISTORICAL_FIELDS
+
+
+def make_rows(n:int, epic:str) -> list[tuple]:
+    return [(epic, "MINUTE", f"2024-01-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.{i // 86400:06d}",
+             1.0, 1.1, 1.2, 1.3, 0.9, 1.0, 1.1, 1.2, i) for i in range(n)]
+
+
+def legacy_save(db:Database, rows:list[tuple], chunk:int=1000):
+    '''Un insert_many per finestra scaricata (1000 barre), come faceva save_data_array'''
+    for i in range(0, len(rows), chunk):
+        with db.db.atomic():
+            HistoricalData.insert_many(rows[i:i + chunk], fields=HISTORICAL_FIELDS).on_conflict_ignore().execute()
+
+
+def bench(name:str, n:int, save):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        rows = make_rows(n, "BENCH")
+        start = time.perf_counter()
+        save(db, rows)
+        elapsed = time.perf_counter() - start
+        assert HistoricalData.select().count() == n
+        db.db.close()
+    print(f"{name:<36} {n / elapsed:>12,.0f} righe/s")
+
+
+def windows(db:Database, rows:list[tuple], chunk:int=1000):
+    for i in range(0, len(rows), chunk):
+        db.save_data_array(rows[i:i + chunk])
+
+
+def bulk_windows(db:Database, rows:list[tuple]):
+    with db.bulk_ingest(report=False):
+        windows(db, rows)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    bench("insert_many per finestra", n, legacy_save)
+    bench("save_data_array per finestra", n, windows)
+    bench("save_data_array + bulk_ingest", n, bulk_windows)
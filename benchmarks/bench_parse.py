@@ -0,0 +1,73 @@
+'''
+Micro-benchmark del parsing delle risposte `prices` di Capital.com: barre al secondo
+del vecchio ciclo per-barra di CapitalDownloader rispetto a transform.from_capital_prices.
+
+    python3 benchmarks/bench_parse.py [numero_barre]
+'''
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import transform
+
+
+def make_prices(n:int, scalar_every:int=0) -> list[dict]:
+    '''Risposta sintetica bid/ask con alcuni lati mancanti e, opzionalmente, prezzi come valore singolo'''
+    prices = []
+    for i in range(n):
+        base = 100 + random.random()
+        price = lambda d: {"bid": base + d, "ask": base + d + 0.01}
+        bar = {
+            "snapshotTimeUTC": f"2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}",
+            "openPrice": price(0), "highPrice": price(0.5), "lowPrice": price(-0.5), "closePrice": price(0.1),
+            "lastTradedVolume": random.randint(0, 1000)
+        }
+        if i % 10 == 0:
+            del bar["highPrice"]["ask"]
+        if scalar_every and i % scalar_every == 0:
+            bar["closePrice"] = base
+        prices.append(bar)
+    return prices
+
+
+def legacy_parse(epic:str, resolution:str, prices:list[dict]) -> list[tuple]:
+    '''Ciclo per-barra usato in precedenza da CapitalDownloader.download_historical_data'''
+    data = []
+    for p in prices:
+        if p.get('openPrice') is None or p.get('closePrice') is None or p.get('highPrice') is None or p.get('lowPrice') is None:
+            continue
+        open_price, close_price, high_price, low_price = p['openPrice'], p['closePrice'], p['highPrice'], p['lowPrice']
+        values = []
+        for price in (open_price, close_price, high_price, low_price):
+            if isinstance(price, dict):
+                bid, ask = price.get('bid'), price.get('ask')
+                if bid is None and ask is not None: bid = ask
+                if ask is None and bid is not None: ask = bid
+                values += [bid, ask]
+            else:
+                values += [price, price]
+        if None in values:
+            continue
+        data.append((epic, resolution, p['snapshotTimeUTC'], *values, p['lastTradedVolume']))
+    return data
+
+
+def bench(name:str, func, prices:list[dict], repeat:int=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func("EPIC", "MINUTE", prices)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28} {len(prices) / best:>14,.0f} barre/s")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    for title, prices in (("bid/ask", make_prices(n)), ("con valori singoli", make_prices(n, scalar_every=25))):
+        print(f"--- {n:,} barre {title} ---")
+        bench("ciclo per-barra", legacy_parse, prices)
+        bench("from_capital_prices", transform.from_capital_prices, prices)
+        bench("from_capital_prices + rows", lambda e, r, p: list(transform.from_capital_prices(e, r, p).rows()), prices)
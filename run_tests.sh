@@ -4,3 +4,62 @@ echo -n "Test database.py... "
 python3 src/database.py
 if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
 
+echo -n "Test backfill.py... "
+python3 src/backfill.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test ratelimit.py... "
+python3 src/ratelimit.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test cache.py... "
+python3 src/cache.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test columnar.py... "
+python3 src/columnar.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test streaming_indicators.py... "
+python3 src/streaming_indicators.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test trading_strategies.py... "
+python3 src/trading_strategies.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test trading_system.py... "
+python3 src/trading_system.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test optimizer.py... "
+python3 src/optimizer.py --self-test
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test rollup.py... "
+python3 src/rollup.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test daily_update.py... "
+python3 src/daily_update.py --self-test
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test archive.py... "
+python3 src/archive.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test migrate.py... "
+python3 src/migrate.py --self-test
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test dataset.py... "
+python3 src/dataset.py --self-test
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test export.py... "
+python3 src/export.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
+
+echo -n "Test streaming.py... "
+python3 src/streaming.py
+if [ $? -eq 0 ]; then echo "ok"; else exit 1; fi
@@ -1,15 +1,25 @@
 import os
+import json
+import asyncio
+import numpy as np
 import pandas as pd
-from fastapi import FastAPI, HTTPException
+from datetime import datetime
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 
 # Importa le tue funzioni di database, trasformazione e strategia
-from .database import Database, HistoricalData, Markets
-from .strategies import moving_average_crossover
-from .transform import calculate_pivot_points
-from .providers import TradingViewAnalysis, YahooFinanceNews # NUOVO IMPORT
+from database import Database, HISTORICAL_FIELDS, Markets, TradingPositions, PortfolioConfig
+from strategies import moving_average_crossover, scan_sma_crossover_parallel
+from transform import calculate_pivot_points
+from providers import TradingViewAnalysis, YahooFinanceNews
 from trading_system import TradingSystem
-from database import Markets, TradingPositions, PortfolioConfig
+from columnar import ColumnStore, BarWindowCache, to_frame
+from cache import TTLCache
+import export
 
 # Carica le variabili d'ambiente per ottenere la stringa di connessione al DB
 load_dotenv()
@@ -17,8 +27,55 @@ DB_URL = os.getenv("APP_DB_URL")
 if not DB_URL:
     raise RuntimeError("La variabile d'ambiente APP_DB_URL non è impostata.")
 
-# Crea un'istanza globale del database
-db = Database(DB_URL)
+# Crea un'istanza globale del database con un pool di connessioni: ogni richiesta (o task
+# sui pool di thread) prende una connessione all'inizio e la restituisce alla fine
+DB_POOL_SIZE = int(os.getenv("APP_DB_POOL_SIZE", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("APP_DB_POOL_TIMEOUT", "10"))
+DB_STALE_TIMEOUT = float(os.getenv("APP_DB_STALE_TIMEOUT", "300"))
+# Con APP_ARCHIVE le letture comprendono anche le barre fredde archiviate
+db = Database(DB_URL, pool_size=DB_POOL_SIZE, pool_timeout=DB_POOL_TIMEOUT, stale_timeout=DB_STALE_TIMEOUT, archive=os.getenv("APP_ARCHIVE"))
+
+# Store colonnare opzionale: se configurato le analisi leggono da lì invece che da HistoricalData
+COLUMN_STORE = os.getenv("APP_COLUMN_STORE")
+# All'attivazione su un database esistente le serie già salvate vengono importate, così lo store non ha storici troncati
+column_store = ColumnStore(COLUMN_STORE) if COLUMN_STORE else None
+if column_store:
+    with db.connection():
+        column_store.seed(db)
+    db.add_ingest_listener(column_store.append)
+
+# Cache dei risultati di /analysis e /trading/analyze, indicizzata anche dall'ultima barra dell'epic:
+# le barre salvate da questo processo la invalidano subito, quelle salvate da altri processi
+# (app.py, daily_update.py) vengono viste entro APP_LATEST_BAR_TTL secondi
+RESULT_CACHE_TTL = float(os.getenv("APP_RESULT_CACHE_TTL", "3600"))
+LATEST_BAR_TTL = float(os.getenv("APP_LATEST_BAR_TTL", "15"))
+result_cache = TTLCache(ttl=RESULT_CACHE_TTL, max_entries=4096)
+latest_bars = TTLCache(ttl=LATEST_BAR_TTL, max_entries=16384)
+# Parametri salvati delle strategie (ad esempio da optimizer.py, anche in un altro processo), riletti ogni APP_LATEST_BAR_TTL secondi
+strategy_parameters = TTLCache(ttl=LATEST_BAR_TTL, max_entries=16384)
+
+def invalidate_results(columns):
+    """Listener di ingest: scarta i risultati e l'ultima barra nota dell'(epic, resolution) aggiornato"""
+    latest_bars.invalidate((columns.epic, columns.resolution))
+    result_cache.invalidate_where(lambda key: key[1] == columns.epic and key[2] == columns.resolution)
+
+db.add_ingest_listener(invalidate_results)
+
+# Ultime barre usate da TradingSystem, controllate con l'ultima barra salvata ogni APP_LATEST_BAR_TTL secondi
+bar_cache = BarWindowCache(db, column_store, ttl=LATEST_BAR_TTL)
+db.add_ingest_listener(bar_cache.append)
+
+# Processi usati da /signals per universi molto grandi (0 o 1 = nessun pool)
+SCAN_WORKERS = int(os.getenv("APP_SCAN_WORKERS", "0"))
+
+# Analisi CPU-bound e chiamate ai provider esterni girano su pool separati e limitati:
+# un epic lento o un provider che non risponde non bloccano l'event loop né gli altri endpoint
+ANALYSIS_WORKERS = int(os.getenv("APP_ANALYSIS_WORKERS", "4"))
+PROVIDER_WORKERS = int(os.getenv("APP_PROVIDER_WORKERS", "8"))
+PROVIDER_TIMEOUT = float(os.getenv("APP_PROVIDER_TIMEOUT", "5"))
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="analysis")
+provider_executor = ThreadPoolExecutor(max_workers=PROVIDER_WORKERS, thread_name_prefix="provider")
+
 tv_analysis = TradingViewAnalysis()
 yf_news = YahooFinanceNews()
 
@@ -27,22 +84,130 @@ app = FastAPI(
     description="API per ottenere analisi e segnali di trading."
 )
 
-@app.get("/analysis/{epic}")
-def get_analysis(epic: str, timeframe: str = "DAY"):
+@app.on_event("shutdown")
+def shutdown_executors():
+    analysis_executor.shutdown(wait=False, cancel_futures=True)
+    provider_executor.shutdown(wait=False, cancel_futures=True)
+    db.close_pool()
+
+def with_connection(function):
     """
-    Restituisce l'analisi completa per un dato epic,
-    inclusi supporto, resistenza e segnali di strategia.
+    Esegue la funzione con una connessione del pool, restituita alla fine.
+    Le connessioni sono per thread: va applicato alla funzione che gira nel thread che fa le query
+    (endpoint sincroni, task sui pool), non a quella che gira nell'event loop.
     """
-    # 1. Carica i dati storici dal database in un DataFrame Pandas
-    query = HistoricalData.select().where(
-        (HistoricalData.epic == epic) &
-        (HistoricalData.resolution == timeframe)
-    ).order_by(HistoricalData.snapshotTimeUTC)
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with db.connection():
+            return function(*args, **kwargs)
+    return wrapper
 
-    if not query.exists():
-        raise HTTPException(status_code=404, detail=f"Nessun dato trovato per l'epic '{epic}' con timeframe '{timeframe}'")
+async def run_analysis(function, *args, **kwargs):
+    """Esegue una funzione bloccante (query, calcolo degli indicatori) sul pool delle analisi"""
+    return await asyncio.get_running_loop().run_in_executor(analysis_executor, partial(with_connection(function), *args, **kwargs))
+
+async def call_provider(function, *args, timeout: float = None, **kwargs):
+    """
+    Chiama un provider esterno sul pool dei provider con un timeout.
+    Restituisce (risultato, errore): in caso di timeout o eccezione il risultato è None e l'errore una descrizione.
+    Allo scadere del timeout la richiesta continua nel suo thread, ma la risposta non la attende.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        result = await asyncio.wait_for(
+            loop.run_in_executor(provider_executor, partial(function, *args, **kwargs)),
+            timeout=timeout or PROVIDER_TIMEOUT
+        )
+        return result, None
+    except asyncio.TimeoutError:
+        return None, f"timeout dopo {timeout or PROVIDER_TIMEOUT:g}s"
+    except Exception as e:
+        return None, str(e)
+
+def latest_snapshot(epic: str, timeframe: str):
+    """Istante dell'ultima barra di un epic, None se non ci sono dati"""
+    def load():
+        if column_store and column_store.covers(epic, timeframe):
+            return int(column_store.tail(epic, timeframe, 1)['time'][-1])
+        return db.get_newest_date(epic, timeframe)
+    return latest_bars.get_or_load((epic, timeframe), load)
+
+def analysis_version(kind: str, epic: str, timeframe: str, strategy: str, load: bool = True):
+    """
+    Ciò da cui dipende un risultato oltre alle barre: per /trading/analyze i parametri salvati della strategia
+    e il numero di reset degli indicatori incrementali. Con load=False solo se già in cache, altrimenti None
+    """
+    if kind != "trading":
+        return ()
+    key = (epic, strategy)
+    if load:
+        parameters = strategy_parameters.get_or_load(key, lambda: json.dumps(trading_system.get_strategy_parameters(epic, strategy), sort_keys=True))
+    else:
+        parameters = strategy_parameters.get(key)
+        if parameters is None:
+            return None
+    return parameters, trading_system.indicator_engine.generation(epic, timeframe)
+
+async def cached_analysis(kind: str, epic: str, timeframe: str, strategy: str, compute):
+    """
+    Risultato di compute() in cache per (kind, epic, timeframe, strategy, ultima barra, versione della finestra, analysis_version).
+    La versione della finestra cambia quando un altro processo salva barre più vecchie dell'ultima (es. un buco riempito).
+    Se l'ultima barra e la versione sono già note la risposta è una lettura dalla cache, senza passare dal pool.
+    """
+    latest = latest_bars.get((epic, timeframe))
+    version = analysis_version(kind, epic, timeframe, strategy, load=False)
+    if latest is not None and version is not None:
+        result = result_cache.get((kind, epic, timeframe, strategy, latest, bar_cache.version(epic, timeframe), version))
+        if result is not None:
+            return result
+
+    def load():
+        latest = latest_snapshot(epic, timeframe)
+        if latest is None:
+            return compute()
+        # Il risultato viene salvato con questa ultima barra: le finestre in memoria devono arrivarci,
+        # e vengono rilette se nel frattempo un altro processo ha scritto barre più vecchie
+        bar_cache.sync(epic, timeframe, latest)
+        version = analysis_version(kind, epic, timeframe, strategy)
+        return result_cache.get_or_load((kind, epic, timeframe, strategy, latest, bar_cache.version(epic, timeframe), version), compute)
+    return await run_analysis(load)
+
+def tradingview_symbol(epic: str) -> tuple:
+    """Simbolo, screener ed exchange di TradingView per un epic"""
+    # NOTA: Questa è una mappatura semplice. Potrebbe essere necessario renderla più complessa.
+    # Ad esempio, per il forex, TradingView vuole "EURUSD", non "EUR/USD".
+    symbol = epic.replace('/', '')
+
+    # Mappatura approssimativa per lo screener di TradingView
+    # Da migliorare in futuro con una logica più precisa
+    if epic in ["GOLD", "SILVER", "OIL"]:
+        screener = "cfd"
+        exchange = "TVC"
+    elif len(symbol) > 4 and symbol.isupper(): # Assumiamo sia una coppia di valute
+        screener = "forex"
+        exchange = "FX_IDC"
+    else: # Assumiamo sia un'azione
+        screener = "america"
+        exchange = "NASDAQ" # Potrebbe essere necessario specificare (es. NYSE)
+    return symbol, screener, exchange
 
-    df = pd.DataFrame(list(query.dicts()))
+def load_history(epic: str, timeframe: str, limit: int = None) -> pd.DataFrame:
+    """
+    Carica lo storico di un epic con le colonne open/high/low/close/volume.
+    Usa lo store colonnare se configurato, altrimenti il database.
+    Restituisce None se non ci sono dati.
+    """
+    if column_store and column_store.covers(epic, timeframe):
+        df = to_frame(column_store.tail(epic, timeframe, limit)).reset_index()
+        df['epic'] = epic
+        df['resolution'] = timeframe
+        return df
+
+    rows = db.get_bars(epic, timeframe)
+    if not rows:
+        return None
+
+    df = pd.DataFrame(rows, columns=[field.name for field in HISTORICAL_FIELDS])
 
     # Rinomina le colonne per la compatibilità con le librerie di analisi
     df.rename(columns={
@@ -52,6 +217,13 @@ def get_analysis(epic: str, timeframe: str = "DAY"):
         'closeBid': 'close',
         'lastTradedVolume': 'volume'
     }, inplace=True)
+    return df if limit is None else df.tail(limit)
+
+def build_analysis(epic: str, timeframe: str) -> dict:
+    # 1. Carica i dati storici in un DataFrame Pandas
+    df = load_history(epic, timeframe)
+    if df is None:
+        raise HTTPException(status_code=404, detail=f"Nessun dato trovato per l'epic '{epic}' con timeframe '{timeframe}'")
 
     # 2. Applica le strategie e le trasformazioni
     df_with_pivots = calculate_pivot_points(df)
@@ -67,40 +239,47 @@ def get_analysis(epic: str, timeframe: str = "DAY"):
         "details": latest_data
     }
 
+@app.get("/analysis/{epic}")
+async def get_analysis(epic: str, timeframe: str = "DAY"):
+    """
+    Restituisce l'analisi completa per un dato epic,
+    inclusi supporto, resistenza e segnali di strategia.
+    """
+    return await cached_analysis("analysis", epic, timeframe, None, partial(build_analysis, epic, timeframe))
+
 @app.get("/market-info/{epic}")
-def get_market_info(epic: str):
+async def get_market_info(epic: str, timeout: float = None):
     """
     Restituisce il sentiment tecnico da TradingView e le notizie da Yahoo Finance
-    per un dato epic.
+    per un dato epic. I due provider sono interrogati in parallelo, ognuno con il proprio timeout:
+    se uno fallisce la risposta contiene comunque l'altro e il motivo in `errors`.
     """
-    # NOTA: Questa è una mappatura semplice. Potrebbe essere necessario renderla più complessa.
-    # Ad esempio, per il forex, TradingView vuole "EURUSD", non "EUR/USD".
-    symbol = epic.replace('/', '')
+    symbol, screener, exchange = tradingview_symbol(epic)
 
-    # Mappatura approssimativa per lo screener di TradingView
-    # Da migliorare in futuro con una logica più precisa
-    if epic in ["GOLD", "SILVER", "OIL"]:
-        screener = "cfd"
-        exchange = "TVC"
-    elif len(symbol) > 4 and symbol.isupper(): # Assumiamo sia una coppia di valute
-        screener = "forex"
-        exchange = "FX_IDC"
-    else: # Assumiamo sia un'azione
-        screener = "america"
-        exchange = "NASDAQ" # Potrebbe essere necessario specificare (es. NYSE)
+    (sentiment, sentiment_error), (news, news_error) = await asyncio.gather(
+        call_provider(tv_analysis.get_sentiment, symbol, screener, exchange, timeout=timeout),
+        call_provider(yf_news.get_news, symbol, timeout=timeout)
+    )
 
-    try:
-        sentiment = tv_analysis.get_sentiment(symbol, screener, exchange)
-        news = yf_news.get_news(symbol)
-
-        return {
-            "epic": epic,
-            "sentiment_summary": sentiment,
-            "news": news
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante il recupero delle informazioni di mercato: {e}")
+    errors = {name: error for name, error in (("sentiment", sentiment_error), ("news", news_error)) if error}
+    if len(errors) == 2:
+        raise HTTPException(status_code=502, detail=f"Errore durante il recupero delle informazioni di mercato: {errors}")
 
+    return {
+        "epic": epic,
+        "sentiment_summary": sentiment,
+        "news": news if news is not None else [],
+        "errors": errors
+    }
+
+
+@app.get("/providers/stats")
+def get_providers_stats():
+    """Statistiche delle cache dei provider esterni (hit, miss, richieste accorpate, eliminazioni)"""
+    return {
+        "tradingview": tv_analysis.cache.stats(),
+        "yahoo_finance": yf_news.cache.stats()
+    }
 
 @app.get("/news/{query}")
 def get_news_with_sentiment(query: str):
@@ -133,50 +312,119 @@ def get_news_with_sentiment(query: str):
 
     return {"query": query, "articles": results}
 
+def scan_signals(timeframe: str, fast_period: int, slow_period: int) -> dict:
+    all_epics = [m.epic for m in Markets.select(Markets.epic).distinct()]
+    bars = slow_period + 1
+
+    # Dallo store colonnare solo le serie che copre interamente, le altre con una sola lettura dal database
+    covered = {epic for epic in all_epics if column_store and column_store.covers(epic, timeframe)}
+    stored = [epic for epic in all_epics if epic in covered]
+    others = [epic for epic in all_epics if epic not in covered]
+    last, closes = [], np.empty((0, bars))
+    for read, epics in ((column_store and column_store.last_closes, stored), (db.get_last_closes, others)):
+        if epics:
+            part_last, part_closes = read(epics, timeframe, bars)
+            last, closes = last + part_last, np.vstack([closes, part_closes])
+    order = {epic: row for row, epic in enumerate(stored + others)}
+    rows = [order[epic] for epic in all_epics]
+    last, closes = [last[row] for row in rows], closes[rows]
+    signals = scan_sma_crossover_parallel(closes, fast_period, slow_period, workers=SCAN_WORKERS)
+
+    active_signals = [{
+        "epic": all_epics[i],
+        "timeframe": timeframe,
+        "signal": signals[i],
+        "timestamp": last[i]
+    } for i in np.flatnonzero(signals != "HOLD")]
+
+    return {"active_signals": active_signals}
+
 @app.get("/signals")
-def get_all_signals(timeframe: str = "DAY"):
+async def get_all_signals(timeframe: str = "DAY", fast_period: int = 10, slow_period: int = 30):
     """
     Scansiona tutti gli epic e restituisce quelli con un segnale di BUY o SELL.
-    NOTA: Questa operazione può essere lenta se ci sono molti epic.
+    Le ultime chiusure di tutti gli epic vengono caricate in un'unica matrice (store colonnare
+    o una query per blocco di epic) e il crossover delle medie mobili è calcolato su tutte insieme.
     """
-    active_signals = []
-    all_epics = [m.epic for m in Markets.select(Markets.epic).distinct()]
+    return await run_analysis(scan_signals, timeframe, fast_period, slow_period)
 
-    for epic in all_epics:
-        try:
-            query = HistoricalData.select().where(
-                (HistoricalData.epic == epic) &
-                (HistoricalData.resolution == timeframe)
-            ).order_by(HistoricalData.snapshotTimeUTC)
-
-            if not query.exists():
-                continue
-
-            df = pd.DataFrame(list(query.dicts()))
-            if df.empty:
-                continue
-
-            df.rename(columns={'closeBid': 'close'}, inplace=True)
-            df_with_signals = moving_average_crossover(df)
-            
-            latest_signal = df_with_signals.iloc[-1].get("signal")
-
-            if latest_signal in ["BUY", "SELL"]:
-                active_signals.append({
-                    "epic": epic,
-                    "timeframe": timeframe,
-                    "signal": latest_signal,
-                    "timestamp": df_with_signals.iloc[-1].get("snapshotTimeUTC")
-                })
-        except Exception:
-            # Ignora gli epic che generano errori durante l'analisi e continua
-            continue
+def pooled_chunks(chunks):
+    """
+    Blocchi letti ognuno con una connessione del pool: Starlette legge uno stream sincrono da thread
+    diversi, quindi la connessione non può restare aperta per tutta la risposta
+    """
+    chunks = iter(chunks)
+    while True:
+        with db.connection():
+            rows = next(chunks, None)
+        if rows is None:
+            return
+        yield rows
+
+def export_response(chunks, format: str, columns: List[str], schema, to_batch, name: str) -> StreamingResponse:
+    """Risposta in streaming: i blocchi vengono letti dal database solo quando il client è pronto a riceverli"""
+    chunks = pooled_chunks(chunks)
+    if format == "arrow":
+        if export.pa is None:
+            raise HTTPException(status_code=501, detail="Export Arrow non disponibile: installare pyarrow")
+        body, media_type = export.to_arrow(chunks, schema, to_batch), export.ARROW_MEDIA_TYPE
+    else:
+        body, media_type = export.to_ndjson(chunks, columns), export.NDJSON_MEDIA_TYPE
+    extension = "arrows" if format == "arrow" else "ndjson"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{name}.{extension}"'})
+
+@app.get("/export/history")
+def export_history(
+    epics: List[str] = Query(None),
+    resolutions: List[str] = Query(None),
+    start: str = None,
+    end: str = None,
+    after_epic: str = None,
+    after_resolution: str = None,
+    after: str = None,
+    format: str = Query("ndjson", pattern="^(ndjson|arrow)$"),
+    chunk: int = Query(10_000, ge=1, le=100_000),
+    limit: int = Query(None, ge=1)
+):
+    """
+    Esporta le barre storiche in streaming (NDJSON o Arrow IPC), filtrate per epic, resolution
+    e intervallo [start, end], in ordine (epic, resolution, snapshotTimeUTC) e a blocchi di `chunk` righe.
+    Per continuare un export interrotto o limitato da `limit` passare epic, resolution e
+    snapshotTimeUTC dell'ultima barra ricevuta in after_epic, after_resolution e after.
+    """
+    cursor = (after_epic, after_resolution, after)
+    if any(cursor) and not all(cursor):
+        raise HTTPException(status_code=400, detail="after_epic, after_resolution e after vanno indicati insieme")
+
+    chunks = export.iter_bars(db, epics, resolutions, start, end, cursor if all(cursor) else None, chunk, limit)
+    return export_response(chunks, format, export.BAR_COLUMNS, export.BARS_SCHEMA, export.bars_batch, "history")
+
+@app.get("/export/news")
+def export_news(
+    start: str = None,
+    end: str = None,
+    after_published: str = None,
+    after_source: str = None,
+    format: str = Query("ndjson", pattern="^(ndjson|arrow)$"),
+    chunk: int = Query(10_000, ge=1, le=100_000),
+    limit: int = Query(None, ge=1)
+):
+    """
+    Esporta le notizie in streaming (NDJSON o Arrow IPC) in ordine (publishedAt, source).
+    Per continuare passare publishedAt e source dell'ultima notizia ricevuta in after_published e after_source.
+    """
+    cursor = (after_published, after_source)
+    if any(cursor) and not all(cursor):
+        raise HTTPException(status_code=400, detail="after_published e after_source vanno indicati insieme")
 
-    return {"active_signals": active_signals}
+    chunks = export.iter_news(db, start, end, cursor if all(cursor) else None, chunk, limit)
+    return export_response(chunks, format, export.NEWS_COLUMNS, export.NEWS_SCHEMA, export.news_batch, "news")
 
-trading_system = TradingSystem(db)
+with db.connection():
+    trading_system = TradingSystem(db, column_store, bar_cache=bar_cache)
 
 @app.get("/markets/search")
+@with_connection
 def search_markets(query: str = "", limit: int = 50):
     """Cerca markets nel database"""
     markets_query = Markets.select()
@@ -191,20 +439,47 @@ def search_markets(query: str = "", limit: int = 50):
     return {"markets": markets}
 
 @app.get("/trading/analyze/{epic}")
-def analyze_epic(epic: str, strategy: str = "COMBINED"):
+async def analyze_epic(epic: str, strategy: str = "COMBINED"):
     """Analizza un epic con la strategia specificata"""
-    result = trading_system.analyze_epic(epic, strategy)
-    return result
+    def analyze():
+        result = trading_system.analyze_epic(epic, strategy)
+        # Le analisi fallite non vanno in cache
+        if result.get('error'):
+            raise ValueError(result['error'])
+        return result
+
+    try:
+        return await cached_analysis("trading", epic, "HOUR", strategy, analyze)
+    except ValueError as e:
+        return {'error': str(e)}
+
+@app.get("/trading/signals/{epic}")
+async def get_signal_history(epic: str, strategy: str = "COMBINED", timeframe: str = "HOUR", limit: int = 500):
+    """Storico dei segnali della strategia per le ultime `limit` barre, per grafici e verifiche"""
+    try:
+        signals = await run_analysis(trading_system.get_signal_history, epic, strategy, timeframe, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    
+    # NaN (barre di riscaldamento degli indicatori) non è serializzabile in JSON
+    records = signals.reset_index()
+    records = records.astype(object).where(records.notna(), None)
+    return {
+        "epic": epic,
+        "strategy": strategy,
+        "timeframe": timeframe,
+        "signals": records.to_dict(orient="records")
+    }
 
 @app.post("/trading/open-position/{epic}")
-def open_position(epic: str, strategy: str = "COMBINED"):
+async def open_position(epic: str, strategy: str = "COMBINED"):
     """Analizza e potenzialmente apre una posizione"""
-    analysis = trading_system.analyze_epic(epic, strategy)
+    analysis = await run_analysis(trading_system.analyze_epic, epic, strategy)
     
     if analysis.get('error'):
         raise HTTPException(status_code=400, detail=analysis['error'])
     
-    position = trading_system.open_position(analysis)
+    position = await run_analysis(trading_system.open_position, analysis)
     
     return {
         "analysis": analysis,
@@ -213,6 +488,7 @@ def open_position(epic: str, strategy: str = "COMBINED"):
     }
 
 @app.get("/trading/positions")
+@with_connection
 def get_positions(open_only: bool = False):
     """Ottiene le posizioni di trading"""
     query = TradingPositions.select()
@@ -224,6 +500,7 @@ def get_positions(open_only: bool = False):
     return {"positions": positions}
 
 @app.post("/trading/close-position/{position_id}")
+@with_connection
 def close_position_manual(position_id: int):
     """Chiude manualmente una posizione"""
     try:
@@ -238,14 +515,15 @@ def close_position_manual(position_id: int):
         raise HTTPException(status_code=404, detail="Posizione non trovata")
 
 @app.get("/trading/portfolio")
+@with_connection
 def get_portfolio():
     """Ottiene il riepilogo del portfolio"""
     return trading_system.get_portfolio_summary()
 
 @app.post("/trading/check-positions")
-def check_positions():
+async def check_positions():
     """Controlla e chiude posizioni se necessario"""
-    closed_positions = trading_system.check_and_close_positions()
+    closed_positions = await run_analysis(trading_system.check_and_close_positions)
     return {
         "checked": datetime.now(),
         "closed_positions": len(closed_positions),
@@ -253,6 +531,7 @@ def check_positions():
     }
 
 @app.put("/trading/portfolio/config")
+@with_connection
 def update_portfolio_config(
     initial_capital: float = None,
     max_position_size: float = None,
@@ -1,12 +1,14 @@
 import os
 import sys
-import time
 import argparse
 
 from database import Database
 from dotenv import load_dotenv
-from datetime import datetime, timedelta, timezone
+from backfill import Backfill, CAPITAL_TIMEFRAME_LIMITS
+from columnar import ColumnStore
 from downloaders import CapitalDownloader, NewsDownloader
+from streaming import CapitalQuoteStream, QuoteIngestor
+from rollup import RESOLUTION_SECONDS
 
 # Controllo se le variabili d'ambiente sono state impostate
 if not os.getenv("APP_TRADING_BOT"):
@@ -21,13 +23,8 @@ NEWS_APIKEY = os.getenv("NEWS_APIKEY")
 CAPITAL_APIKEY = os.getenv("CAPITAL_APIKEY")
 CAPITAL_EMAIL = os.getenv("CAPITAL_EMAIL")
 CAPITAL_PASSWORD = os.getenv("CAPITAL_PASSWORD")
-CAPITAL_TIMEFRAME_LIMITS = {
-    "MINUTE": timedelta(hours=16),
-    "MINUTE_5": timedelta(hours=83),
-    "MINUTE_15": timedelta(days=10),
-    "HOUR": timedelta(days=41),
-    "DAY": timedelta(days=900)
-}
+COLUMN_STORE = os.getenv("APP_COLUMN_STORE")
+ARCHIVE = os.getenv("APP_ARCHIVE")
 
 
 
@@ -40,8 +37,11 @@ def fetch_news(db:Database):
 
 
 
-def fetch_data(db:Database, epics:list[str], timeframes:list[str]):
-    '''Scarica dati storici dei trading'''
+def fetch_data(db:Database, epics:list[str], timeframes:list[str], workers:int=1, gaps:bool=False):
+    '''
+    Scarica dati storici dei trading, con più epic in parallelo se workers > 1.
+    Con gaps scarica solo i buchi nello storico già presente e le barre fino a oggi, secondo l'indice di copertura
+    '''
     capital = CapitalDownloader(db, CAPITAL_APIKEY)
     capital.start_new_session(CAPITAL_EMAIL, CAPITAL_PASSWORD)
     capital.download_epics()
@@ -49,52 +49,42 @@ def fetch_data(db:Database, epics:list[str], timeframes:list[str]):
     if not epics:
         epics = db.get_all_epics()
 
-    total = len(epics)
-    completed = 0
-    start = time.time()
-
-    for epic in epics:
-        print(f"⏳ Inizio elaborazione {epic}...")
-        for resolution in timeframes:
-            to_date = db.get_oldest_date(epic, resolution)
-            to_date = datetime.now(timezone.utc) if to_date is None else to_date
-            from_date = to_date - CAPITAL_TIMEFRAME_LIMITS[resolution]
-
-            while True:
-                from_date_str = from_date.strftime("%Y-%m-%dT%H:%M:%S")
-                to_date_str = to_date.strftime("%Y-%m-%dT%H:%M:%S")
-
-                downloaded_data = capital.download_historical_data(epic, resolution, from_date_str, to_date_str)
-                
-                if not downloaded_data:
-                    break
-                
-                db.save_data_array(downloaded_data)
-
-                print(f"\t📊 Scaricati {len(downloaded_data)} record per {epic}:{resolution} da {from_date_str} a {to_date_str}...")
-
-                to_date = db.get_oldest_date(epic, resolution) - timedelta(seconds=1)
-                from_date = to_date - CAPITAL_TIMEFRAME_LIMITS[resolution]
-
-        completed += 1
-        percent = completed / total
-        delta = time.time() - start
-        remaining = (delta / completed) * (total - completed)
-        delta_str = str(timedelta(seconds=delta))[:-3]
-        remaining_str = str(timedelta(seconds=remaining))[:-3]
-        print(f"🕒 [{delta_str}] Rimasto: {remaining_str} {completed}/{total} ({percent:.2%})")
-
+    backfill = Backfill(db, capital, workers)
+    backfill.fill_gaps(epics, timeframes) if gaps else backfill.run(epics, timeframes)
     print("✅ Download di tutti i dati completato!")
 
 
 
+def stream_quotes(db:Database, epics:list[str], timeframes:list[str]):
+    '''Riceve le quotazioni in tempo reale degli epic e salva le barre costruite dai tick, fino a Ctrl+C'''
+    capital = CapitalDownloader(db, CAPITAL_APIKEY)
+    capital.start_new_session(CAPITAL_EMAIL, CAPITAL_PASSWORD)
+    resolutions = [timeframe for timeframe in timeframes if timeframe in RESOLUTION_SECONDS]
+    if not epics or not resolutions:
+        print(f"❌ Lo streaming richiede almeno un epic e un timeframe fra {', '.join(RESOLUTION_SECONDS)}")
+        return
+
+    stream = CapitalQuoteStream.from_downloader(capital, epics)
+    ingestor = QuoteIngestor(db, stream, resolutions)
+    print(f"📡 Streaming di {len(epics)} epic, barre {', '.join(resolutions)}...")
+    try:
+        ingestor.run()
+    finally:
+        stream.close()
+        print(f"✅ Ricevuti {ingestor.ticks} tick, salvate {ingestor.saved} barre")
+
+
+
 
 # ======= Main =======
 arg = argparse.ArgumentParser(description="Bot di trading")
 grp = arg.add_argument_group()
 grp.add_argument("-e", "--epics", help="Epic dei dati da scaricare, lasciare vuoto per tutti", nargs="*")
 grp.add_argument("-t", "--timeframe", help="Timeframe dei dati da scaricare, lasciare vuoto per DAY", nargs="*", choices=CAPITAL_TIMEFRAME_LIMITS.keys(), default=["DAY"])
+grp.add_argument("-g", "--gaps", help="Scarica solo i buchi nello storico già scaricato e le barre fino a oggi", action="store_true")
+grp.add_argument("-w", "--workers", help="Numero di epic scaricati in parallelo (condividono il limite di richieste)", type=int, default=1)
 arg.add_argument("-n", "--news", help="Scarica le news", action="store_true")
+arg.add_argument("-q", "--quotes", help="Riceve in streaming le quotazioni degli epic di -e e salva le barre dei timeframe di -t", action="store_true")
 arguments = arg.parse_args()
 
 if not len(sys.argv) > 1:
@@ -102,8 +92,17 @@ if not len(sys.argv) > 1:
     exit(1)
 
 try:
-    database = Database(DB_URL)
-    arguments.epics != None and fetch_data(database, arguments.epics, arguments.timeframe)
+    # Con più worker le connessioni vengono prese da un pool invece di restare aperte una per thread
+    database = Database(DB_URL, pool_size=arguments.workers if arguments.workers > 1 else None, archive=ARCHIVE)
+    if COLUMN_STORE:
+        # Le serie già nel database vengono importate all'attivazione dello store
+        column_store = ColumnStore(COLUMN_STORE)
+        column_store.seed(database)
+        database.add_ingest_listener(column_store.append)
+    if arguments.quotes:
+        stream_quotes(database, arguments.epics, arguments.timeframe)
+    elif arguments.epics != None:
+        fetch_data(database, arguments.epics, arguments.timeframe, arguments.workers, arguments.gaps)
     arguments.news and fetch_news(database)
 except KeyboardInterrupt:
     print("\n❌ Operazione annullata dall'utente.")
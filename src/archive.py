@@ -0,0 +1,296 @@
+import os
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+
+import transform
+
+# Periodo delle partizioni per resolution: le barre più fitte per mese, le altre per anno
+PARTITION_PERIOD = {
+    "MINUTE": "M",
+    "MINUTE_5": "M",
+    "MINUTE_15": "Y",
+    "MINUTE_30": "Y",
+    "HOUR": "Y",
+    "HOUR_4": "Y",
+    "DAY": "Y",
+    "WEEK": "Y"
+}
+
+# Giorni dopo i quali le barre di ogni resolution vengono archiviate da archive_cold
+ARCHIVE_AFTER_DAYS = {
+    "MINUTE": 90,
+    "MINUTE_5": 180,
+    "MINUTE_15": 365,
+    "MINUTE_30": 365,
+    "HOUR": 730,
+    "HOUR_4": 730
+}
+
+
+class Archive:
+    '''
+    Archivio compresso e colonnare delle barre fredde, partizionato per resolution e per mese o anno
+    (PARTITION_PERIOD): `<root>/<resolution>/<YYYY-MM o YYYY>/<epic>.npz`. Ogni file ha un membro compresso
+    per colonna: tempi in secondi epoch, prezzi (campi, barre) nell'ordine di transform.PRICE_FIELDS e volumi,
+    quindi leggere un epic decomprime solo i suoi file. I file letti restano in una piccola cache LRU.
+    Una barra già archiviata non viene sovrascritta, come on_conflict_ignore nel database.
+    '''
+
+    def __init__(self, root:str, cached_files:int=32):
+        self.root = root
+        self.cached_files = cached_files
+        self.cache = OrderedDict()  # (resolution, partizione, epic) -> colonne decompresse
+        self.listing = {}           # resolution -> (mtime della cartella, partizioni ordinate)
+        self.lock = threading.RLock()
+        os.makedirs(root, exist_ok=True)
+
+    # ======= Partizioni =======
+
+    @staticmethod
+    def period(resolution:str) -> str:
+        return PARTITION_PERIOD.get(resolution, "Y")
+
+    def labels(self, resolution:str, times:np.ndarray) -> np.ndarray:
+        '''Partizione di ogni tempo (secondi epoch)'''
+        return np.asarray(times, dtype='datetime64[s]').astype(f"datetime64[{self.period(resolution)}]").astype(str)
+
+    def bounds(self, resolution:str, label:str) -> tuple[int, int]:
+        '''Primo e ultimo secondo epoch coperti da una partizione'''
+        start = np.datetime64(label, self.period(resolution))
+        return int(start.astype('datetime64[s]').astype(np.int64)), int((start + 1).astype('datetime64[s]').astype(np.int64)) - 1
+
+    def path(self, resolution:str, label:str, epic:str) -> str:
+        return os.path.join(self.root, resolution, label, f"{epic}.npz")
+
+    def resolutions(self) -> list[str]:
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def partitions(self, resolution:str, since:int=None, until:int=None) -> list[str]:
+        '''Partizioni di una resolution in ordine di tempo, solo quelle che toccano [since, until]'''
+        folder = os.path.join(self.root, resolution)
+        if not os.path.isdir(folder):
+            return []
+        with self.lock:
+            mtime = os.stat(folder).st_mtime_ns
+            cached = self.listing.get(resolution)
+            if cached is None or cached[0] != mtime:
+                cached = self.listing[resolution] = (mtime, sorted(os.listdir(folder)))
+        labels = cached[1]
+        if since is None and until is None:
+            return list(labels)
+        result = []
+        for label in labels:
+            start, end = self.bounds(resolution, label)
+            if (since is None or end >= since) and (until is None or start <= until):
+                result.append(label)
+        return result
+
+    def load(self, resolution:str, label:str, epic:str) -> dict:
+        '''Colonne time, prices (campi, barre) e volume di un epic in una partizione, None se non archiviato'''
+        key = (resolution, label, epic)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        path = self.path(resolution, label, epic)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            columns = {name: data[name] for name in data.files}
+        self._remember(key, columns)
+        return columns
+
+    def _remember(self, key:tuple, columns:dict):
+        with self.lock:
+            self.cache[key] = columns
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cached_files:
+                self.cache.popitem(last=False)
+
+    # ======= Letture =======
+
+    def read(self, epic:str, resolution:str, since:int=None, until:int=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Tempi (secondi epoch), prezzi (barre, campi) e volumi di un epic fra since e until inclusi, in ordine di tempo'''
+        times, prices, volumes = [], [], []
+        for label in self.partitions(resolution, since, until):
+            columns = self.load(resolution, label, epic)
+            if columns is None:
+                continue
+            time = columns["time"]
+            first = 0 if since is None else np.searchsorted(time, since, side='left')
+            last = len(time) if until is None else np.searchsorted(time, until, side='right')
+            times.append(time[first:last])
+            prices.append(columns["prices"][:, first:last].T)
+            volumes.append(columns["volume"][first:last])
+        if not times:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(transform.PRICE_FIELDS))), np.empty(0, dtype=np.int64)
+        return np.concatenate(times), np.concatenate(prices), np.concatenate(volumes)
+
+    def edge(self, epic:str, resolution:str, newest:bool) -> int:
+        '''Tempo della barra archiviata più vecchia (o più recente) di un epic, None se non ce ne sono'''
+        labels = self.partitions(resolution)
+        for label in reversed(labels) if newest else labels:
+            columns = self.load(resolution, label, epic)
+            if columns is not None and len(columns["time"]):
+                return int(columns["time"][-1 if newest else 0])
+        return None
+
+    def series(self, resolutions:list[str]=None) -> set[tuple[str, str]]:
+        '''Coppie (epic, resolution) con barre archiviate'''
+        pairs = set()
+        for resolution in resolutions or self.resolutions():
+            for label in self.partitions(resolution):
+                folder = os.path.join(self.root, resolution, label)
+                pairs.update((name[:-4], resolution) for name in os.listdir(folder) if name.endswith(".npz") and ".tmp" not in name)
+        return pairs
+
+    def bar_days(self, epics:list[str], resolutions:list[str], since:int, until:int) -> set[tuple[str, str, str]]:
+        '''Celle (epic, resolution, giorno) con almeno una barra archiviata fra since e until'''
+        days = set()
+        for resolution in resolutions:
+            for epic in epics:
+                times, _, _ = self.read(epic, resolution, since, until)
+                for day in np.unique(times - times % 86400).astype('datetime64[s]').astype('datetime64[D]').astype(str):
+                    days.add((epic, resolution, day))
+        return days
+
+    # ======= Scritture =======
+
+    def write(self, blocks:list[transform.PriceColumns]) -> int:
+        '''
+        Aggiunge blocchi di barre ai file delle partizioni giuste, riscrivendo ogni file toccato una sola volta.
+        Il file nuovo viene scritto accanto a quello vecchio e poi lo sostituisce, quindi un'interruzione
+        lascia l'archivio intatto. Restituisce il numero di barre nuove.
+        '''
+        grouped = {}
+        for block in blocks:
+            if not len(block):
+                continue
+            times = np.asarray(block.times, dtype='datetime64[s]').astype(np.int64)
+            labels = self.labels(block.resolution, times)
+            for label in np.unique(labels):
+                mask = labels == label
+                grouped.setdefault((block.resolution, label, block.epic), []).append((times[mask], block.prices[mask], block.volume[mask]))
+
+        added = 0
+        for (resolution, label, epic), parts in grouped.items():
+            with self.lock:
+                columns = self.load(resolution, label, epic)
+                before = 0
+                if columns is not None:
+                    before = len(columns["time"])
+                    parts.insert(0, (columns["time"], columns["prices"].T, columns["volume"]))
+                time = np.concatenate([part[0] for part in parts])
+                # A parità di tempo resta la prima barra, cioè quella già archiviata
+                _, first = np.unique(time, return_index=True)
+                columns = {
+                    "time": time[first].astype(np.int64),
+                    "prices": np.ascontiguousarray(np.concatenate([part[1] for part in parts])[first].T, dtype=np.float64),
+                    "volume": np.concatenate([part[2] for part in parts])[first].astype(np.int64)
+                }
+                path = self.path(resolution, label, epic)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = path[:-4] + ".tmp.npz"
+                np.savez_compressed(tmp, **columns)
+                os.replace(tmp, path)
+                self._remember((resolution, label, epic), columns)
+                added += len(columns["time"]) - before
+        return added
+
+
+def archive_cold(db, days:dict[str, int]=ARCHIVE_AFTER_DAYS, now:int=None) -> int:
+    '''
+    Sposta nell'archivio di `db` (un Database con archive) le partizioni interamente più vecchie di
+    days[resolution] giorni, una serie e una partizione alla volta: le barre vengono prima scritte
+    nell'archivio e poi cancellate dalla tabella, quindi un'interruzione lascia al più barre in entrambi
+    i posti, che Database.get_bars restituisce una volta sola. Restituisce il numero di barre spostate.
+    '''
+    archive = db.archive
+    if archive is None:
+        raise ValueError("Il database non ha un archivio")
+    now = int(time.time()) if now is None else now
+
+    moved = 0
+    for resolution, keep in days.items():
+        period = archive.period(resolution)
+        # Solo partizioni intere: quella che contiene il limite resta nella tabella
+        last = np.datetime64(archive.labels(resolution, [now - keep * 86400])[0], period) - 1
+        for (epic, _), oldest in sorted(db.get_oldest_dates([resolution], archived=False).items()):
+            first = np.datetime64(oldest, 's').astype(f"datetime64[{period}]")
+            for label in np.arange(first, last + 1).astype(str):
+                since, until = np.array(archive.bounds(resolution, label), dtype='datetime64[s]').astype(str)
+                rows = db.get_bars(epic, resolution, since=since, until=until, archived=False)
+                if not rows:
+                    continue
+                archive.write(transform.columns_from_rows(rows))
+                db.delete_bars(epic, resolution, since, until)
+                moved += len(rows)
+    return moved
+
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    def block(epic:str, resolution:str, times:list[str]) -> transform.PriceColumns:
+        values = np.arange(len(times), dtype=np.float64)
+        prices = np.repeat(values[:, None], len(transform.PRICE_FIELDS), axis=1)
+        return transform.PriceColumns(epic, resolution, np.array(times, dtype=object), prices, values.astype(np.int64))
+
+    def epoch(date:str) -> int:
+        return int(np.datetime64(date, 's').astype(np.int64))
+
+    with tempfile.TemporaryDirectory() as root:
+        archive = Archive(root)
+        minutes = [f"2024-01-31T23:{m:02d}:00" for m in range(58, 60)] + [f"2024-02-01T00:{m:02d}:00" for m in range(3)]
+        assert archive.write([block("GOLD", "MINUTE", minutes), block("EUR_USD", "MINUTE", minutes[:2])]) == 7
+        assert archive.partitions("MINUTE") == ["2024-01", "2024-02"]
+        assert archive.partitions("MINUTE", since=epoch("2024-02-01")) == ["2024-02"]
+        assert archive.bounds("MINUTE", "2024-02") == (epoch("2024-02-01"), epoch("2024-02-29T23:59:59"))
+
+        # Letture che attraversano due partizioni
+        times, prices, volume = archive.read("GOLD", "MINUTE")
+        assert list(times.astype('datetime64[s]').astype(str)) == minutes and list(volume) == [0, 1, 2, 3, 4]
+        times, prices, _ = archive.read("GOLD", "MINUTE", since=epoch("2024-01-31T23:59:00"), until=epoch("2024-02-01T00:01:00"))
+        assert len(times) == 3 and list(prices[:, 6]) == [1, 2, 3]
+        assert len(archive.read("SILVER", "MINUTE")[0]) == 0
+
+        # Le barre già archiviate non vengono sovrascritte
+        assert archive.write([block("GOLD", "MINUTE", minutes[-2:] + ["2024-02-01T00:05:00"])]) == 1
+        times, _, volume = archive.read("GOLD", "MINUTE")
+        assert len(times) == 6 and list(volume[-3:]) == [3, 4, 2]
+
+        # File compressi riletti da un'altra istanza senza cache
+        archive = Archive(root)
+        assert archive.edge("GOLD", "MINUTE", newest=False) == epoch("2024-01-31T23:58:00")
+        assert archive.edge("GOLD", "MINUTE", newest=True) == epoch("2024-02-01T00:05:00")
+        assert archive.edge("GOLD", "DAY", newest=True) is None
+        assert archive.series() == {("GOLD", "MINUTE"), ("EUR_USD", "MINUTE")}
+        assert archive.bar_days(["EUR_USD"], ["MINUTE"], epoch("2024-01-01"), epoch("2024-12-31")) == {("EUR_USD", "MINUTE", "2024-01-31")}
+
+    # Database con archivio: le letture uniscono tabella e archivio in entrambi i formati
+    from database import Database
+
+    bars = [f"2024-{month:02d}-{day:02d}T12:00:00" for month in (1, 2, 3) for day in (10, 20)]
+    for storage in ("text", "compact"):
+        with tempfile.TemporaryDirectory() as root:
+            db = Database("sqlite:///:memory:", storage=storage, archive=root)
+            db.save_data_array(block("GOLD", "MINUTE", bars))
+            rows = db.get_bars("GOLD", "MINUTE")
+            assert archive_cold(db, {"MINUTE": 30}, now=epoch("2024-03-15")) == 2
+            assert archive_cold(db, {"MINUTE": 30}, now=epoch("2024-03-15")) == 0
+            assert [row[2] for row in db.get_bars("GOLD", "MINUTE", archived=False)] == bars[2:]
+            assert db.get_bars("GOLD", "MINUTE") == rows
+            assert db.get_bars("GOLD", "MINUTE", after=bars[0], limit=2) == rows[1:3]
+            assert db.get_bars("GOLD", "MINUTE", since="2024-01-15", until="2024-02-15") == rows[1:3]
+            assert db.get_oldest_date("GOLD", "MINUTE").isoformat() == bars[0]
+            assert db.get_oldest_dates(["MINUTE"])[("GOLD", "MINUTE")].isoformat() == bars[0]
+            assert db.get_oldest_dates(["MINUTE"], archived=False)[("GOLD", "MINUTE")].isoformat() == bars[2]
+            assert db.get_series() == [("GOLD", "MINUTE")]
+            assert ("GOLD", "MINUTE", "2024-01-10") in db.get_bar_days(["GOLD"], ["MINUTE"], "2024-01-01", "2024-03-31")
+
+            # Un'archiviazione interrotta lascia la barra in entrambi i posti: viene letta una volta
+            db.save_data_array(block("GOLD", "MINUTE", bars[:1]))
+            assert db.get_bars("GOLD", "MINUTE") == rows
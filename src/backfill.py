@@ -0,0 +1,227 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from database import Database
+from downloaders import CapitalDownloader
+
+CAPITAL_TIMEFRAME_LIMITS = {
+    "MINUTE": timedelta(hours=16),
+    "MINUTE_5": timedelta(hours=83),
+    "MINUTE_15": timedelta(days=10),
+    "HOUR": timedelta(days=41),
+    "DAY": timedelta(days=900)
+}
+
+# Il backfill di una serie è completato solo dopo almeno BACKFILL_EMPTY_WINDOWS finestre vuote consecutive
+# che coprono più di BACKFILL_EMPTY_SPAN: weekend e festività non fermano il download a ritroso
+BACKFILL_EMPTY_WINDOWS = 2
+BACKFILL_EMPTY_SPAN = timedelta(weeks=1)
+
+
+
+def download_interval(db:Database, capital:CapitalDownloader, save_lock:threading.Lock, epic:str, resolution:str, from_date:str, to_date:str) -> int:
+    '''
+    Scarica in avanti l'intervallo [from_date, to_date] di una serie, in finestre della dimensione massima
+    accettata da Capital.com. Ogni finestra viene salvata con la sua copertura, anche se vuota. Restituisce le barre salvate
+    '''
+    start, end = datetime.fromisoformat(from_date), datetime.fromisoformat(to_date)
+    saved = 0
+    while start <= end:
+        window_end = min(start + CAPITAL_TIMEFRAME_LIMITS[resolution] - timedelta(seconds=1), end)
+        window = (start.strftime("%Y-%m-%dT%H:%M:%S"), window_end.strftime("%Y-%m-%dT%H:%M:%S"))
+        data = capital.download_historical_data(epic, resolution, *window)
+        with save_lock, db.connection():
+            saved += db.save_window(epic, resolution, *window, data)
+        start = window_end + timedelta(seconds=1)
+    return saved
+
+
+
+class Progress:
+    '''Avanzamento e tempo rimanente stimato di un download, condivisibile fra più thread'''
+
+    def __init__(self, total:int):
+        self.total = total
+        self.completed = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def step(self):
+        with self.lock:
+            self.completed += 1
+            percent = self.completed / self.total
+            delta = time.time() - self.start
+            remaining = (delta / self.completed) * (self.total - self.completed)
+            delta_str = str(timedelta(seconds=delta))[:-3]
+            remaining_str = str(timedelta(seconds=remaining))[:-3]
+            print(f"🕒 [{delta_str}] Rimasto: {remaining_str} {self.completed}/{self.total} ({percent:.2%})")
+
+
+
+class Backfill:
+    '''
+    Scarica a ritroso lo storico di più epic in parallelo.
+    I worker condividono lo stesso CapitalDownloader, quindi anche il suo limite di richieste al secondo:
+    aumentare i worker tiene più richieste in volo senza superare il limite di Capital.com.
+    Ogni finestra salvata aggiorna il journal (BackfillCheckpoint) nella stessa transazione dei dati,
+    così un backfill interrotto riprende subito dall'ultima finestra completata.
+    '''
+
+    def __init__(self, db:Database, capital:CapitalDownloader, workers:int=4):
+        self.db = db
+        self.capital = capital
+        self.workers = max(1, workers)
+        self.checkpoints = {}
+        self.oldest_dates = {}
+        # SQLite ammette un solo writer alla volta: i salvataggi vengono serializzati.
+        # Con un pool la connessione viene presa solo per il salvataggio, non durante i download
+        self.save_lock = threading.Lock()
+
+    def load_journal(self, epics:list[str], timeframes:list[str]):
+        '''Carica il journal con una sola query; le date più vecchie servono solo per le coppie mai registrate'''
+        self.checkpoints = self.db.get_backfill_checkpoints()
+        if any((epic, resolution) not in self.checkpoints for epic in epics for resolution in timeframes):
+            self.oldest_dates = self.db.get_oldest_dates(timeframes)
+
+    def start_date(self, epic:str, resolution:str) -> datetime:
+        '''Data da cui riprendere il backfill a ritroso, None se già completato'''
+        checkpoint = self.checkpoints.get((epic, resolution))
+        if checkpoint is not None:
+            return None if checkpoint.completed else datetime.fromisoformat(checkpoint.fromDate) - timedelta(seconds=1)
+        oldest = self.oldest_dates.get((epic, resolution))
+        return datetime.now(timezone.utc) if oldest is None else oldest
+
+    def fetch_epic(self, epic:str, timeframes:list[str]):
+        '''Scarica a ritroso tutte le finestre mancanti di un epic per i timeframe indicati'''
+        print(f"⏳ Inizio elaborazione {epic}...")
+        for resolution in timeframes:
+            to_date = self.start_date(epic, resolution)
+            if to_date is None:
+                continue
+            from_date = to_date - CAPITAL_TIMEFRAME_LIMITS[resolution]
+            # Inizio (a ritroso) della sequenza di finestre vuote in corso; dopo un riavvio la sequenza riparte da zero
+            empty_since, empty_windows = None, 0
+
+            while True:
+                from_date_str = from_date.strftime("%Y-%m-%dT%H:%M:%S")
+                to_date_str = to_date.strftime("%Y-%m-%dT%H:%M:%S")
+
+                downloaded_data = self.capital.download_historical_data(epic, resolution, from_date_str, to_date_str)
+
+                if not downloaded_data:
+                    empty_since = empty_since or to_date
+                    empty_windows += 1
+                    completed = empty_windows >= BACKFILL_EMPTY_WINDOWS and empty_since - from_date > BACKFILL_EMPTY_SPAN
+                    with self.save_lock, self.db.connection():
+                        self.db.save_backfill_window(epic, resolution, from_date_str, to_date_str, completed=completed)
+                    if completed:
+                        break
+                    to_date = from_date - timedelta(seconds=1)
+                    from_date = to_date - CAPITAL_TIMEFRAME_LIMITS[resolution]
+                    continue
+
+                empty_since, empty_windows = None, 0
+                oldest = downloaded_data.oldest()
+                with self.save_lock, self.db.connection():
+                    self.db.save_backfill_window(epic, resolution, oldest, to_date_str, downloaded_data)
+
+                print(f"\t📊 Scaricati {len(downloaded_data)} record per {epic}:{resolution} da {from_date_str} a {to_date_str}...")
+
+                to_date = datetime.fromisoformat(oldest) - timedelta(seconds=1)
+                from_date = to_date - CAPITAL_TIMEFRAME_LIMITS[resolution]
+
+    def run(self, epics:list[str], timeframes:list[str]):
+        '''Distribuisce gli epic sul pool di worker e riporta avanzamento ed ETA a ogni epic completato'''
+        self.load_journal(epics, timeframes)
+        progress = Progress(len(epics))
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="backfill")
+        try:
+            with self.db.bulk_ingest():
+                futures = {executor.submit(self.fetch_epic, epic, timeframes): epic for epic in epics}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        print(f"❌ Errore critico durante il download dei dati storici per {futures[future]}.")
+                        raise
+                    progress.step()
+        finally:
+            # In caso di errore o Ctrl+C non vengono avviati altri epic
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def fill_gaps(self, epics:list[str], timeframes:list[str]):
+        '''
+        Riscarica i buchi nello storico già scaricato (richieste fallite, finestre interrotte) e la parte
+        fino a oggi, calcolati dall'indice di copertura senza leggere le barre. Un worker per serie.
+        '''
+        self.db.seed_coverage()
+        missing = self.db.get_missing_intervals(epics, timeframes)
+        if not missing:
+            print("✅ Nessun buco nello storico")
+            return
+
+        def fetch(epic:str, resolution:str, gaps:list[tuple[str, str]]):
+            for from_date, to_date in gaps:
+                saved = download_interval(self.db, self.capital, self.save_lock, epic, resolution, from_date, to_date)
+                print(f"\t📊 Scaricati {saved} record per {epic}:{resolution} da {from_date} a {to_date}...")
+
+        progress = Progress(len(missing))
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gaps")
+        try:
+            with self.db.bulk_ingest():
+                futures = {executor.submit(fetch, epic, resolution, gaps): epic for (epic, resolution), gaps in missing.items()}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        print(f"❌ Errore critico durante il download dei buchi per {futures[future]}.")
+                        raise
+                    progress.step()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+if __name__ == "__main__":
+    import io
+    import contextlib
+    from transform import columns_from_rows, from_capital_prices
+
+    class FakeCapital:
+        '''Server finto: restituisce le barre di `rows` che cadono nella finestra richiesta'''
+        def __init__(self, rows:list[tuple]):
+            self.rows = rows
+            self.requests = 0
+
+        def download_historical_data(self, epic:str, resolution:str, from_date:str, to_date:str):
+            self.requests += 1
+            window = [row for row in self.rows if row[:2] == (epic, resolution) and from_date <= row[2] <= to_date]
+            return columns_from_rows(window)[0] if window else from_capital_prices(epic, resolution, [])
+
+    def bars(start:str, hours:int) -> list[tuple]:
+        first = datetime.fromisoformat(start)
+        return [('GOLD', 'MINUTE', (first + timedelta(minutes=10 * i)).strftime("%Y-%m-%dT%H:%M:%S"), 1.0, 1.1, 1.2, 1.3, 0.9, 1.0, 1.1, 1.2, 10)
+                for i in range(hours * 6)]
+
+    # Storico con un buco di quattro giorni (weekend lungo) fra due tratti di barre MINUTE
+    rows = bars('2024-01-02T00:00:00', 24) + bars('2024-01-06T00:00:00', 24)
+    db = Database("sqlite:///:memory:")
+    db.save_data_array(rows[-1:])
+    capital = FakeCapital(rows)
+    backfill = Backfill(db, capital, workers=1)
+    backfill.load_journal(['GOLD'], ['MINUTE'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        backfill.fetch_epic('GOLD', ['MINUTE'])
+    # Il buco non ferma il backfill: arrivano anche le barre precedenti, poi una settimana vuota lo completa
+    assert len(db.get_bars('GOLD', 'MINUTE')) == len(rows)
+    checkpoint = db.get_backfill_checkpoints()[('GOLD', 'MINUTE')]
+    assert checkpoint.completed and datetime.fromisoformat(checkpoint.fromDate) < datetime(2024, 1, 2) - BACKFILL_EMPTY_SPAN
+
+    # Una serie completata non viene più richiesta al server
+    requests = capital.requests
+    backfill.load_journal(['GOLD'], ['MINUTE'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        backfill.fetch_epic('GOLD', ['MINUTE'])
+    assert capital.requests == requests
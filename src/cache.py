@@ -0,0 +1,194 @@
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    '''
+    Cache in memoria condivisibile fra più thread, con:
+    - scadenza per chiave (ttl passato a ogni caricamento, o quello di default)
+    - eliminazione LRU oltre `max_entries` voci o `max_bytes` di dimensione stimata
+    - single-flight: richieste concorrenti per la stessa chiave aspettano un solo caricamento
+    Gli errori del caricamento vengono propagati a tutti i chiamanti in attesa ma non memorizzati.
+    '''
+
+    def __init__(self, ttl:float=60.0, max_entries:int=1024, max_bytes:int=None, sizeof=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or approximate_size
+        self.entries = OrderedDict() # key -> (scadenza, dimensione, valore), dalla meno alla più recente
+        self.loading = {}            # key -> Future del caricamento in corso
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        # Contatori
+        self.hits = 0       # valori trovati e non scaduti
+        self.misses = 0     # caricamenti eseguiti
+        self.coalesced = 0  # richieste che hanno atteso il caricamento di un'altra
+        self.evictions = 0  # voci eliminate per rispettare i limiti
+        self.expired = 0    # voci trovate scadute
+
+    def _lookup(self, key, now:float):
+        '''Valore non scaduto della chiave, spostata in coda LRU; chiamare con il lock'''
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= now:
+            self._remove(key)
+            self.expired += 1
+            return False, None
+        self.entries.move_to_end(key)
+        return True, entry[2]
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def _store(self, key, value, ttl:float):
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + ttl, size, value)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self.lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+            return value if found else default
+
+    def set(self, key, value, ttl:float=None):
+        with self.lock:
+            self._store(key, value, self.ttl if ttl is None else ttl)
+
+    def get_or_load(self, key, loader, ttl:float=None):
+        '''Valore della chiave; se assente o scaduto lo carica con loader(), una sola volta anche con più thread in attesa'''
+        with self.lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            future = self.loading.get(key)
+            if future is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                future = self.loading[key] = Future()
+                self.misses += 1
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self._store(key, value, self.ttl if ttl is None else ttl)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def invalidate_where(self, predicate) -> int:
+        '''Elimina le voci la cui chiave soddisfa predicate(key). Restituisce il numero di voci eliminate'''
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "hit_rate": (self.hits + self.coalesced) / requests if requests else 0.0
+            }
+
+
+
+def approximate_size(value) -> int:
+    '''Dimensione stimata in byte di un valore: la lunghezza del suo JSON, o sys.getsizeof se non serializzabile'''
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return sys.getsizeof(value)
+
+
+
+if __name__ == "__main__":
+    # Scadenza per chiave
+    cache = TTLCache(ttl=60)
+    assert cache.get_or_load("a", lambda: 1, ttl=0.05) == 1
+    assert cache.get_or_load("a", lambda: 2) == 1
+    time.sleep(0.06)
+    assert cache.get_or_load("a", lambda: 3) == 3
+    assert cache.stats()["expired"] == 1
+
+    # LRU con limite di voci e di memoria
+    cache = TTLCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.stats()["evictions"] == 1
+    cache = TTLCache(max_bytes=20)
+    cache.set("a", "x" * 10)
+    cache.set("b", "y" * 10)
+    assert cache.get("a") is None and cache.get("b") == "y" * 10 and cache.bytes == 12
+
+    # Single-flight: 8 thread concorrenti, un solo caricamento
+    cache = TTLCache()
+    calls = []
+    def slow_loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return "value"
+    threads = [threading.Thread(target=cache.get_or_load, args=("k", slow_loader)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and cache.stats()["coalesced"] == 7
+
+    # Gli errori non vengono memorizzati
+    def failing_loader():
+        raise RuntimeError("upstream")
+    try:
+        cache.get_or_load("e", failing_loader)
+        assert False
+    except RuntimeError:
+        pass
+    assert cache.get_or_load("e", lambda: "ok") == "ok"
+
+    assert cache.invalidate_where(lambda key: key in ("k", "e")) == 2 and cache.stats()["entries"] == 0
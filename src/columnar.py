@@ -0,0 +1,631 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Il lock fra processi usa flock: dove non c'è (Windows) resta solo quello fra thread
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import transform
+from database import Database
+
+# Una barra su disco: tempo in millisecondi epoch UTC, prezzi nell'ordine di HistoricalData e volume
+BAR_DTYPE = np.dtype([('time', '<i8')] + [(field, '<f8') for field in transform.PRICE_FIELDS] + [('lastTradedVolume', '<i8')])
+
+
+class ColumnStore:
+    '''
+    Copia colonnare di HistoricalData su disco, letta tramite memory-map.
+    Per ogni (epic, resolution) ci sono due file append-only di barre BAR_DTYPE:
+    - `forward.bars` in ordine crescente, dove finiscono le barre più recenti (daily update, streaming)
+    - `backward.bars` in ordine decrescente, dove finiscono le barre più vecchie (backfill a ritroso)
+    La serie completa è backward rovesciato seguito da forward. Solo le barre che cadono in mezzo
+    allo storico già presente costringono a riscrivere i file, fondendoli in un unico forward.
+    Più processi (app.py, api.py, daily_update.py) scrivono nello stesso store: ogni scrittura di una coppia
+    avviene con un flock sul file `lock` della sua cartella, oltre al lock fra i thread del processo.
+    '''
+
+    def __init__(self, root:str):
+        self.root = root
+        self.lock = threading.Lock()
+        self.locks = {}
+        os.makedirs(root, exist_ok=True)
+
+    def folder(self, epic:str, resolution:str) -> str:
+        return os.path.join(self.root, resolution, epic.replace(os.sep, "_"))
+
+    def _open(self, epic:str, resolution:str, name:str) -> np.ndarray:
+        '''Memory-map di un file in sola lettura, vuoto se non esiste. Un record troncato da un crash viene ignorato'''
+        path = os.path.join(self.folder(epic, resolution), name)
+        count = os.path.getsize(path) // BAR_DTYPE.itemsize if os.path.exists(path) else 0
+        if count == 0:
+            return np.empty(0, dtype=BAR_DTYPE)
+        return np.memmap(path, dtype=BAR_DTYPE, mode='r', shape=(count,))
+
+    @contextmanager
+    def _locked(self, epic:str, resolution:str):
+        '''Scrittura esclusiva della coppia: lock fra i thread e flock fra i processi. Restituisce la cartella'''
+        folder = self.folder(epic, resolution)
+        os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            lock = self.locks.setdefault(folder, threading.Lock())
+        # Il flock viene rilasciato alla chiusura del file, anche se il processo muore
+        with lock, open(os.path.join(folder, 'lock'), 'a') as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            yield folder
+
+    def append(self, columns:transform.PriceColumns):
+        '''Aggiunge un blocco di barre; pensato per essere registrato come listener di ingest del Database'''
+        if not len(columns):
+            return
+        with self._locked(columns.epic, columns.resolution):
+            self._append(columns)
+
+    def _append(self, columns:transform.PriceColumns):
+        '''append con il lock della coppia già preso'''
+        block = to_bars(columns)
+        block = block[np.argsort(block['time'], kind='stable')]
+        folder = self.folder(columns.epic, columns.resolution)
+        forward = self._open(columns.epic, columns.resolution, 'forward.bars')
+        backward = self._open(columns.epic, columns.resolution, 'backward.bars')
+        first = backward[-1]['time'] if len(backward) else (forward[0]['time'] if len(forward) else None)
+        last = forward[-1]['time'] if len(forward) else (backward[0]['time'] if len(backward) else None)
+
+        if last is None or block['time'][0] > last:
+            with open(os.path.join(folder, 'forward.bars'), 'ab') as file:
+                block.tofile(file)
+        elif block['time'][-1] < first:
+            with open(os.path.join(folder, 'backward.bars'), 'ab') as file:
+                block[::-1].tofile(file)
+        else:
+            self._merge(folder, np.concatenate([backward[::-1], forward, block]))
+        del forward, backward
+
+    def _merge(self, folder:str, bars:np.ndarray):
+        '''
+        Riscrive la serie ordinata in un unico forward; a parità di tempo vince l'ultima barra, cioè quella ricevuta dal
+        listener di ingest, che passa solo barre scritte nel database (nuove o sostituite da save_data_array con overwrite).
+        Va chiamato con il lock della coppia preso
+        '''
+        _, last = np.unique(bars['time'][::-1], return_index=True)
+        bars = bars[::-1][last]
+        tmp = os.path.join(folder, 'forward.bars.tmp')
+        bars.tofile(tmp)
+        os.replace(tmp, os.path.join(folder, 'forward.bars'))
+        backward = os.path.join(folder, 'backward.bars')
+        if os.path.exists(backward):
+            os.remove(backward)
+
+    def compact(self, epic:str, resolution:str):
+        '''Fonde backward in forward, così anche le letture di tutto lo storico sono senza copie'''
+        with self._locked(epic, resolution) as folder:
+            backward = self._open(epic, resolution, 'backward.bars')
+            if len(backward):
+                forward = self._open(epic, resolution, 'forward.bars')
+                self._merge(folder, np.concatenate([backward[::-1], forward]))
+
+    def count(self, epic:str, resolution:str) -> int:
+        return len(self._open(epic, resolution, 'forward.bars')) + len(self._open(epic, resolution, 'backward.bars'))
+
+    def count_between(self, epic:str, resolution:str, start:int, end:int) -> int:
+        '''Numero di barre con tempo (ms epoch) in [start, end], con una ricerca binaria sui memory-map'''
+        count = 0
+        for times in (self._open(epic, resolution, 'forward.bars')['time'], self._open(epic, resolution, 'backward.bars')['time'][::-1]):
+            count += int(np.searchsorted(times, end, side='right') - np.searchsorted(times, start, side='left'))
+        return count
+
+    def tail(self, epic:str, resolution:str, n:int=None) -> np.ndarray:
+        '''
+        Ultime n barre (tutte se n è None) in ordine crescente di tempo.
+        Quando stanno tutte in forward.bars il risultato è una vista sul memory-map, senza copie:
+        tail(...)['closeBid'] è direttamente la colonna delle chiusure.
+        '''
+        forward = self._open(epic, resolution, 'forward.bars')
+        if n is not None and n <= len(forward):
+            return forward[len(forward) - n:]
+        backward = self._open(epic, resolution, 'backward.bars')
+        if not len(backward):
+            return forward
+        missing = len(backward) if n is None else min(len(backward), n - len(forward))
+        return np.concatenate([backward[:missing][::-1], forward])
+
+    def last_closes(self, epics:list[str], resolution:str, bars:int) -> tuple[list[str], np.ndarray]:
+        '''Stesso formato di Database.get_last_closes, letto dai memory-map senza passare dal database'''
+        closes = np.full((len(epics), bars), np.nan)
+        last = [None] * len(epics)
+        for row, epic in enumerate(epics):
+            tail = self.tail(epic, resolution, bars)
+            if len(tail):
+                closes[row, bars - len(tail):] = tail['closeBid']
+                last[row] = str(np.datetime64(int(tail['time'][-1]), 'ms').astype('datetime64[s]'))
+        return last, closes
+
+    def covers(self, epic:str, resolution:str) -> bool:
+        '''
+        True se i file della coppia contengono tutto lo storico del database, cioè sono stati importati con
+        import_database e da allora aggiornati dal listener di ingest. Solo queste coppie vanno lette dallo store:
+        le altre hanno al più le barre salvate dopo l'attivazione dello store
+        '''
+        return os.path.exists(os.path.join(self.folder(epic, resolution), 'imported'))
+
+    def import_database(self, db:Database, epic:str, resolution:str, chunk:int=100_000, missing:bool=False) -> bool:
+        '''
+        Ricostruisce i file di una coppia leggendo le barre del database in ordine, per popolare lo store su un database esistente.
+        Tutta l'importazione, fino al marker `imported`, avviene con il lock della coppia: le barre salvate intanto
+        da altri processi vengono aggiunte dopo, senza duplicati. Con missing=True una coppia già coperta
+        (ad esempio importata da un altro processo mentre si aspettava il lock) non viene riletta.
+        Restituisce True se la coppia è stata importata
+        '''
+        with self._locked(epic, resolution) as folder:
+            if missing and self.covers(epic, resolution):
+                return False
+            for name in ('imported', 'forward.bars', 'backward.bars'):
+                if os.path.exists(os.path.join(folder, name)):
+                    os.remove(os.path.join(folder, name))
+
+            last = None
+            while rows := db.get_bars(epic, resolution, after=last, limit=chunk):
+                self._append(transform.columns_from_rows(rows)[0])
+                last = rows[-1][2]
+            open(os.path.join(folder, 'imported'), 'w').close()
+        return True
+
+    def seed(self, db:Database) -> int:
+        '''
+        Importa dal database tutte le coppie non ancora coperte; da chiamare quando lo store viene attivato,
+        prima di registrarne il listener di ingest. Le coppie già importate, anche da un altro processo, non vengono rilette.
+        Restituisce le coppie importate
+        '''
+        pairs = [pair for pair in db.get_series() if not self.covers(*pair)]
+        return sum(self.import_database(db, epic, resolution, missing=True) for epic, resolution in pairs)
+
+
+
+class BarWindowCache:
+    '''
+    Cache in memoria, condivisa fra thread, delle ultime `size` barre di ogni (epic, resolution) in array
+    BAR_DTYPE contigui, con eliminazione LRU oltre `max_series` serie. Una serie viene letta alla prima
+    richiesta (dal ColumnStore se la copre interamente, altrimenti con Database.get_last_bars) e poi resta aggiornata
+    da append, da registrare come listener di ingest: i blocchi delle serie non in cache vengono ignorati.
+    Le barre salvate da altri processi (app.py, daily_update.py, lo streaming) non passano da append:
+    dopo `ttl` secondi dall'ultimo controllo una finestra viene confrontata con l'ultima barra salvata
+    e vengono lette solo le barre mancanti. Poi il numero di barre salvate fra la prima barra letta e l'ultima
+    viene confrontato con quelle ricevute: se differisce qualcuno ha salvato barre più vecchie dell'ultima
+    (un buco riempito, un backfill) e la finestra viene riletta per intero. sync() fa lo stesso controllo subito.
+    Ogni rilettura incrementa version() della serie e viene notificata ai listener di add_reload_listener,
+    ad esempio per scartare lo stato degli indicatori incrementali calcolato sulla finestra precedente.
+    Il DataFrame di ogni finestra viene costruito una sola volta, alla prima lettura dopo un aggiornamento.
+    '''
+
+    def __init__(self, db:Database, column_store:ColumnStore=None, size:int=500, max_series:int=1024, ttl:float=15.0):
+        self.db = db
+        self.column_store = column_store
+        self.size = size
+        self.max_series = max_series
+        self.ttl = ttl
+        # (epic, resolution) -> [barre, DataFrame o None, ultimo controllo, prima barra letta (ms), barre da allora],
+        # dalla meno alla più recente
+        self.windows = OrderedDict()
+        self.loading = {}             # (epic, resolution) -> blocchi arrivati durante la lettura iniziale
+        self.versions = {}            # (epic, resolution) -> numero di riletture, anche dopo l'eliminazione LRU
+        self.reload_listeners = []
+        self.lock = threading.Lock()
+
+        # Contatori
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0  # finestre aggiornate con barre salvate da altri processi
+        self.reloads = 0    # finestre rilette perché sono cambiate barre già viste
+
+    def _merge(self, window:np.ndarray, block:np.ndarray) -> np.ndarray:
+        '''Ultime `size` barre dell'unione; a parità di tempo resta la barra già presente, come on_conflict_ignore'''
+        if not len(window) or block['time'][0] > window['time'][-1]:
+            merged = np.concatenate([window, block])
+        else:
+            merged = np.concatenate([window, block])
+            _, first = np.unique(merged['time'], return_index=True)
+            merged = merged[first]
+        return merged[-self.size:]
+
+    def _read(self, epics:list[str], resolution:str) -> dict[str, np.ndarray]:
+        '''Ultime `size` barre di più epic dallo store colonnare o con un'unica lettura dal database'''
+        windows = {}
+        missing = []
+        for epic in epics:
+            if self.column_store and self.column_store.covers(epic, resolution):
+                windows[epic] = np.array(self.column_store.tail(epic, resolution, self.size))
+            else:
+                missing.append(epic)
+        rows = self.db.get_last_bars(missing, resolution, self.size) if missing else {}
+        for epic in missing:
+            windows[epic] = to_bars(transform.columns_from_rows(rows[epic])[0]) if epic in rows else np.empty(0, dtype=BAR_DTYPE)
+        return windows
+
+    def _newest(self, epic:str, resolution:str) -> int:
+        '''Tempo (ms epoch) dell'ultima barra salvata, None se non ce ne sono'''
+        if self.column_store and self.column_store.covers(epic, resolution):
+            return int(self.column_store.tail(epic, resolution, 1)['time'][-1])
+        newest = self.db.get_newest_date(epic, resolution)
+        return None if newest is None else int(np.datetime64(newest, 'ms').astype(np.int64))
+
+    def _count(self, epic:str, resolution:str, start:int, end:int) -> int:
+        '''Barre salvate fra start e end (ms epoch), contate senza leggerle'''
+        if self.column_store and self.column_store.covers(epic, resolution):
+            return self.column_store.count_between(epic, resolution, start, end)
+        since, until = (str(np.datetime64(t, 'ms').astype('datetime64[s]')) for t in (start, end))
+        return self.db.count_bars(epic, resolution, since, until)
+
+    def _entry(self, bars:np.ndarray) -> list:
+        return [bars, None, time.monotonic(), int(bars['time'][0]) if len(bars) else None, len(bars)]
+
+    def _loaded(self, key:tuple):
+        '''Una finestra è stata (ri)letta: nuova versione e notifica ai listener, fuori dal lock'''
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+        for listener in self.reload_listeners:
+            listener(*key)
+
+    def _reload(self, epic:str, resolution:str, entry:list):
+        bars = self._read([epic], resolution)[epic]
+        with self.lock:
+            entry[:] = self._entry(bars)
+            self.reloads += 1
+        self._loaded((epic, resolution))
+
+    def _refresh(self, epic:str, resolution:str, entry:list, newest:int=None):
+        '''
+        Aggiunge alla finestra le barre più recenti della sua ultima, se ce ne sono, poi controlla che non siano
+        cambiate barre già viste; altrimenti, o se le barre nuove sono più della finestra, la rilegge
+        '''
+        newest = self._newest(epic, resolution) if newest is None else newest
+        bars = entry[0]
+        last = int(bars['time'][-1]) if len(bars) else None
+        if newest is not None and (last is None or newest > last):
+            rows = [] if last is None or (self.column_store and self.column_store.covers(epic, resolution)) else self.db.get_bars(
+                epic, resolution, after=str(np.datetime64(last, 'ms').astype('datetime64[s]')), limit=self.size + 1)
+            if not rows or len(rows) > self.size:
+                # Troppe barre nuove, finestra vuota o store colonnare: si rilegge tutta la finestra
+                return self._reload(epic, resolution, entry)
+            block = to_bars(transform.columns_from_rows(rows)[0])
+            with self.lock:
+                entry[0] = self._merge(entry[0], block)
+                entry[1] = None
+                entry[4] += len(block)
+                self.refreshes += 1
+            last = int(block['time'][-1])
+        # Oltre 10 finestre di barre contate la finestra viene riletta, così il conteggio resta una scansione breve
+        if entry[3] is not None and (entry[4] > 10 * self.size or self._count(epic, resolution, entry[3], last) != entry[4]):
+            return self._reload(epic, resolution, entry)
+        entry[2] = time.monotonic()
+
+    def sync(self, epic:str, resolution:str, newest):
+        '''Controlla subito la finestra, leggendola se non è in cache, fino all'ultima barra `newest` (ms epoch o datetime)'''
+        with self.lock:
+            entry = self.windows.get((epic, resolution))
+        if entry is None:
+            self._entries([epic], resolution)
+            return
+        if newest is not None and not isinstance(newest, (int, np.integer)):
+            newest = int(np.datetime64(newest, 'ms').astype(np.int64))
+        self._refresh(epic, resolution, entry, newest)
+
+    def version(self, epic:str, resolution:str) -> int:
+        '''Numero di (ri)letture della finestra: i risultati calcolati con una versione precedente non valgono più'''
+        with self.lock:
+            return self.versions.get((epic, resolution), 0)
+
+    def add_reload_listener(self, listener):
+        '''Registra una funzione chiamata con (epic, resolution) ogni volta che una finestra viene (ri)letta'''
+        self.reload_listeners.append(listener)
+
+    def _entries(self, epics:list[str], resolution:str) -> dict[str, list]:
+        '''Finestre di più epic, leggendo insieme quelle non ancora in cache e aggiornando quelle non controllate da `ttl` secondi'''
+        entries = {}
+        stale = []
+        now = time.monotonic()
+        with self.lock:
+            for epic in epics:
+                entry = self.windows.get((epic, resolution))
+                if entry is not None:
+                    self.windows.move_to_end((epic, resolution))
+                    entries[epic] = entry
+                    self.hits += 1
+                    if now - entry[2] >= self.ttl:
+                        stale.append(epic)
+                else:
+                    self.loading.setdefault((epic, resolution), [])
+            missing = [epic for epic in epics if epic not in entries]
+        for epic in stale:
+            self._refresh(epic, resolution, entries[epic])
+        if not missing:
+            return entries
+
+        try:
+            loaded = self._read(missing, resolution)
+        except BaseException:
+            with self.lock:
+                for epic in missing:
+                    self.loading.pop((epic, resolution), None)
+            raise
+        with self.lock:
+            for epic in missing:
+                key = (epic, resolution)
+                pending = self.loading.pop(key, [])
+                entry = self.windows.get(key)
+                if entry is None:
+                    bars = loaded[epic]
+                    # Le barre salvate durante la lettura potrebbero non esserci: vengono fuse ora
+                    for block in pending:
+                        bars = self._merge(bars, block)
+                    entry = self.windows[key] = self._entry(bars)
+                    self.misses += 1
+                    while len(self.windows) > self.max_series:
+                        self.windows.popitem(last=False)
+                        self.evictions += 1
+                entries[epic] = entry
+        for epic in missing:
+            self._loaded((epic, resolution))
+        return entries
+
+    def bars(self, epic:str, resolution:str, n:int=None) -> np.ndarray:
+        '''Ultime n barre (al massimo `size`) in ordine crescente di tempo; non vanno modificate'''
+        bars = self._entries([epic], resolution)[epic][0]
+        return bars if n is None else bars[len(bars) - min(n, len(bars)):]
+
+    def frames(self, epics:list[str], resolution:str, n:int=None) -> dict[str, pd.DataFrame]:
+        '''DataFrame (come to_frame) delle ultime n barre degli epic con dati'''
+        frames = {}
+        for epic, entry in self._entries(epics, resolution).items():
+            bars, frame = entry[0], entry[1]
+            if not len(bars):
+                continue
+            if frame is None:
+                frame = to_frame(bars)
+                with self.lock:
+                    # Se nel frattempo è arrivato un aggiornamento il DataFrame non viene memorizzato
+                    if entry[0] is bars:
+                        entry[1] = frame
+            frames[epic] = frame if n is None else frame.iloc[-n:]
+        return frames
+
+    def frame(self, epic:str, resolution:str, n:int=None) -> pd.DataFrame:
+        '''DataFrame delle ultime n barre, None se la serie non ha dati'''
+        return self.frames([epic], resolution, n).get(epic)
+
+    def latest(self, epic:str, resolution:str) -> tuple[int, float]:
+        '''Tempo (ms epoch) e closeBid dell'ultima barra, None se la serie non ha dati'''
+        with self.lock:
+            entry = self.windows.get((epic, resolution))
+            if entry is not None and len(entry[0]) and time.monotonic() - entry[2] < self.ttl:
+                self.hits += 1
+                self.windows.move_to_end((epic, resolution))
+                last = entry[0][-1]
+                return int(last['time']), float(last['closeBid'])
+        bars = self.bars(epic, resolution, 1)
+        return (int(bars['time'][-1]), float(bars['closeBid'][-1])) if len(bars) else None
+
+    def append(self, columns:transform.PriceColumns):
+        '''Aggiunge un blocco di barre alla finestra della sua serie, se è in cache; pensato come listener di ingest'''
+        if not len(columns):
+            return
+        key = (columns.epic, columns.resolution)
+        with self.lock:
+            if key not in self.windows and key not in self.loading:
+                return
+        block = to_bars(columns)
+        block = block[np.argsort(block['time'], kind='stable')]
+        with self.lock:
+            entry = self.windows.get(key)
+            if entry is not None and len(entry[0]) and block['time'][0] <= entry[0]['time'][-1]:
+                # Barre non più recenti della finestra: viene riletta alla prossima richiesta
+                del self.windows[key]
+                entry = None
+                rewritten = True
+            else:
+                rewritten = False
+            if entry is not None:
+                entry[0] = self._merge(entry[0], block)
+                entry[1] = None
+                entry[4] += len(block)
+                if entry[3] is None:
+                    entry[3] = int(entry[0]['time'][0])
+            elif key in self.loading:
+                self.loading[key].append(block)
+        if rewritten:
+            self._loaded(key)
+
+    def invalidate(self, epic:str, resolution:str):
+        with self.lock:
+            self.windows.pop((epic, resolution), None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "series": len(self.windows),
+                "bytes": sum(entry[0].nbytes for entry in self.windows.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "refreshes": self.refreshes,
+                "reloads": self.reloads,
+                "hit_rate": self.hits / requests if requests else 0.0
+            }
+
+
+
+def to_bars(columns:transform.PriceColumns) -> np.ndarray:
+    '''Converte un blocco PriceColumns nel formato su disco'''
+    bars = np.empty(len(columns), dtype=BAR_DTYPE)
+    bars['time'] = columns.times.astype('datetime64[ms]').astype(np.int64)
+    for i, field in enumerate(transform.PRICE_FIELDS):
+        bars[field] = columns.prices[:, i]
+    bars['lastTradedVolume'] = columns.volume
+    return bars
+
+def to_frame(bars:np.ndarray) -> pd.DataFrame:
+    '''
+    DataFrame nel formato usato dalle analisi (open/high/low/close sul bid, volume, indice temporale),
+    equivalente a quello costruito da una query su HistoricalData
+    '''
+    df = pd.DataFrame({field: bars[field] for field in BAR_DTYPE.names if field != 'time'})
+    df.index = pd.to_datetime(bars['time'], unit='ms')
+    df.index.name = 'snapshotTimeUTC'
+    return df.rename(columns={
+        'openBid': 'open',
+        'highBid': 'high',
+        'lowBid': 'low',
+        'closeBid': 'close',
+        'lastTradedVolume': 'volume'
+    })
+
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    def block(days:range) -> transform.PriceColumns:
+        times = np.array([f"2024-01-{d:02d}T00:00:00" for d in days], dtype=object)
+        prices = np.array([[d] * len(transform.PRICE_FIELDS) for d in days], dtype=np.float64)
+        return transform.PriceColumns("GOLD", "DAY", times, prices, np.array(list(days), dtype=np.int64))
+
+    with tempfile.TemporaryDirectory() as root:
+        store = ColumnStore(root)
+        assert len(store.tail("GOLD", "DAY", 10)) == 0
+
+        # Backfill a ritroso: la finestra più recente va in forward, le altre in backward
+        store.append(block(range(20, 26)))
+        store.append(block(range(10, 20)))
+        store.append(block(range(1, 10)))
+        assert store.count("GOLD", "DAY") == 25
+        assert list(store.tail("GOLD", "DAY")['closeBid']) == list(range(1, 26))
+
+        # Le ultime barre sono una vista sul memory-map
+        last = store.tail("GOLD", "DAY", 3)
+        assert isinstance(last, np.memmap) and list(last['lastTradedVolume']) == [23, 24, 25]
+        assert list(store.tail("GOLD", "DAY", 8)['closeBid']) == list(range(18, 26))
+
+        # Barre sovrapposte: fusione senza duplicati, con i valori del blocco appena salvato
+        replaced = block(range(24, 29))
+        replaced.prices[0] = 0
+        store.append(replaced)
+        bars = store.tail("GOLD", "DAY")
+        assert list(bars['time']) == sorted(set(bars['time'])) and len(bars) == 28
+        assert list(bars['closeBid'][-6:]) == [23, 0, 25, 26, 27, 28]
+        replaced.prices[0] = 24
+        store.append(replaced)
+        assert not os.path.exists(os.path.join(store.folder("GOLD", "DAY"), 'backward.bars'))
+
+        last, closes = store.last_closes(["GOLD", "SILVER"], "DAY", 30)
+        assert last == ["2024-01-28T00:00:00", None]
+        assert list(closes[0, -3:]) == [26, 27, 28] and np.isnan(closes[0, :2]).all() and np.isnan(closes[1]).all()
+
+        df = to_frame(store.tail("GOLD", "DAY", 5))
+        assert list(df['close']) == [24, 25, 26, 27, 28]
+        assert str(df.index[-1]) == "2024-01-28 00:00:00"
+
+    # Più processi che scrivono nella stessa coppia, con barre che cadono in mezzo allo storico: con il flock nessuna va persa
+    if fcntl is not None:
+        import multiprocessing
+
+        def write(root:str, days:range):
+            store = ColumnStore(root)
+            for day in days:
+                store.append(block([day]))
+
+        with tempfile.TemporaryDirectory() as root:
+            processes = [multiprocessing.get_context('fork').Process(target=write, args=(root, range(start, 32, 3))) for start in (1, 2, 3)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            assert all(process.exitcode == 0 for process in processes)
+            assert list(ColumnStore(root).tail("GOLD", "DAY")['closeBid']) == list(range(1, 32))
+
+    # Cache delle finestre: letta una volta dal database, poi aggiornata dal listener di ingest
+    db = Database("sqlite:///:memory:")
+    db.save_data_array(block(range(1, 26)))
+    cache = BarWindowCache(db, size=10, max_series=2)
+    db.add_ingest_listener(cache.append)
+    assert cache.latest("GOLD", "DAY") == (int(np.datetime64("2024-01-25", 'ms').astype(np.int64)), 25.0)
+    assert list(cache.bars("GOLD", "DAY")['closeBid']) == list(range(16, 26))
+    assert list(cache.frame("GOLD", "DAY", 5)['close']) == [21, 22, 23, 24, 25]
+    assert cache.frame("GOLD", "DAY") is not None and cache.frame("SILVER", "DAY") is None
+
+    db.save_data_array(block(range(24, 28)))
+    assert list(cache.bars("GOLD", "DAY")['closeBid']) == list(range(18, 28)) and cache.latest("GOLD", "DAY")[1] == 27.0
+    assert list(cache.frame("GOLD", "DAY", 2)['close']) == [26, 27]
+    assert cache.stats()["misses"] == 2 and cache.stats()["series"] == 2
+
+    # Oltre max_series esce la serie usata meno di recente
+    cache.frames(["GOLD", "OIL"], "DAY")
+    assert ("SILVER", "DAY") not in cache.windows and cache.stats()["evictions"] == 1
+
+    # Store attivato su un database esistente: letto solo per le serie importate da seed
+    with tempfile.TemporaryDirectory() as root:
+        store = ColumnStore(root)
+        store.append(block(range(28, 30)))  # primo ingest dopo l'attivazione, senza lo storico
+        assert store.count("GOLD", "DAY") == 2 and not store.covers("GOLD", "DAY")
+        assert list(BarWindowCache(db, store, size=5).bars("GOLD", "DAY")['closeBid']) == [23, 24, 25, 26, 27]
+        assert store.seed(db) == 1 and store.seed(db) == 0 and store.covers("GOLD", "DAY")
+        assert list(store.tail("GOLD", "DAY")['closeBid']) == list(range(1, 28))
+        db.add_ingest_listener(store.append)
+        db.save_data_array(block(range(27, 30)))
+        db.ingest_listeners.remove(store.append)
+        assert list(store.tail("GOLD", "DAY")['closeBid']) == list(range(1, 30))
+        assert list(BarWindowCache(db, store, size=3).bars("GOLD", "DAY")['closeBid']) == [27, 28, 29]
+
+    # Barre salvate da un altro processo: viste dopo `ttl` secondi o subito con sync
+    with tempfile.TemporaryDirectory() as folder:
+        url = f"sqlite:///{os.path.join(folder, 'bars.db')}"
+        reader = Database(url)
+        writer = Database(url)
+        writer.save_data_array(block(range(1, 11)))
+        cache = BarWindowCache(reader, size=5, ttl=3600)
+        reader.add_ingest_listener(cache.append)
+        assert cache.latest("GOLD", "DAY")[1] == 10.0
+        writer.save_data_array(block(range(11, 14)))
+        assert cache.latest("GOLD", "DAY")[1] == 10.0
+        cache.sync("GOLD", "DAY", reader.get_newest_date("GOLD", "DAY"))
+        assert list(cache.bars("GOLD", "DAY")['closeBid']) == [9, 10, 11, 12, 13]
+        cache.ttl = 0
+        writer.save_data_array(block(range(14, 16)))
+        assert cache.latest("GOLD", "DAY")[1] == 15.0 and str(cache.frame("GOLD", "DAY").index[-1]) == "2024-01-15 00:00:00"
+        # Più barre nuove della finestra: viene riletta per intero
+        writer.save_data_array(block(range(16, 29)))
+        assert list(cache.bars("GOLD", "DAY")['closeBid']) == [24, 25, 26, 27, 28]
+        assert cache.stats()["refreshes"] == 2 and cache.stats()["reloads"] == 1
+
+        # Un buco dentro la finestra riempito da un altro processo: la finestra viene riletta e la versione cambia
+        def silver(days:list[int]) -> transform.PriceColumns:
+            columns = block(days)
+            columns.epic = "SILVER"
+            return columns
+        reloaded = []
+        cache = BarWindowCache(reader, size=10, ttl=3600)
+        cache.add_reload_listener(lambda *key: reloaded.append(key))
+        writer.save_data_array(silver([1, 2, 3, 4, 6, 7, 8, 9, 10]))
+        assert list(cache.bars("SILVER", "DAY")['closeBid']) == [1, 2, 3, 4, 6, 7, 8, 9, 10]
+        version = cache.version("SILVER", "DAY")
+        writer.save_data_array(silver([5]))
+        cache.sync("SILVER", "DAY", reader.get_newest_date("SILVER", "DAY"))
+        assert list(cache.bars("SILVER", "DAY")['closeBid']) == list(range(1, 11))
+        assert cache.version("SILVER", "DAY") == version + 1 and reloaded == [("SILVER", "DAY")] * 2
+        # Anche insieme a barre nuove, con il controllo dopo `ttl`
+        cache.ttl = 0
+        writer.save_data_array(silver([11, 12, 14]))
+        assert list(cache.bars("SILVER", "DAY")['closeBid']) == [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14][-10:]
+        writer.save_data_array(silver([13, 15]))
+        assert list(cache.bars("SILVER", "DAY")['closeBid']) == list(range(6, 16)) and cache.version("SILVER", "DAY") == version + 2
+        # Senza cambiamenti nessuna rilettura
+        assert list(cache.bars("SILVER", "DAY")['closeBid']) == list(range(6, 16)) and cache.stats()["reloads"] == 2
+        reader.db.close()
+        writer.db.close()
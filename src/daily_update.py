@@ -1,158 +1,218 @@
 import os
 import sys
-import time
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
-import schedule
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Aggiungi il percorso src al PYTHONPATH
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-
-from database import get_connection, get_all_epics
-from downloaders import HistoricalDataDownloader
-from providers import CapitalComProvider
+from database import Database
+from columnar import ColumnStore
+from downloaders import CapitalDownloader
+from backfill import download_interval
+from rollup import RollupEngine, ROLLUP_RESOLUTIONS
 
 # Configurazione logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('daily_update.log'),
+        logging.FileHandler('daily_update.log', delay=True),  # creato solo alla prima riga di log
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+RESOLUTIONS = ['MINUTE', 'MINUTE_5', 'MINUTE_15', 'HOUR', 'DAY']
+
 class DailyDataUpdater:
-    def __init__(self):
-        self.provider = CapitalComProvider()
-        self.downloader = HistoricalDataDownloader(self.provider)
-        self.resolutions = ['MINUTE', 'MINUTE_5', 'MINUTE_15', 'HOUR', 'DAY']
-        
-    def get_yesterday_range(self) -> tuple:
-        """Calcola il range temporale per ieri"""
-        yesterday = datetime.now() - timedelta(days=1)
-        start_time = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_time = yesterday.replace(hour=23, minute=59, second=59, microsecond=999000)
-        
-        return start_time, end_time
-    
-    def should_download_for_resolution(self, resolution: str, epic: str, yesterday: datetime) -> bool:
-        """Determina se scaricare dati per una specifica resolution"""
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Controlla se abbiamo già dati per ieri
-        yesterday_str = yesterday.strftime('%Y-%m-%d')
-        
-        query = """
-        SELECT COUNT(*) FROM historicaldata 
-        WHERE epic = %s AND resolution = %s 
-        AND DATE(timestamp) = %s
+    """
+    Aggiornamento giornaliero dello storico.
+    Gli intervalli mancanti vengono calcolati dall'indice di copertura (Coverage), poi solo quelli
+    vengono scaricati da un pool di worker. I worker condividono il
+    token bucket del CapitalDownloader, quindi il limite di richieste al secondo resta rispettato
+    senza pause fisse fra un download e l'altro.
+    Le resolution in `rollup` non vengono scaricate ma costruite dalle barre MINUTE (che vengono
+    scaricate comunque): con tutte e quattro si passa da sei richieste per epic e giorno a due.
+    """
+    def __init__(self, db: Database, capital: CapitalDownloader, resolutions: list = None, workers: int = 4, rollup: list = None):
+        self.db = db
+        self.capital = capital
+        resolutions = resolutions or RESOLUTIONS
+        rollup = [r for r in resolutions if r in (rollup or [])]
+        self.rollup = RollupEngine(db, rollup) if rollup else None
+        self.resolutions = [r for r in resolutions if not self.rollup or r not in self.rollup.resolutions]
+        if self.rollup and "MINUTE" not in self.resolutions:
+            self.resolutions.insert(0, "MINUTE")
+        self.workers = max(1, workers)
+        # SQLite ammette un solo writer alla volta: i salvataggi vengono serializzati
+        self.save_lock = threading.Lock()
+
+    @staticmethod
+    def get_days(days: int = 1) -> list:
+        """Gli ultimi `days` giorni completi (UTC), escluso oggi, dal più vecchio"""
+        today = datetime.now(timezone.utc).date()
+        return [today - timedelta(days=n) for n in range(days, 0, -1)]
+
+    def plan(self, epics: list, days: list) -> list:
         """
-        
-        cursor.execute(query, (epic, resolution, yesterday_str))
-        count = cursor.fetchone()[0]
-        
-        cursor.close()
-        conn.close()
-        
-        # Se abbiamo già dati per ieri, non scarichiamo di nuovo
-        return count == 0
-    
-    def download_epic_yesterday(self, epic: str, resolution: str) -> bool:
-        """Scarica i dati di ieri per un epic specifico"""
-        try:
-            start_time, end_time = self.get_yesterday_range()
-            
-            # Per DAY resolution, scarica solo se è un giorno lavorativo
-            if resolution == 'DAY':
-                # Lunedì = 0, Domenica = 6
-                if start_time.weekday() >= 5:  # Sabato o Domenica
-                    logger.info(f"⏭️ Saltato {epic} (DAY) - Weekend")
-                    return True
-            
-            # Per HOUR e MINUTE, scarica solo nei giorni lavorativi
-            elif resolution in ['HOUR', 'MINUTE', 'MINUTE_5', 'MINUTE_15']:
-                if start_time.weekday() >= 5:  # Sabato o Domenica
-                    logger.info(f"⏭️ Saltato {epic} ({resolution}) - Weekend")
-                    return True
-            
-            logger.info(f"📊 Scaricando {epic} ({resolution}) per {start_time.strftime('%Y-%m-%d')}")
-            
-            # Scarica i dati
-            success = self.downloader.download_and_store(
-                epic=epic,
-                resolution=resolution,
-                start_time=start_time,
-                end_time=end_time
-            )
-            
-            if success:
-                logger.info(f"✅ Completato {epic} ({resolution})")
-                return True
-            else:
-                logger.warning(f"⚠️ Fallito {epic} ({resolution})")
-                return False
-                
-        except Exception as e:
-            logger.error(f"❌ Errore scaricando {epic} ({resolution}): {str(e)}")
-            return False
-    
-    def run_daily_update(self):
-        """Esegue l'aggiornamento giornaliero completo"""
+        Intervalli (epic, resolution, inizio, fine) da scaricare: le parti dei giorni lavorativi non ancora
+        presenti nell'indice di copertura, divise per giorno. Sabato e domenica vengono saltati.
+        Le barre non vengono lette: buchi lasciati da richieste fallite vengono ritrovati e riscaricati.
+        """
+        weekdays = [day.isoformat() for day in days if day.weekday() < 5]
+        if not weekdays:
+            return []
+
+        self.db.seed_coverage()
+        missing = self.db.get_missing_intervals(epics, self.resolutions, f"{weekdays[0]}T00:00:00", f"{weekdays[-1]}T23:59:59")
+        intervals = []
+        for day in weekdays:
+            day_start, day_end = f"{day}T00:00:00", f"{day}T23:59:59"
+            for (epic, resolution), gaps in missing.items():
+                for start, end in gaps:
+                    if start <= day_end and end >= day_start:
+                        intervals.append((epic, resolution, max(start, day_start), min(end, day_end)))
+        return intervals
+
+    def run_daily_update(self, epics: list = None, days: int = 1) -> dict:
+        """Esegue l'aggiornamento giornaliero completo degli ultimi `days` giorni"""
         start_time = datetime.now()
         logger.info(f"🚀 Inizio aggiornamento giornaliero alle {start_time}")
-        
-        # Ottieni tutti gli epic dal database
-        epics = get_all_epics()
-        logger.info(f"📋 Trovati {len(epics)} epic da processare")
-        
-        yesterday = datetime.now() - timedelta(days=1)
-        
-        total_downloads = 0
-        successful_downloads = 0
-        failed_downloads = 0
-        skipped_downloads = 0
-        
-        for epic in epics:
-            for resolution in self.resolutions:
-                # Controlla se dobbiamo scaricare
-                if not self.should_download_for_resolution(resolution, epic, yesterday):
-                    logger.info(f"⏭️ Saltato {epic} ({resolution}) - Già presente")
-                    skipped_downloads += 1
-                    continue
-                
-                total_downloads += 1
-                
-                # Scarica i dati
-                success = self.download_epic_yesterday(epic, resolution)
-                
-                if success:
-                    successful_downloads += 1
-                else:
-                    failed_downloads += 1
-                
-                # Pausa per evitare rate limiting
-                time.sleep(2)
-        
-        end_time = datetime.now()
-        duration = end_time - start_time
-        
+
+        epics = epics or self.db.get_all_epics()
+        day_list = self.get_days(days)
+        logger.info(f"📋 Trovati {len(epics)} epic da processare per {len(day_list)} giorni")
+
+        intervals = self.plan(epics, day_list)
+        total_cells = len(epics) * len(self.resolutions) * len(day_list)
+        missing_cells = len({(epic, resolution, start[:10]) for epic, resolution, start, _ in intervals})
+        stats = {"total": len(intervals), "successful": 0, "failed": 0, "skipped": total_cells - missing_cells, "bars": 0}
+        logger.info(f"🗺️ {len(intervals)} intervalli mancanti in {missing_cells} celle (epic, resolution, giorno) su {total_cells}")
+
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="daily")
+        try:
+            with self.db.bulk_ingest(report=False):
+                futures = {executor.submit(download_interval, self.db, self.capital, self.save_lock, *interval): interval for interval in intervals}
+                for future in as_completed(futures):
+                    epic, resolution, start, end = futures[future]
+                    try:
+                        bars = future.result()
+                    except Exception as e:
+                        logger.error(f"❌ Errore scaricando {epic} ({resolution}) da {start} a {end}: {str(e)}")
+                        stats["failed"] += 1
+                        continue
+                    stats["successful"] += 1
+                    stats["bars"] += bars
+                    logger.info(f"✅ Completato {epic} ({resolution}) da {start} a {end}: {bars} barre")
+        finally:
+            # In caso di errore o Ctrl+C non vengono avviati altri download
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.rollup and day_list:
+            stats["rollup"] = self.rollup.fill(epics, f"{day_list[0].isoformat()}T00:00:00", f"{day_list[-1].isoformat()}T23:59:59")
+            logger.info(f"🧮 Costruite {stats['rollup']} barre {', '.join(self.rollup.resolutions)} dalle barre MINUTE")
+
+        duration = datetime.now() - start_time
+
         # Report finale
         logger.info(f"🏁 Aggiornamento completato in {duration}")
         logger.info(f"📊 Statistiche:")
-        logger.info(f"   - Totale processati: {total_downloads}")
-        logger.info(f"   - Successi: {successful_downloads}")
-        logger.info(f"   - Fallimenti: {failed_downloads}")
-        logger.info(f"   - Saltati: {skipped_downloads}")
+        logger.info(f"   - Totale processati: {stats['total']}")
+        logger.info(f"   - Successi: {stats['successful']}")
+        logger.info(f"   - Fallimenti: {stats['failed']}")
+        logger.info(f"   - Saltati: {stats['skipped']}")
+        logger.info(f"   - Barre salvate: {stats['bars']}")
+        return stats
 
-def run_scheduled_update():
+def run_scheduled_update(epics: list = None, resolutions: list = None, days: int = 1, workers: int = 4, rollup: list = None):
     """Funzione chiamata dal cron job"""
-    updater = DailyDataUpdater()
-    updater.run_daily_update()
+    db = Database(os.getenv("APP_DB_URL"), pool_size=workers if workers > 1 else None, archive=os.getenv("APP_ARCHIVE"))
+    if os.getenv("APP_COLUMN_STORE"):
+        # Come app.py: lo store resta allineato anche con le barre del daily update
+        column_store = ColumnStore(os.getenv("APP_COLUMN_STORE"))
+        with db.connection():
+            column_store.seed(db)
+        db.add_ingest_listener(column_store.append)
+    capital = CapitalDownloader(db, os.getenv("CAPITAL_APIKEY"))
+    capital.start_new_session(os.getenv("CAPITAL_EMAIL"), os.getenv("CAPITAL_PASSWORD"))
+    updater = DailyDataUpdater(db, capital, resolutions, workers, rollup)
+    return updater.run_daily_update(epics, days)
+
+def self_test():
+    """Pianificazione e aggiornamento con un downloader finto: buchi divisi per giorno, weekend saltati, celle già coperte contate"""
+    import tempfile
+    import pandas as pd
+    from datetime import date
+    from transform import columns_from_rows, from_capital_prices
+
+    class FakeCapital:
+        """Restituisce una barra HOUR per ogni ora della finestra richiesta; fallisce per gli epic in `failing`"""
+        def __init__(self, failing: set):
+            self.failing = failing
+            self.requests = []
+
+        def download_historical_data(self, epic: str, resolution: str, from_date: str, to_date: str):
+            self.requests.append((epic, resolution, from_date, to_date))
+            if epic in self.failing:
+                raise RuntimeError("download fallito")
+            hours = pd.date_range(from_date, to_date, freq="h").strftime("%Y-%m-%dT%H:%M:%S")
+            rows = [(epic, resolution, hour, *[1.0] * 8, 1) for hour in hours]
+            return columns_from_rows(rows)[0] if rows else from_capital_prices(epic, resolution, [])
+
+    logging.disable(logging.CRITICAL)
+    days = [date(2024, 1, 5), date(2024, 1, 6), date(2024, 1, 7), date(2024, 1, 8)]  # da venerdì a lunedì
+    with tempfile.TemporaryDirectory() as folder:
+        db = Database(f"sqlite:///{os.path.join(folder, 'bars.db')}")
+        # GOLD ha già la mattina di venerdì e tutto lunedì
+        db.save_window("GOLD", "HOUR", "2024-01-05T00:00:00", "2024-01-05T11:59:59")
+        db.save_window("GOLD", "HOUR", "2024-01-08T00:00:00", "2024-01-08T23:59:59")
+        capital = FakeCapital(failing={"OIL"})
+        updater = DailyDataUpdater(db, capital, ["HOUR"], workers=2)
+        updater.get_days = lambda days_back: days
+
+        # Il buco di SILVER da venerdì a lunedì diventa un intervallo per giorno lavorativo
+        assert updater.plan(["GOLD", "SILVER"], days) == [
+            ("GOLD", "HOUR", "2024-01-05T12:00:00", "2024-01-05T23:59:59"),
+            ("SILVER", "HOUR", "2024-01-05T00:00:00", "2024-01-05T23:59:59"),
+            ("SILVER", "HOUR", "2024-01-08T00:00:00", "2024-01-08T23:59:59")
+        ]
+        assert updater.plan(["GOLD"], days[1:3]) == []
+
+        stats = updater.run_daily_update(["GOLD", "SILVER", "OIL"], len(days))
+        # 3 epic x 4 giorni: 5 celle mancanti, le altre (weekend e lunedì di GOLD) saltate
+        assert stats == {"total": 5, "successful": 3, "failed": 2, "skipped": 7, "bars": 12 + 24 + 24}
+        assert len(capital.requests) == 5 and not any(request[2].startswith(("2024-01-06", "2024-01-07")) for request in capital.requests)
+        assert len(db.get_bars("SILVER", "HOUR")) == 48 and db.get_bars("OIL", "HOUR") == []
+
+        # Il giro successivo riprova solo i download falliti
+        capital.failing.clear()
+        assert updater.run_daily_update(["GOLD", "SILVER", "OIL"], len(days)) == {"total": 2, "successful": 2, "failed": 0, "skipped": 10, "bars": 48}
+        db.db.close()
+    logging.disable(logging.NOTSET)
 
 if __name__ == "__main__":
-    # Esecuzione diretta per test
-    run_scheduled_update()
\ No newline at end of file
+    from dotenv import load_dotenv
+
+    arg = argparse.ArgumentParser(description="Scarica le barre mancanti degli ultimi giorni")
+    arg.add_argument("-e", "--epics", help="Epic da aggiornare, lasciare vuoto per tutti", nargs="*")
+    arg.add_argument("-t", "--timeframe", help="Timeframe da aggiornare", nargs="*", choices=RESOLUTIONS, default=RESOLUTIONS)
+    arg.add_argument("-d", "--days", help="Giorni da controllare a ritroso, escluso oggi", type=int, default=1)
+    arg.add_argument("-r", "--rollup", help="Timeframe da costruire dalle barre MINUTE invece di scaricarli", nargs="*", choices=ROLLUP_RESOLUTIONS, default=[])
+    arg.add_argument("-w", "--workers", help="Download in parallelo (condividono il limite di richieste)", type=int, default=4)
+    arg.add_argument("--self-test", help="Esegue il test con un downloader finto, senza database né .env", action="store_true")
+    arguments = arg.parse_args()
+
+    if arguments.self_test:
+        self_test()
+        sys.exit(0)
+
+    if not os.getenv("APP_TRADING_BOT") and not load_dotenv():
+        print("❌\tFile .env non trovato.\nCopia il file .env.example in .env e imposta le variabili d'ambiente.")
+        exit(1)
+
+    try:
+        run_scheduled_update(arguments.epics, arguments.timeframe, arguments.days, arguments.workers, arguments.rollup)
+    except KeyboardInterrupt:
+        print("\n❌ Operazione annullata dall'utente.")
+        sys.exit(1)
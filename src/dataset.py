@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from numpy.lib.format import open_memmap
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import transform
+from database import Database, to_epoch
+from streaming_indicators import RSIState, BollingerState, MACDState
+
+# Parquet è opzionale: senza pyarrow i dataset si scrivono solo in .npy
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Il sentiment delle notizie è opzionale: senza textblob la colonna vale 0
+try:
+    from textblob import TextBlob
+except ImportError:
+    TextBlob = None
+
+# Colonne della matrice delle feature, nell'ordine. I livelli di prezzo (bande, pivot) sono
+# relativi alla chiusura e il MACD è diviso per la chiusura, così epic con prezzi diversi sono confrontabili
+FEATURES = (
+    "return",           # rendimento logaritmico della chiusura bid
+    "rsi",              # RSI / 100
+    "bb_upper", "bb_middle", "bb_lower",
+    "macd", "macd_signal", "macd_histogram",
+    "spread",           # (ask - bid) / bid sulla chiusura
+    "support", "resistance",
+    "volume",           # log(1 + lastTradedVolume)
+    "sentiment"         # polarità media delle notizie delle ultime SENTIMENT_WINDOW ore
+)
+FORMATS = ("npy", "parquet")
+SENTIMENT_WINDOW = 24
+
+
+
+def news_sentiment(db:Database, since:str=None, until:str=None, chunk:int=10_000) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Polarità (da -1 a 1) di titolo e descrizione di ogni notizia, con il tempo di pubblicazione
+    in secondi epoch, in ordine di tempo. Vuoti se textblob non è installato.
+    '''
+    times, scores = [], []
+    if TextBlob is None:
+        print("⚠️ textblob non installato: il sentiment delle notizie vale 0")
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    after = None
+    while rows := db.get_news(after=after, limit=chunk, since=since, until=until):
+        published = pd.to_datetime([row[0] for row in rows], utc=True, errors='coerce')
+        for when, row in zip(published, rows):
+            if not pd.isna(when):
+                times.append(when.value // 10**9)
+                scores.append(TextBlob(f"{row[3] or ''}. {row[4] or ''}").sentiment.polarity)
+        after = rows[-1][:2]
+
+    order = np.argsort(times, kind='stable')
+    return np.asarray(times, dtype=np.int64)[order], np.asarray(scores, dtype=np.float64)[order]
+
+def sentiment_at(times:np.ndarray, news_times:np.ndarray, news_scores:np.ndarray, hours:int=SENTIMENT_WINDOW) -> np.ndarray:
+    '''Per ogni tempo la polarità media delle notizie pubblicate nelle `hours` ore precedenti, 0 se non ce ne sono'''
+    if not len(news_times):
+        return np.zeros(len(times))
+    cumulative = np.concatenate([[0.0], np.cumsum(news_scores)])
+    end = np.searchsorted(news_times, times, side='right')
+    start = np.searchsorted(news_times, times - hours * 3600, side='right')
+    count = end - start
+    return np.divide(cumulative[end] - cumulative[start], count, out=np.zeros(len(times)), where=count > 0)
+
+
+
+class FeatureBuilder:
+    '''
+    Feature di una serie calcolate a blocchi di barre consecutive. Gli indicatori usano gli stati
+    incrementali di streaming_indicators, quindi coincidono con TechnicalIndicators (talib) calcolato
+    sull'intera serie, e tra un blocco e il successivo si conserva solo l'ultima barra.
+    '''
+
+    def __init__(self, news_times:np.ndarray, news_scores:np.ndarray):
+        self.rsi = RSIState(14)
+        self.bollinger = BollingerState(20, 2)
+        self.macd = MACDState(12, 26, 9)
+        self.news_times = news_times
+        self.news_scores = news_scores
+        self.previous = None # ultima barra del blocco precedente (high, low, close)
+
+    def update(self, rows:list[tuple]) -> tuple[np.ndarray, np.ndarray]:
+        '''Tempi in secondi epoch e matrice (barre, FEATURES) float32 di un blocco di righe nel formato di HistoricalData'''
+        columns = transform.columns_from_rows(rows)[0]
+        bid = pd.DataFrame({
+            'high': columns.column('highBid'),
+            'low': columns.column('lowBid'),
+            'close': columns.column('closeBid')
+        })
+        ask = columns.column('closeAsk')
+        times = to_epoch(columns.times)
+
+        # Il pivot di una barra usa quella precedente, anche se sta nel blocco prima
+        previous, self.previous = self.previous, bid.iloc[-1].to_list()
+        if previous is not None:
+            bid = pd.concat([pd.DataFrame([previous], columns=bid.columns), bid], ignore_index=True)
+        pivots = transform.calculate_pivot_points(bid)
+        closes = pivots['close'].to_numpy()
+        if previous is not None:
+            returns = np.diff(np.log(closes))
+            pivots, closes = pivots.iloc[1:], closes[1:]
+        else:
+            returns = np.concatenate([[np.nan], np.diff(np.log(closes))])
+
+        indicators = np.array([(self.rsi.update(c), *self.bollinger.update(c), *self.macd.update(c)) for c in closes]).reshape(-1, 7)
+
+        features = np.empty((len(closes), len(FEATURES)), dtype=np.float32)
+        features[:, 0] = returns
+        features[:, 1] = indicators[:, 0] / 100
+        features[:, 2:5] = indicators[:, 1:4] / closes[:, None] - 1
+        features[:, 5:8] = indicators[:, 4:7] / closes[:, None]
+        features[:, 8] = (ask - closes) / closes
+        features[:, 9] = pivots['support'].to_numpy() / closes - 1
+        features[:, 10] = pivots['resistance'].to_numpy() / closes - 1
+        features[:, 11] = np.log1p(columns.volume)
+        features[:, 12] = sentiment_at(times, self.news_times, self.news_scores)
+        return times, features
+
+
+
+class ShardWriter:
+    '''
+    Scrive le finestre di una serie in shard di al più `shard_size` finestre, senza tenerle in memoria:
+    - npy: X-NNNNN.npy (finestre, window, FEATURES) float32, y-NNNNN.npy (rendimento della barra
+      successiva) e t-NNNNN.npy (tempo dell'ultima barra della finestra) scritti in memory-map
+    - parquet: NNNNN.parquet con le colonne time, target e features (lista fissa di window * FEATURES valori)
+    '''
+
+    def __init__(self, folder:str, window:int, format:str="npy", shard_size:int=50_000):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown dataset format: {format}")
+        if format == "parquet" and pq is None:
+            raise RuntimeError("pyarrow non installato: usa il formato npy")
+        self.folder = folder
+        self.window = window
+        self.format = format
+        self.shard_size = shard_size
+        self.shards = []
+        self.windows = 0
+        self.current = None # (X, y, t) in memory-map oppure ParquetWriter
+        self.used = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, prefix:str, index:int, extension:str) -> str:
+        return os.path.join(self.folder, f"{prefix}{index:05d}.{extension}")
+
+    def _open(self):
+        index = len(self.shards)
+        if self.format == "npy":
+            shape = (self.shard_size, self.window, len(FEATURES))
+            self.current = (
+                open_memmap(self._path("X-", index, "npy"), mode='w+', dtype=np.float32, shape=shape),
+                open_memmap(self._path("y-", index, "npy"), mode='w+', dtype=np.float32, shape=(self.shard_size,)),
+                open_memmap(self._path("t-", index, "npy"), mode='w+', dtype=np.int64, shape=(self.shard_size,))
+            )
+        else:
+            self.current = pq.ParquetWriter(self._path("", index, "parquet"), self.schema())
+        self.shards.append(index)
+        self.used = 0
+
+    def schema(self):
+        return pa.schema([
+            ("time", pa.timestamp("s", tz="UTC")),
+            ("target", pa.float32()),
+            ("features", pa.list_(pa.float32(), self.window * len(FEATURES)))
+        ], metadata={"window": str(self.window), "features": ",".join(FEATURES)})
+
+    def write(self, X:np.ndarray, y:np.ndarray, t:np.ndarray):
+        '''Aggiunge finestre (n, window, FEATURES), target (n,) e tempi (n,); X può essere una vista senza copie'''
+        done = 0
+        while done < len(X):
+            if self.current is None:
+                self._open()
+            count = min(len(X) - done, self.shard_size - self.used)
+            block = slice(done, done + count)
+            if self.format == "npy":
+                self.current[0][self.used:self.used + count] = X[block]
+                self.current[1][self.used:self.used + count] = y[block]
+                self.current[2][self.used:self.used + count] = t[block]
+            else:
+                flat = np.ascontiguousarray(X[block], dtype=np.float32).reshape(-1)
+                self.current.write_table(pa.table([
+                    pa.array(t[block].astype('datetime64[s]'), pa.timestamp("s", tz="UTC")),
+                    pa.array(y[block], pa.float32()),
+                    pa.FixedSizeListArray.from_arrays(pa.array(flat), self.window * len(FEATURES))
+                ], schema=self.schema()))
+            self.used += count
+            self.windows += count
+            done += count
+            if self.used == self.shard_size:
+                self._close()
+
+    def _close(self):
+        if self.format == "parquet":
+            self.current.close()
+        else:
+            for array in self.current:
+                array.flush()
+            if self.used < self.shard_size:
+                self._truncate()
+        self.current = None
+
+    def _truncate(self):
+        '''L'ultimo shard .npy viene riscritto con il numero reale di finestre'''
+        index = self.shards[-1]
+        for array, prefix in zip(self.current, ("X-", "y-", "t-")):
+            path = self._path(prefix, index, "npy")
+            final = open_memmap(path + ".tmp", mode='w+', dtype=array.dtype, shape=(self.used, *array.shape[1:]))
+            final[:] = array[:self.used]
+            final.flush()
+            del final
+            os.replace(path + ".tmp", path)
+
+    def close(self):
+        if self.current is not None:
+            self._close()
+
+
+
+# ======= Worker =======
+# Le notizie valutate vengono passate una sola volta a ogni processo, che apre la propria connessione
+_db_URL = None
+_archive = None
+_news = None
+
+def _attach(db_URL:str, archive:str, news_times:np.ndarray, news_scores:np.ndarray):
+    global _db_URL, _archive, _news
+    _db_URL = db_URL
+    _archive = archive
+    _news = (news_times, news_scores)
+
+def _runs(mask:np.ndarray) -> list[tuple[int, int]]:
+    '''Intervalli [start, end) di valori True consecutivi, per scrivere le finestre valide come viste senza copie'''
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+def build_series(epic:str, resolution:str, folder:str, window:int, format:str="npy", since:str=None, until:str=None,
+                 chunk:int=100_000, shard_size:int=50_000) -> dict:
+    '''
+    Scrive le finestre di una serie: una finestra per barra con le `window` righe di feature che terminano
+    lì e come target il rendimento della barra successiva. Le barre sono lette a blocchi di `chunk`,
+    quindi la memoria usata non dipende dalla lunghezza della serie. Le finestre con valori non
+    validi (le barre iniziali, prima che gli indicatori siano definiti) vengono scartate.
+    '''
+    db = Database(_db_URL, archive=_archive)
+    builder = FeatureBuilder(*_news)
+    writer = ShardWriter(folder, window, format, shard_size)
+    times, features = np.empty(0, dtype=np.int64), np.empty((0, len(FEATURES)), dtype=np.float32)
+
+    after = None
+    try:
+        while rows := db.get_bars(epic, resolution, after=after, limit=chunk, since=since, until=until):
+            after = rows[-1][2]
+            new_times, new_features = builder.update(rows)
+            times = np.concatenate([times, new_times])
+            features = np.concatenate([features, new_features])
+            if len(features) > window:
+                X = sliding_window_view(features[:-1], window, axis=0).transpose(0, 2, 1)
+                y, t = features[window:, 0], times[window - 1:-1]
+                valid = np.isfinite(features).all(axis=1)
+                complete = sliding_window_view(valid[:-1], window).all(axis=1) & valid[window:]
+                for start, end in _runs(complete):
+                    writer.write(X[start:end], y[start:end], t[start:end])
+            # L'ultima finestra aspetta la barra successiva per il target
+            times, features = times[-window:], features[-window:]
+    finally:
+        writer.close()
+        db.db.close()
+
+    return {"epic": epic, "resolution": resolution, "windows": writer.windows, "shards": len(writer.shards)}
+
+
+
+def build_dataset(db_URL:str, output:str, pairs:list[tuple[str, str]], window:int, format:str="npy", since:str=None,
+                  until:str=None, workers:int=None, chunk:int=100_000, shard_size:int=50_000, archive:str=None) -> dict:
+    '''
+    Costruisce il dataset di più serie (epic, resolution), una per processo, in output/<resolution>/<epic>,
+    e scrive il manifest output/dataset.json. Restituisce il manifest.
+    Con `archive` vengono lette anche le barre archiviate (vedi archive.Archive).
+    '''
+    db = Database(db_URL, archive=archive)
+    news_times, news_scores = news_sentiment(db, until=until)
+    db.db.close()
+
+    manifest = {"window": window, "format": format, "features": list(FEATURES), "target": "return", "since": since, "until": until, "series": []}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_attach, initargs=(db_URL, archive, news_times, news_scores)) as executor:
+        futures = {}
+        for epic, resolution in pairs:
+            folder = os.path.join(output, resolution, epic.replace(os.sep, "_"))
+            futures[executor.submit(build_series, epic, resolution, folder, window, format, since, until, chunk, shard_size)] = folder
+        for future in as_completed(futures):
+            series = future.result()
+            series["folder"] = os.path.relpath(futures[future], output)
+            manifest["series"].append(series)
+            print(f"\t📊 {series['epic']}:{series['resolution']} {series['windows']} finestre in {series['shards']} shard")
+
+    manifest["series"].sort(key=lambda series: (series["epic"], series["resolution"]))
+    with open(os.path.join(output, "dataset.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+def load_shards(output:str):
+    '''Shard .npy di un dataset come (X, y, t) in memory-map, per l'addestramento senza caricare tutto in RAM'''
+    with open(os.path.join(output, "dataset.json")) as file:
+        manifest = json.load(file)
+    for series in manifest["series"]:
+        folder = os.path.join(output, series["folder"])
+        for index in range(series["shards"]):
+            yield tuple(np.load(os.path.join(folder, f"{prefix}{index:05d}.npy"), mmap_mode='r') for prefix in ("X-", "y-", "t-"))
+
+def self_test():
+    '''Dataset di un database SQLite temporaneo: allineamento finestre/target, blocchi e shard, formato parquet'''
+    import io
+    import glob
+    import tempfile
+    from contextlib import redirect_stdout
+
+    # Sentiment: media delle notizie nelle ore precedenti, 0 senza notizie
+    assert list(sentiment_at(np.array([0, 7200, 100_000]), np.array([3600, 7200]), np.array([0.5, -1.0]))) == [0.0, -0.25, 0.0]
+
+    rng = np.random.default_rng(7)
+    closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, 300)))
+    times = pd.date_range("2024-01-01", periods=len(closes), freq="h").strftime("%Y-%m-%dT%H:%M:%S")
+    rows = [("GOLD", "HOUR", time, c, c + 0.1, c * 1.01, c * 1.01 + 0.1, c * 0.99, c * 0.99 + 0.1, c, c + 0.1, i + 1)
+            for i, (time, c) in enumerate(zip(times, closes))]
+    window = 16
+
+    def read(folder:str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        shards = sorted(glob.glob(os.path.join(folder, "X-*.npy")))
+        return tuple(np.concatenate([np.load(path.replace("X-", prefix)) for path in shards]) for prefix in ("X-", "y-", "t-"))
+
+    with tempfile.TemporaryDirectory() as root:
+        url = f"sqlite:///{os.path.join(root, 'bars.db')}"
+        db = Database(url)
+        db.save_data_array(rows)
+        db.save_data_array([("SILVER", "HOUR", *row[2:]) for row in rows[:100]])
+        db.db.close()
+        _attach(url, None, np.empty(0, dtype=np.int64), np.empty(0))
+
+        # Finestre e target: la finestra i termina alla barra t[i], il target è il rendimento della barra successiva
+        series = build_series("GOLD", "HOUR", os.path.join(root, "whole"), window, chunk=1000, shard_size=1000)
+        X, y, t = read(os.path.join(root, "whole"))
+        bar_times, features = FeatureBuilder(np.empty(0, dtype=np.int64), np.empty(0)).update(rows)
+        assert series["windows"] == len(X) == len(y) == len(t) > 200 and X.shape[1:] == (window, len(FEATURES))
+        for i in (0, len(X) // 2, len(X) - 1):
+            end = int(np.searchsorted(bar_times, t[i]))
+            assert np.array_equal(X[i], features[end - window + 1:end + 1]) and y[i] == features[end + 1, 0]
+            assert np.isclose(y[i], np.log(closes[end + 1] / closes[end]), atol=1e-6)
+        assert t[-1] == bar_times[-2] and np.isfinite(X).all() and not np.isfinite(features[:window]).all()
+
+        # A blocchi piccoli e in shard piccoli: stesse finestre, l'ultimo shard troncato alle finestre scritte
+        series = build_series("GOLD", "HOUR", os.path.join(root, "chunked"), window, chunk=37, shard_size=50)
+        chunked = read(os.path.join(root, "chunked"))
+        assert all(np.array_equal(a, b) for a, b in zip((X, y, t), chunked))
+        assert series["shards"] == -(-len(X) // 50)
+        last = [np.load(os.path.join(root, "chunked", f"{prefix}{series['shards'] - 1:05d}.npy")) for prefix in ("X-", "y-", "t-")]
+        assert all(len(array) == len(X) - 50 * (series["shards"] - 1) for array in last)
+        assert not glob.glob(os.path.join(root, "chunked", "*.tmp"))
+
+        # Parquet: stesse finestre con tempi, target e feature appiattite
+        if pq is not None:
+            build_series("GOLD", "HOUR", os.path.join(root, "parquet"), window, "parquet", chunk=37, shard_size=50)
+            table = pa.concat_tables([pq.read_table(path) for path in sorted(glob.glob(os.path.join(root, "parquet", "*.parquet")))])
+            assert table.schema.metadata[b"window"] == str(window).encode()
+            # Parquet salva i timestamp almeno in millisecondi
+            assert np.array_equal(table["time"].cast(pa.timestamp("s", tz="UTC")).cast(pa.int64()).to_numpy(), t) and np.array_equal(table["target"].to_numpy(), y)
+            assert np.array_equal(np.stack(table["features"].to_numpy(zero_copy_only=False)).reshape(X.shape), X)
+
+        # Più serie in processi separati, con il manifest e load_shards
+        with redirect_stdout(io.StringIO()):
+            manifest = build_dataset(url, os.path.join(root, "dataset"), [("GOLD", "HOUR"), ("SILVER", "HOUR")], window, workers=2, shard_size=50)
+        first = int(np.argmax(np.isfinite(features).all(axis=1)))  # prima barra con tutti gli indicatori definiti
+        assert [(series["epic"], series["windows"]) for series in manifest["series"]] == [("GOLD", len(X)), ("SILVER", 100 - first - window)]
+        shards = list(load_shards(os.path.join(root, "dataset")))
+        assert np.array_equal(np.concatenate([shard[0] for shard in shards[:manifest["series"][0]["shards"]]]), X)
+
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    arg = argparse.ArgumentParser(description="Costruisce un dataset di finestre di feature dallo storico salvato")
+    arg.add_argument("-o", "--output", help="Cartella del dataset", default="dataset")
+    arg.add_argument("-e", "--epics", help="Epic da includere, lasciare vuoto per tutti", nargs="*")
+    arg.add_argument("-t", "--timeframes", help="Timeframe da includere, lasciare vuoto per tutti", nargs="*")
+    arg.add_argument("-n", "--window", help="Barre per finestra", type=int, default=64)
+    arg.add_argument("-f", "--format", help="Formato degli shard", choices=FORMATS, default="npy")
+    arg.add_argument("-s", "--since", help="Data iniziale (ISO)", default=None)
+    arg.add_argument("-u", "--until", help="Data finale (ISO)", default=None)
+    arg.add_argument("-w", "--workers", help="Processi del pool, di default uno per core", type=int, default=None)
+    arg.add_argument("--shard-size", help="Finestre per shard", type=int, default=50_000)
+    arg.add_argument("--self-test", help="Esegue il test su un database SQLite temporaneo, senza .env", action="store_true")
+    arguments = arg.parse_args()
+
+    if arguments.self_test:
+        self_test()
+        sys.exit(0)
+
+    if not os.getenv("APP_TRADING_BOT") and not load_dotenv():
+        print("❌\tFile .env non trovato.\nCopia il file .env.example in .env e imposta le variabili d'ambiente.")
+        exit(1)
+
+    db_URL = os.getenv("APP_DB_URL")
+    archive = os.getenv("APP_ARCHIVE")
+    database = Database(db_URL, archive=archive)
+    pairs = database.get_series(arguments.timeframes)
+    if arguments.epics:
+        pairs = [pair for pair in pairs if pair[0] in set(arguments.epics)]
+    database.db.close()
+
+    print(f"⏳ Dataset di {len(pairs)} serie, finestre di {arguments.window} barre...")
+    start = time.time()
+    try:
+        manifest = build_dataset(db_URL, arguments.output, pairs, arguments.window, arguments.format, arguments.since,
+                                 arguments.until, arguments.workers, shard_size=arguments.shard_size, archive=archive)
+    except KeyboardInterrupt:
+        print("\n❌ Operazione annullata dall'utente.")
+        sys.exit(1)
+
+    total = sum(series["windows"] for series in manifest["series"])
+    print(f"✅ {total} finestre salvate in {arguments.output} ({time.time() - start:.1f}s)")
@@ -1,24 +1,30 @@
 import json
-import time
 import requests
 import transform
 
 from database import Database
+from ratelimit import TokenBucket
 
 
 class Downloader:
     baseURL:str
     session: requests.Session
     database:Database
-    last_request:float
     rate_limit_per_second: int
-
-    def __init__(self, baseURL:str, database:Database=None, rate_limit_per_second:int = 10):
+    rate_limiter:TokenBucket
+    max_retries:int
+
+    def __init__(self, baseURL:str, database:Database=None, rate_limit_per_second:int = 10, burst:int=None, rate_limiter:TokenBucket=None, max_retries:int=5):
+        '''
+        Il limite di richieste è un token bucket condiviso da tutti i thread che usano il downloader.
+        Per condividere lo stesso budget fra più downloader passare la stessa istanza in `rate_limiter`.
+        '''
         self.baseURL = baseURL
         self.session = requests.Session()
         self.database = database
-        self.last_request = 0.0
         self.rate_limit_per_second = rate_limit_per_second
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate_limit_per_second, burst)
+        self.max_retries = max_retries
 
         assert self.database is not None, "Database non specificato!"
         assert self.baseURL is not None, "URL non specificato!"
@@ -27,19 +33,26 @@ class Downloader:
         self.session.headers[name] = value
 
     def get(self, url:str) -> requests.Response:
-        return self.request("GET", url, maxSecWait=(1 / self.rate_limit_per_second))
+        return self.request("GET", url)
 
     def post(self, url:str, data:dict) -> requests.Response:
-        return self.request("POST", url, data, maxSecWait=(1 / self.rate_limit_per_second))
-
-    def request(self, method:str, url:str, data:dict=None, maxSecWait:float=0.0) -> requests.Response:
-        elapsed = time.time() - self.last_request
-        if elapsed < maxSecWait:
-            time.sleep(maxSecWait - elapsed)
+        return self.request("POST", url, data)
 
+    def request(self, method:str, url:str, data:dict=None) -> requests.Response:
         data = json.dumps(data) if data is not None else None
-        response = self.session.request(method, self.baseURL + url, data=data)
-        self.last_request = time.time()
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            response = self.session.request(method, self.baseURL + url, data=data)
+            if response.status_code != 429:
+                self.rate_limiter.success()
+                break
+            if attempt == self.max_retries:
+                break
+
+            delay = self.rate_limiter.throttle(response.headers.get("Retry-After"), attempt)
+            self.rate_limiter.retry()
+            print(f"⚠️ Troppe richieste. Nuovo tentativo per '{url}' tra {delay:.1f} secondi...")
 
         match response.status_code:
             case 200:
@@ -56,7 +69,9 @@ class CapitalDownloader(Downloader):
     '''Downloader per dati storici di https://open-api.capital.com/'''
 
     def __init__(self, database:Database, api_key:str):
-        super().__init__("https://api-capital.backend-capital.com/api/v1/", database, rate_limit_per_second=8)
+        # Capital.com accetta al massimo 10 richieste al secondo per utente: in un secondo qualsiasi
+        # il bucket concede al più burst + rate richieste, quindi 2 + 8
+        super().__init__("https://api-capital.backend-capital.com/api/v1/", database, rate_limit_per_second=8, burst=2)
         self.header("Content-Type", "application/json")
         self.header("X-CAP-API-KEY", api_key)
 
@@ -66,89 +81,24 @@ class CapitalDownloader(Downloader):
         self.header("CST", head.get("CST"))
         self.header("X-SECURITY-TOKEN", head.get("X-SECURITY-TOKEN"))
 
-    def download_historical_data(self, epic:str, resolution:str, from_date:str, to_date:str, max_bars:int=1000):
-        relative_url = f"prices/{epic}?resolution={resolution}&from={from_date}&to={to_date}"
+    def download_historical_data(self, epic:str, resolution:str, from_date:str, to_date:str, max_bars:int=1000) -> transform.PriceColumns:
+        '''Scarica le barre di una finestra in formato colonnare, vuoto se il server non ha dati'''
+        relative_url = f"prices/{epic}?resolution={resolution}&max={max_bars}&from={from_date}&to={to_date}"
         
         try:
-            # Usa il metodo get() della classe base che ora gestisce gli errori
+            # Il metodo get() della classe base ripete già le richieste rifiutate con 429
             response = self.get(relative_url)
         except Exception as e:
-            # Gestisce specificamente l'errore di rate-limiting (429) per riprovare
-            if "429" in str(e):
-                print("⚠️ Troppe richieste. Attendo 20 secondi...")
-                time.sleep(20)
-                return self.download_historical_data(epic, resolution, from_date, to_date)
-            else:
-                # Per tutti gli altri errori (incluso il 500), solleva di nuovo l'eccezione per fermare lo script.
-                print(f"❌ Errore critico durante il download dei dati storici per {epic}.")
-                raise e
+            # Per tutti gli altri errori (incluso il 500), solleva di nuovo l'eccezione per fermare lo script.
+            print(f"❌ Errore critico durante il download dei dati storici per {epic}.")
+            raise e
 
         # Se la risposta è None (es. 404), significa che non ci sono dati.
         if response is None:
-            return []
+            return transform.from_capital_prices(epic, resolution, [])
 
         prices = response.json().get('prices', [])
-        if not prices:
-            return []
-
-        # Trasformazione dei dati per allinearli al modello del database
-        data = []
-        for p in prices:
-            # Salta i record incompleti che potrebbero essere restituiti dall'API
-            if p.get('openPrice') is None or p.get('closePrice') is None or p.get('highPrice') is None or p.get('lowPrice') is None:
-                continue
-
-            # Gestisce i due possibili formati di prezzo (dizionario bid/ask o singolo valore)
-            open_price = p['openPrice']
-            close_price = p['closePrice']
-            high_price = p['highPrice']
-            low_price = p['lowPrice']
-
-            if isinstance(open_price, dict):
-                open_bid = open_price.get('bid')
-                open_ask = open_price.get('ask')
-                if open_bid is None and open_ask is not None: open_bid = open_ask
-                if open_ask is None and open_bid is not None: open_ask = open_bid
-
-                close_bid = close_price.get('bid')
-                close_ask = close_price.get('ask')
-                if close_bid is None and close_ask is not None: close_bid = close_ask
-                if close_ask is None and close_bid is not None: close_ask = close_bid
-
-                high_bid = high_price.get('bid')
-                high_ask = high_price.get('ask')
-                if high_bid is None and high_ask is not None: high_bid = high_ask
-                if high_ask is None and high_bid is not None: high_ask = high_bid
-
-                low_bid = low_price.get('bid')
-                low_ask = low_price.get('ask')
-                if low_bid is None and low_ask is not None: low_bid = low_ask
-                if low_ask is None and low_bid is not None: low_ask = low_bid
-
-                # Se dopo la correzione uno dei valori è ancora None (es. dict vuoto), il record non è valido.
-                if open_bid is None or close_bid is None or high_bid is None or low_bid is None:
-                    continue
-            else:
-                open_bid = open_ask = open_price
-                close_bid = close_ask = close_price
-                high_bid = high_ask = high_price
-                low_bid = low_ask = low_price
-
-            data.append((
-                epic,
-                resolution,
-                p['snapshotTimeUTC'],
-                open_bid,
-                open_ask,
-                close_bid,
-                close_ask,
-                high_bid,
-                high_ask,
-                low_bid,
-                low_ask,
-                p['lastTradedVolume']
-            ))
-        return data
+        return transform.from_capital_prices(epic, resolution, prices)
 
     def download_epics(self):
         response = self.get("markets")
@@ -161,7 +111,7 @@ class CapitalDownloader(Downloader):
 class NewsDownloader(Downloader):
     '''Downloader per dati storici di https://newsapi.org/'''
     def __init__(self, database:Database, api_key:str):
-        super().__init__("https://newsapi.org/v2/", database)
+        super().__init__("https://newsapi.org/v2/", database, rate_limit_per_second=1, burst=5)
         self.header("Content-Type", "application/json")
         self.header("x-api-key", api_key)
 
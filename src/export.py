@@ -0,0 +1,162 @@
+import io
+import json
+import numpy as np
+
+from database import Database, HISTORICAL_FIELDS, News
+
+# Arrow è opzionale: senza pyarrow l'export è disponibile solo in NDJSON
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+BAR_COLUMNS = [field.name for field in HISTORICAL_FIELDS]
+NEWS_COLUMNS = [field.name for field in News._meta.sorted_fields]
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+
+def iter_bars(db:Database, epics:list[str]=None, resolutions:list[str]=None, since:str=None, until:str=None,
+              cursor:tuple[str, str, str]=None, chunk:int=10_000, limit:int=None):
+    '''
+    Blocchi di al più `chunk` barre in ordine (epic, resolution, snapshotTimeUTC).
+    cursor è l'(epic, resolution, snapshotTimeUTC) dell'ultima barra già ricevuta: l'export riprende
+    subito dopo, quindi un client può spezzare un dataset in più richieste senza stato sul server.
+    In memoria c'è un solo blocco alla volta.
+    '''
+    pairs = db.get_series(resolutions)
+    if epics:
+        wanted = set(epics)
+        pairs = [pair for pair in pairs if pair[0] in wanted]
+    if cursor:
+        pairs = [pair for pair in pairs if pair >= tuple(cursor[:2])]
+
+    remaining = limit
+    for epic, resolution in pairs:
+        after = cursor[2] if cursor and (epic, resolution) == tuple(cursor[:2]) else None
+        while remaining is None or remaining > 0:
+            size = chunk if remaining is None else min(chunk, remaining)
+            rows = db.get_bars(epic, resolution, after=after, limit=size, since=since, until=until)
+            if not rows:
+                break
+            yield rows
+            if remaining is not None:
+                remaining -= len(rows)
+            if len(rows) < size:
+                break
+            after = rows[-1][2]
+
+def iter_news(db:Database, since:str=None, until:str=None, cursor:tuple[str, str]=None, chunk:int=10_000, limit:int=None):
+    '''Blocchi di al più `chunk` notizie in ordine (publishedAt, source), ripartendo dopo cursor=(publishedAt, source)'''
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = chunk if remaining is None else min(chunk, remaining)
+        rows = db.get_news(after=cursor, limit=size, since=since, until=until)
+        if not rows:
+            break
+        yield rows
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < size:
+            break
+        cursor = rows[-1][:2]
+
+
+
+def to_ndjson(chunks, columns:list[str]):
+    '''Un oggetto JSON per riga, un blocco di byte per blocco di righe'''
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows).encode()
+
+def bars_schema():
+    return pa.schema(
+        [("epic", pa.string()), ("resolution", pa.string()), ("snapshotTimeUTC", pa.timestamp("s", tz="UTC"))] +
+        [(name, pa.float64()) for name in BAR_COLUMNS[3:-1]] +
+        [("lastTradedVolume", pa.int64())]
+    )
+
+def news_schema():
+    return pa.schema([(name, pa.string()) for name in NEWS_COLUMNS])
+
+BARS_SCHEMA = bars_schema() if pa else None
+NEWS_SCHEMA = news_schema() if pa else None
+
+def bars_batch(rows:list[tuple]):
+    columns = list(zip(*rows))
+    return pa.record_batch([
+        pa.array(columns[0], pa.string()),
+        pa.array(columns[1], pa.string()),
+        pa.array(np.array(columns[2], dtype="datetime64[s]"), pa.timestamp("s", tz="UTC")),
+        *[pa.array(column, pa.float64()) for column in columns[3:-1]],
+        pa.array(columns[-1], pa.int64())
+    ], schema=BARS_SCHEMA)
+
+def news_batch(rows:list[tuple]):
+    return pa.record_batch([pa.array(column, pa.string()) for column in zip(*rows)], schema=NEWS_SCHEMA)
+
+def to_arrow(chunks, schema, to_batch):
+    '''Stream Arrow IPC: lo schema e poi un record batch per blocco, inviati man mano che sono pronti'''
+    sink = io.BytesIO()
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_batch(to_batch(rows))
+            yield drain()
+    yield drain()
+
+
+
+if __name__ == "__main__":
+    db = Database("sqlite:///:memory:")
+    bars = sorted([(epic, resolution, f"2024-01-{day:02d}T{hour:02d}:00:00", *[float(day)] * 8, day)
+                   for epic, resolution, days in (("GOLD", "DAY", 7), ("GOLD", "HOUR", 5), ("SILVER", "DAY", 4))
+                   for day in range(1, days + 1) for hour in ([0] if resolution == "DAY" else [9])])
+    db.save_data_array(bars)
+
+    # Tutte le serie in ordine (epic, resolution, tempo), a blocchi di al più `chunk` barre
+    chunks = list(iter_bars(db, chunk=3))
+    assert [row for rows in chunks for row in rows] == bars and max(len(rows) for rows in chunks) == 3
+    assert [row for rows in iter_bars(db, ["GOLD"], ["DAY"], since="2024-01-03", until="2024-01-05") for row in rows] == bars[2:5]
+
+    # Un client che pagina con limit e cursor riceve ogni barra una sola volta, anche a cavallo fra le serie
+    for chunk, limit in ((3, 4), (2, 5), (10, 1)):
+        received, cursor, pages = [], None, 0
+        while page := [row for rows in iter_bars(db, cursor=cursor, chunk=chunk, limit=limit) for row in rows]:
+            assert len(page) <= limit
+            received.extend(page)
+            cursor = page[-1][:3]
+            pages += 1
+        assert received == bars and pages == -(-len(bars) // limit)
+
+    # Notizie in ordine (publishedAt, source), con la stessa paginazione
+    news = [(f"2024-01-0{day}T00:00:00", source, "", f"Title {day}", "", "", "", "") for day in range(1, 5) for source in ("BBC", "CNN")]
+    db.save_news_array(news)
+    received, cursor = [], None
+    while page := [row for rows in iter_news(db, cursor=cursor, chunk=2, limit=3) for row in rows]:
+        received.extend(page)
+        cursor = page[-1][:2]
+    assert received == news and [row for rows in iter_news(db, since="2024-01-04") for row in rows] == news[6:]
+
+    # NDJSON: un oggetto per riga con i nomi delle colonne
+    lines = b"".join(to_ndjson(iter_bars(db, chunk=5), BAR_COLUMNS)).decode().splitlines()
+    assert [tuple(json.loads(line)[name] for name in BAR_COLUMNS) for line in lines] == bars
+
+    # Arrow IPC: lo stream riletto restituisce le stesse barre e notizie, un record batch per blocco
+    if pa is not None:
+        reader = pa.ipc.open_stream(b"".join(to_arrow(iter_bars(db, chunk=5), BARS_SCHEMA, bars_batch)))
+        table = reader.read_all()
+        assert table.schema == BARS_SCHEMA and len(table.to_batches()) == -(-len(bars) // 5)
+        times = table["snapshotTimeUTC"].cast(pa.int64()).to_numpy().astype("datetime64[s]").astype(str)
+        assert [(epic, resolution, time, *row) for epic, resolution, time, *row in zip(
+            table["epic"].to_pylist(), table["resolution"].to_pylist(), times,
+            *[table[name].to_pylist() for name in BAR_COLUMNS[3:]])] == bars
+        table = pa.ipc.open_stream(b"".join(to_arrow(iter_news(db, chunk=3), NEWS_SCHEMA, news_batch))).read_all()
+        assert list(zip(*[table[name].to_pylist() for name in NEWS_COLUMNS])) == news
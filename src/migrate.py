@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import argparse
+import peewee
+from datetime import datetime, timezone
+
+from database import Database, HistoricalData, HISTORICAL_FIELDS, Series, CompactHistoricalData, StorageMigration
+from archive import archive_cold, ARCHIVE_AFTER_DAYS
+
+
+
+def database_size(db:Database) -> int:
+    '''Dimensione in byte del file SQLite (compreso il WAL), None per gli altri database'''
+    path = getattr(db.db, 'database', None)
+    if not path or path == ':memory:' or not os.path.exists(path):
+        return None
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+def migrate_to_compact(db:Database, chunk:int=100_000, keep:bool=False) -> int:
+    '''
+    Copia HistoricalData nel formato compatto (CompactHistoricalData + Series), una coppia
+    (epic, resolution) alla volta con paginazione sulla chiave primaria, e verifica il numero di righe.
+    Solo dopo la verifica registra la migrazione in StorageMigration: da lì i nuovi Database usano il formato compatto
+    anche se la tabella testuale resta. Se keep è False la elimina e, su SQLite, compatta il file con VACUUM.
+    Restituisce il numero di barre copiate.
+    '''
+    # Una migrazione interrotta lascia entrambe le tabelle: viene ripresa, le barre già copiate sono ignorate
+    if not db.db.table_exists(HistoricalData._meta.table_name):
+        print("✅ Il database usa già il formato compatto")
+        return 0
+
+    pairs = list(HistoricalData.select(HistoricalData.epic, HistoricalData.resolution).distinct().tuples())
+    db.db.create_tables([Series, CompactHistoricalData])
+    db.storage = "compact"
+    db._insert_sql = None
+
+    copied = 0
+    start = time.time()
+    with db.bulk_ingest(report=False):
+        for i, (epic, resolution) in enumerate(pairs, 1):
+            last = ""
+            while rows := list(HistoricalData
+                               .select(*HISTORICAL_FIELDS)
+                               .where(HistoricalData.epic == epic, HistoricalData.resolution == resolution, HistoricalData.snapshotTimeUTC > last)
+                               .order_by(HistoricalData.snapshotTimeUTC)
+                               .limit(chunk)
+                               .tuples()):
+                db.save_data_array(rows)
+                copied += len(rows)
+                last = rows[-1][2]
+            print(f"\t📊 {i}/{len(pairs)} {epic}:{resolution} ({copied} barre, {time.time() - start:.1f}s)")
+
+    expected = HistoricalData.select().count()
+    stored = CompactHistoricalData.select().count()
+    if stored != expected:
+        raise RuntimeError(f"Migrazione incompleta: {stored} barre nel formato compatto, {expected} in HistoricalData")
+    StorageMigration.replace(storage="compact", completed=datetime.now(timezone.utc)).execute()
+
+    if not keep:
+        HistoricalData.drop_table()
+        if isinstance(db.db, peewee.SqliteDatabase):
+            db.db.execute_sql("VACUUM")
+            db.db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    return copied
+
+def self_test():
+    '''Migrazione interrotta, con --keep e completa su file SQLite temporanei: il formato compatto solo dopo la verifica'''
+    import io
+    import tempfile
+    from contextlib import redirect_stdout
+
+    bars = [(epic, "DAY", f"2024-01-{day:02d}T00:00:00", *[float(day)] * 8, day) for epic in ("GOLD", "SILVER") for day in range(1, 11)]
+    with tempfile.TemporaryDirectory() as folder:
+        for keep in (True, False):
+            url = f"sqlite:///{os.path.join(folder, f'bars_{keep}.db')}"
+            db = Database(url)
+            db.save_data_array(bars)
+
+            # Interrotta dopo la creazione delle tabelle compatte: tutti restano sul formato testuale
+            db.db.create_tables([Series, CompactHistoricalData])
+            assert Database(url).storage == "text"
+            db = Database(url)
+            db.storage = "compact"
+            db._insert_sql = None
+            db.save_data_array(bars[:3])
+            assert Database(url).storage == "text"
+
+            # Ripresa: le barre già copiate vengono ignorate, poi la verifica e il marker
+            with redirect_stdout(io.StringIO()):
+                assert migrate_to_compact(Database(url), chunk=4, keep=keep) == len(bars)
+            db = Database(url)
+            assert db.storage == "compact" and db.db.table_exists(HistoricalData._meta.table_name) == keep
+            assert [tuple(row[:3]) for row in db.get_bars("SILVER", "DAY")] == [tuple(bar[:3]) for bar in bars[10:]]
+            with redirect_stdout(io.StringIO()):
+                assert migrate_to_compact(db) == (len(bars) if keep else 0)
+
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    arg = argparse.ArgumentParser(description="Converte le barre salvate nel formato compatto (timestamp interi e dizionario epic/resolution) o archivia quelle fredde")
+    arg.add_argument("-d", "--database", help="URL del database, di default APP_DB_URL")
+    arg.add_argument("-c", "--chunk", help="Barre lette per query", type=int, default=100_000)
+    arg.add_argument("-k", "--keep", help="Non eliminare la tabella HistoricalData dopo la copia", action="store_true")
+    arg.add_argument("-a", "--archive", help="Sposta le barre fredde nell'archivio compresso, di default in APP_ARCHIVE", nargs="?", const="")
+    arg.add_argument("--older-than", help="Giorni dopo cui archiviare, come RESOLUTION=GIORNI", nargs="*", default=[])
+    arg.add_argument("--self-test", help="Esegue il test su database SQLite temporanei, senza .env", action="store_true")
+    arguments = arg.parse_args()
+
+    if arguments.self_test:
+        self_test()
+        sys.exit(0)
+
+    if not os.getenv("APP_TRADING_BOT") and not load_dotenv():
+        print("❌\tFile .env non trovato.\nCopia il file .env.example in .env e imposta le variabili d'ambiente.")
+        exit(1)
+    # I default vengono dalle variabili d'ambiente, lette solo ora dal .env
+    arguments.database = arguments.database or os.getenv("APP_DB_URL")
+    if arguments.archive == "":
+        arguments.archive = os.getenv("APP_ARCHIVE") or "archive"
+
+    database = Database(arguments.database, archive=arguments.archive)
+    before = database_size(database)
+    try:
+        if arguments.archive:
+            days = {**ARCHIVE_AFTER_DAYS, **{r: int(d) for r, d in (item.split("=", 1) for item in arguments.older_than)}}
+            moved = archive_cold(database, days)
+            if moved and isinstance(database.db, peewee.SqliteDatabase):
+                database.db.execute_sql("VACUUM")
+                database.db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            print(f"✅ Archiviate {moved} barre in {arguments.archive}")
+        else:
+            copied = migrate_to_compact(database, arguments.chunk, arguments.keep)
+            print(f"✅ Migrate {copied} barre")
+    except KeyboardInterrupt:
+        print("\n❌ Operazione annullata dall'utente.")
+        sys.exit(1)
+
+    after = database_size(database)
+    if before and after:
+        print(f"💾 Dimensione del database: {before / 2**20:.1f} MB → {after / 2**20:.1f} MB")
@@ -0,0 +1,255 @@
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+
+from datetime import timedelta
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from database import Database, HISTORICAL_FIELDS, TradingStrategies
+from trading_strategies import TradingStrategies as Strategies
+
+# Valori provati per ogni parametro delle strategie
+PARAMETER_SPACE = {
+    "RSI": {
+        "rsi_period": [7, 14, 21],
+        "rsi_oversold": [20, 25, 30, 35],
+        "rsi_overbought": [65, 70, 75, 80]
+    },
+    "BOLLINGER": {
+        "bb_period": [10, 15, 20, 30],
+        "bb_std": [1.5, 2, 2.5, 3]
+    },
+    "COMBINED": {
+        "rsi_period": [7, 14, 21],
+        "rsi_oversold": [20, 25, 30, 35],
+        "rsi_overbought": [65, 70, 75, 80],
+        "bb_period": [10, 20, 30],
+        "bb_std": [1.5, 2, 2.5],
+        "macd_fast": [8, 12],
+        "macd_slow": [21, 26],
+        "macd_signal": [7, 9]
+    }
+}
+
+
+
+def grid_search(space:dict) -> list[dict]:
+    '''Tutte le combinazioni dello spazio dei parametri'''
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*space.values())]
+
+def random_search(space:dict, samples:int, seed:int=None) -> list[dict]:
+    '''Un campione casuale, senza ripetizioni, delle combinazioni dello spazio dei parametri'''
+    grid = grid_search(space)
+    return random.Random(seed).sample(grid, min(samples, len(grid)))
+
+def backtest(closes:np.ndarray, signals:np.ndarray) -> float:
+    '''
+    Rendimento logaritmico totale seguendo i segnali: BUY apre (o gira) una posizione lunga,
+    SELL una corta, HOLD mantiene quella corrente. Il segnale di una barra vale dalla barra successiva.
+    '''
+    position = pd.Series(np.select([signals == "BUY", signals == "SELL"], [1.0, -1.0], np.nan)).ffill().fillna(0.0).to_numpy()
+    returns = np.diff(np.log(closes))
+    return float(np.sum(position[:-1] * returns))
+
+
+
+# ======= Worker =======
+# Le chiusure di tutti gli epic stanno in un unico blocco di memoria condivisa: ogni processo
+# si collega al blocco all'avvio e legge la propria porzione senza copiarla.
+_shared = None
+_closes = None
+_offsets = None
+
+def _attach(name:str, size:int, offsets:list[int]):
+    global _shared, _closes, _offsets
+    _shared = shared_memory.SharedMemory(name=name)
+    _closes = np.ndarray((size,), dtype=np.float64, buffer=_shared.buf)
+    _offsets = offsets
+
+def _evaluate(strategy_type:str, epic_index:int, parameter_sets:list[dict]) -> list[float]:
+    closes = _closes[_offsets[epic_index]:_offsets[epic_index + 1]]
+    # high/low servono solo a supporto e resistenza, che non influenzano il segnale
+    df = pd.DataFrame({"close": closes, "high": closes, "low": closes}, copy=False)
+    strategies = Strategies()
+    series = {
+        "RSI": strategies.rsi_strategy_series,
+        "BOLLINGER": strategies.bollinger_strategy_series,
+        "COMBINED": strategies.combined_strategy_series
+    }[strategy_type]
+    return [backtest(closes, series(df, **parameters)["signal"].to_numpy()) for parameters in parameter_sets]
+
+
+
+class ParameterOptimizer:
+    '''
+    Cerca i parametri migliori di una strategia per ogni epic sullo storico salvato,
+    distribuendo le combinazioni su un pool di processi (di default uno per core).
+    '''
+
+    def __init__(self, db:Database, strategy_type:str="COMBINED", timeframe:str="HOUR", bars:int=5000, workers:int=None, chunk:int=16):
+        self.db = db
+        self.strategy_type = strategy_type
+        self.timeframe = timeframe
+        self.bars = bars
+        self.workers = workers or os.cpu_count()
+        self.chunk = chunk
+
+    def load_closes(self, epics:list[str]) -> tuple[list[str], np.ndarray, list[int]]:
+        '''Ultime `bars` chiusure di ogni epic, concatenate; offsets delimita ogni epic'''
+        bars = self.db.get_last_bars(epics, self.timeframe, self.bars)
+        close = [field.name for field in HISTORICAL_FIELDS].index('closeBid')
+
+        loaded, blocks, offsets = [], [], [0]
+        for epic in epics:
+            closes = [row[close] for row in bars.get(epic, [])]
+            if len(closes) < 2:
+                continue
+            loaded.append(epic)
+            blocks.append(np.asarray(closes, dtype=np.float64))
+            offsets.append(offsets[-1] + len(closes))
+        return loaded, np.concatenate(blocks) if blocks else np.empty(0), offsets
+
+    def run(self, epics:list[str], parameter_sets:list[dict]) -> dict[str, tuple[dict, float]]:
+        '''Valuta ogni combinazione su ogni epic; restituisce per epic i parametri migliori e il loro rendimento'''
+        epics, closes, offsets = self.load_closes(epics)
+        if not epics:
+            return {}
+
+        shared = shared_memory.SharedMemory(create=True, size=closes.nbytes)
+        try:
+            np.ndarray(closes.shape, dtype=np.float64, buffer=shared.buf)[:] = closes
+            del closes
+
+            chunks = [parameter_sets[i:i + self.chunk] for i in range(0, len(parameter_sets), self.chunk)]
+            best = {}
+            total = len(epics) * len(chunks)
+            completed = 0
+            start = time.time()
+
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_attach, initargs=(shared.name, offsets[-1], offsets)) as executor:
+                futures = {
+                    executor.submit(_evaluate, self.strategy_type, i, chunk): (epics[i], chunk)
+                    for i in range(len(epics)) for chunk in chunks
+                }
+                for future in as_completed(futures):
+                    epic, chunk = futures[future]
+                    for parameters, score in zip(chunk, future.result()):
+                        if epic not in best or score > best[epic][1]:
+                            best[epic] = (parameters, score)
+
+                    completed += 1
+                    if completed % max(1, total // 20) == 0 or completed == total:
+                        delta = time.time() - start
+                        remaining = (delta / completed) * (total - completed)
+                        print(f"🕒 [{str(timedelta(seconds=delta))[:-3]}] Rimasto: {str(timedelta(seconds=remaining))[:-3]} {completed}/{total} ({completed / total:.2%})")
+            return best
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def save(self, results:dict[str, tuple[dict, float]]):
+        '''Scrive i parametri migliori in TradingStrategies.parameters, creando la strategia dell'epic se non esiste'''
+        with self.db.db.atomic():
+            for epic, (parameters, _) in results.items():
+                updated = (TradingStrategies
+                           .update(parameters=parameters)
+                           .where(TradingStrategies.epic == epic, TradingStrategies.strategy_type == self.strategy_type)
+                           .execute())
+                if not updated:
+                    TradingStrategies.create(
+                        name=f"{self.strategy_type}_OPTIMIZED",
+                        epic=epic,
+                        strategy_type=self.strategy_type,
+                        parameters=parameters
+                    )
+
+
+
+def self_test():
+    '''Ottimizzazione su chiusure sintetiche: il pool con memoria condivisa trova gli stessi parametri della valutazione seriale'''
+    import io
+    import contextlib
+
+    db = Database("sqlite:///:memory:")
+    rng = np.random.default_rng(7)
+    times = pd.date_range("2024-01-01", periods=400, freq="h").strftime("%Y-%m-%dT%H:%M:%S")
+    for epic in ("GOLD", "SILVER"):
+        closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(times))))
+        db.save_data_array([(epic, "HOUR", time, *[close] * 8, 1) for time, close in zip(times, closes)])
+    db.save_data_array([("OIL", "HOUR", times[0], *[1.0] * 8, 1)])  # una sola barra: epic ignorato
+
+    parameter_sets = random_search(PARAMETER_SPACE["RSI"], 6, seed=1)
+    assert len(parameter_sets) == 6 and random_search(PARAMETER_SPACE["RSI"], 6, seed=1) == parameter_sets
+    assert len(grid_search(PARAMETER_SPACE["BOLLINGER"])) == 16
+    assert backtest(np.array([1.0, 2.0, 1.0]), np.array(["BUY", "HOLD", "HOLD"])) == 0.0
+    assert math.isclose(backtest(np.array([1.0, 2.0, 1.0]), np.array(["BUY", "SELL", "HOLD"])), 2 * math.log(2))
+
+    optimizer = ParameterOptimizer(db, "RSI", "HOUR", bars=300, workers=2, chunk=4)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = optimizer.run(["GOLD", "SILVER", "OIL", "MISSING"], parameter_sets)
+    assert sorted(results) == ["GOLD", "SILVER"]
+
+    epics, closes, offsets = optimizer.load_closes(["GOLD", "SILVER"])
+    assert offsets == [0, 300, 600]
+    strategies = Strategies()
+    for i, epic in enumerate(epics):
+        series = closes[offsets[i]:offsets[i + 1]]
+        df = pd.DataFrame({"close": series, "high": series, "low": series})
+        scores = [backtest(series, strategies.rsi_strategy_series(df, **parameters)["signal"].to_numpy()) for parameters in parameter_sets]
+        assert math.isclose(results[epic][1], max(scores)) and results[epic][0] == parameter_sets[scores.index(max(scores))]
+
+    # Il salvataggio aggiorna la strategia esistente invece di crearne un'altra
+    optimizer.save(results)
+    optimizer.save(results)
+    saved = {strategy.epic: strategy.parameters for strategy in TradingStrategies.select().where(TradingStrategies.strategy_type == "RSI")}
+    assert saved == {epic: parameters for epic, (parameters, _) in results.items()}
+
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    arg = argparse.ArgumentParser(description="Ottimizzazione dei parametri delle strategie sullo storico salvato")
+    arg.add_argument("-e", "--epics", help="Epic da ottimizzare, lasciare vuoto per tutti", nargs="*")
+    arg.add_argument("-s", "--strategy", help="Strategia da ottimizzare", choices=PARAMETER_SPACE.keys(), default="COMBINED")
+    arg.add_argument("-t", "--timeframe", help="Timeframe dello storico", default="HOUR")
+    arg.add_argument("-b", "--bars", help="Numero di barre più recenti usate per epic", type=int, default=5000)
+    arg.add_argument("-r", "--random", help="Numero di combinazioni casuali da provare, 0 per la griglia completa", type=int, default=0)
+    arg.add_argument("-w", "--workers", help="Processi del pool, di default uno per core", type=int, default=None)
+    arg.add_argument("--self-test", help="Esegue il test su dati sintetici, senza database né .env", action="store_true")
+    arguments = arg.parse_args()
+
+    if arguments.self_test:
+        self_test()
+        sys.exit(0)
+
+    if not os.getenv("APP_TRADING_BOT") and not load_dotenv():
+        print("❌\tFile .env non trovato.\nCopia il file .env.example in .env e imposta le variabili d'ambiente.")
+        exit(1)
+
+    database = Database(os.getenv("APP_DB_URL"))
+    space = PARAMETER_SPACE[arguments.strategy]
+    parameter_sets = random_search(space, arguments.random) if arguments.random else grid_search(space)
+    epics = arguments.epics or database.get_all_epics()
+
+    print(f"⏳ {len(parameter_sets)} combinazioni di {arguments.strategy} su {len(epics)} epic...")
+    optimizer = ParameterOptimizer(database, arguments.strategy, arguments.timeframe, arguments.bars, arguments.workers)
+    try:
+        results = optimizer.run(epics, parameter_sets)
+    except KeyboardInterrupt:
+        print("\n❌ Operazione annullata dall'utente.")
+        sys.exit(1)
+
+    optimizer.save(results)
+    # Il punteggio è un rendimento logaritmico: viene mostrato come rendimento semplice
+    for epic, (parameters, score) in sorted(results.items()):
+        print(f"\t📈 {epic}: {math.expm1(score):+.2%} {parameters}")
+    print(f"✅ Parametri salvati per {len(results)} epic")
@@ -1,41 +1,70 @@
 from tradingview_ta import TA_Handler, Interval
 import yfinance as yf
 
+from cache import TTLCache
+
+# Durata in secondi dell'analisi in cache per ogni intervallo di TradingView:
+# un riepilogo giornaliero cambia molto più lentamente di uno a 1 minuto
+SENTIMENT_TTL = {
+    Interval.INTERVAL_1_MINUTE: 30,
+    Interval.INTERVAL_5_MINUTES: 60,
+    Interval.INTERVAL_15_MINUTES: 120,
+    Interval.INTERVAL_30_MINUTES: 180,
+    Interval.INTERVAL_1_HOUR: 300,
+    Interval.INTERVAL_2_HOURS: 450,
+    Interval.INTERVAL_4_HOURS: 600,
+    Interval.INTERVAL_1_DAY: 900,
+    Interval.INTERVAL_1_WEEK: 3600,
+    Interval.INTERVAL_1_MONTH: 3600
+}
+NEWS_TTL = 300
+
 class TradingViewAnalysis:
     """
     Fornisce l'analisi del sentiment tecnico da TradingView.
+    Le risposte restano in cache per (symbol, screener, exchange, interval) secondo SENTIMENT_TTL,
+    e richieste concorrenti per la stessa chiave condividono una sola chiamata a TradingView.
     """
+    def __init__(self, cache: TTLCache = None):
+        self.cache = cache or TTLCache(max_entries=2048, max_bytes=16 * 1024 * 1024)
+
     def get_sentiment(self, symbol: str, screener: str, exchange: str, interval: str = Interval.INTERVAL_1_DAY):
         """
         Ottiene il riepilogo dell'analisi tecnica.
         - symbol: Il ticker (es. "GOLD", "AAPL")
         - screener: Il mercato (es. "america", "forex", "crypto")
         - exchange: La borsa (es. "NASDAQ", "FX_IDC")
+        Gli errori di TradingView vengono sollevati e non finiscono in cache: è il chiamante a decidere
+        come riportarli (api.py li restituisce in `errors`)
         """
-        try:
-            handler = TA_Handler(
-                symbol=symbol,
-                screener=screener,
-                exchange=exchange,
-                interval=interval
-            )
-            analysis = handler.get_analysis()
-            return analysis.summary
-        except Exception as e:
-            print(f"⚠️ Impossibile ottenere l'analisi da TradingView per {symbol}: {e}")
-            return None
+        return self.cache.get_or_load(
+            (symbol, screener, exchange, interval),
+            lambda: self.fetch_sentiment(symbol, screener, exchange, interval),
+            ttl=SENTIMENT_TTL.get(interval)
+        )
+
+    def fetch_sentiment(self, symbol: str, screener: str, exchange: str, interval: str):
+        """Chiamata diretta a TradingView, senza cache; gli errori vengono sollevati"""
+        handler = TA_Handler(
+            symbol=symbol,
+            screener=screener,
+            exchange=exchange,
+            interval=interval
+        )
+        analysis = handler.get_analysis()
+        return analysis.summary
 
 class YahooFinanceNews:
     """
     Fornisce le notizie di mercato da Yahoo Finance.
+    Le notizie di ogni ticker restano in cache per NEWS_TTL secondi.
     """
+    def __init__(self, cache: TTLCache = None):
+        self.cache = cache or TTLCache(ttl=NEWS_TTL, max_entries=1024, max_bytes=32 * 1024 * 1024)
+
     def get_news(self, symbol: str):
         """
         Ottiene le notizie più recenti per un dato ticker.
+        Gli errori di Yahoo Finance vengono sollevati e non finiscono in cache
         """
-        try:
-            ticker = yf.Ticker(symbol)
-            return ticker.news
-        except Exception as e:
-            print(f"⚠️ Impossibile ottenere le notizie da Yahoo Finance per {symbol}: {e}")
-            return []
\ No newline at end of file
+        return self.cache.get_or_load(symbol, lambda: yf.Ticker(symbol).news)
@@ -0,0 +1,144 @@
+import time
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    '''
+    Limitatore di richieste a token bucket, condivisibile fra più thread.
+    Permette burst fino a `capacity` richieste e poi una media di `rate` richieste al secondo.
+    Alla ricezione di un 429 blocca tutte le richieste per il tempo indicato da Retry-After
+    (o con backoff esponenziale se assente) e dimezza il rate, che poi risale gradualmente
+    a ogni risposta andata a buon fine.
+    '''
+
+    def __init__(self, rate:float, capacity:float=None, min_rate:float=None, max_backoff:float=60.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 10
+        self.capacity = capacity if capacity is not None else rate
+        self.max_backoff = max_backoff
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+        # Contatori
+        self.requests = 0   # token concessi
+        self.waited = 0     # richieste ritardate localmente per rispettare il rate
+        self.throttled = 0  # risposte 429 ricevute dal server
+        self.retried = 0    # richieste ripetute dopo un 429
+
+    def _refill(self, now:float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self) -> float:
+        '''Prenota un token e attende finché non è disponibile. Restituisce i secondi di attesa'''
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            self.requests += 1
+            # Token negativi = richieste già prenotate in coda: ognuna aspetta il proprio turno,
+            # che dopo un 429 comincia solo alla fine della pausa (il refill riparte da blocked_until)
+            wait = max(self.blocked_until, now) - now + max(0.0, -self.tokens) / self.rate
+            if wait > 0:
+                self.waited += 1
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def success(self):
+        '''Risposta accettata dal server: il rate risale in modo additivo verso il massimo'''
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def throttle(self, retry_after:str=None, attempt:int=0) -> float:
+        '''Risposta 429: sospende tutte le richieste e dimezza il rate. Restituisce i secondi di pausa'''
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = min(self.max_backoff, (2 ** attempt) / self.max_rate * 10)
+
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.blocked_until = max(self.blocked_until, now + delay)
+            # Il bucket riparte vuoto alla fine della pausa per non ripartire con un burst
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = max(self.updated, self.blocked_until)
+        return delay
+
+    def retry(self):
+        with self.lock:
+            self.retried += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "requests": self.requests,
+                "waited": self.waited,
+                "throttled": self.throttled,
+                "retried": self.retried
+            }
+
+
+
+def parse_retry_after(value:str) -> float:
+    '''Converte l'header Retry-After (secondi o data HTTP) in secondi, None se assente o non valido'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+
+if __name__ == "__main__":
+    # Burst iniziale senza attese, poi una richiesta ogni 1/rate secondi
+    bucket = TokenBucket(rate=100, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.01
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.045
+    assert bucket.stats()["waited"] == 5
+
+    # Un 429 dimezza il rate e blocca le richieste per il tempo di Retry-After
+    assert bucket.throttle("0.05") == 0.05
+    assert bucket.rate == 50
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.05
+    for _ in range(20):
+        bucket.success()
+    assert bucket.rate == 100
+
+    # Una richiesta in coda durante la pausa aspetta la fine della pausa più il proprio turno
+    bucket = TokenBucket(rate=100, capacity=1)
+    bucket.acquire()
+    start = time.monotonic()
+    bucket.throttle("0.05")
+    waits = [bucket.acquire() for _ in range(2)]
+    # La seconda attesa si accorcia di quanto il primo sleep ha sforato: conta il turno, non l'attesa
+    assert waits[0] >= 0.05 + 1 / bucket.rate - 0.001 and time.monotonic() - start >= 0.05 + 2 / bucket.rate
+
+    # Retry-After come data HTTP
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("abc") is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,137 @@
+import numpy as np
+
+import transform
+from database import Database, to_epoch, from_epoch, merge_intervals
+
+# Durata in secondi delle resolution di Capital.com costruibili dalle barre MINUTE.
+# I bucket sono allineati all'epoch UTC: DAY va dalle 00:00 alle 23:59 UTC
+RESOLUTION_SECONDS = {
+    "MINUTE": 60,
+    "MINUTE_5": 300,
+    "MINUTE_15": 900,
+    "MINUTE_30": 1800,
+    "HOUR": 3600,
+    "HOUR_4": 14400,
+    "DAY": 86400
+}
+ROLLUP_RESOLUTIONS = tuple(resolution for resolution in RESOLUTION_SECONDS if resolution != "MINUTE")
+
+
+
+def aggregate(columns:transform.PriceColumns, resolution:str, covered:list[tuple[int, int]]=None) -> transform.PriceColumns:
+    '''
+    Barre di `resolution` costruite da barre MINUTE in ordine di tempo: open della prima barra del bucket,
+    massimo degli high, minimo dei low, close dell'ultima e somma dei volumi, separatamente per bid e ask.
+    Con `covered` (intervalli MINUTE scaricati, fusi, in secondi epoch) restano solo i bucket interamente
+    scaricati, così una barra parziale non viene mai salvata.
+    '''
+    seconds = RESOLUTION_SECONDS[resolution]
+    times = to_epoch(columns.times)
+    buckets = times - times % seconds
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]])) if len(times) else np.empty(0, dtype=np.intp)
+    ends = np.concatenate([starts[1:], [len(times)]]) - 1
+
+    prices = columns.prices
+    rolled = np.empty((len(starts), len(transform.PRICE_FIELDS)))
+    if len(starts):
+        rolled[:, 0:2] = prices[starts, 0:2]
+        rolled[:, 2:4] = np.maximum.reduceat(prices[:, 2:4], starts, axis=0)
+        rolled[:, 4:6] = np.minimum.reduceat(prices[:, 4:6], starts, axis=0)
+        rolled[:, 6:8] = prices[ends, 6:8]
+    volume = np.add.reduceat(columns.volume, starts) if len(starts) else np.empty(0, dtype=np.int64)
+    bucket_times = buckets[starts]
+
+    if covered is not None:
+        complete = complete_buckets(bucket_times, seconds, covered)
+        rolled, volume, bucket_times = rolled[complete], volume[complete], bucket_times[complete]
+
+    times = np.array(from_epoch(bucket_times), dtype=object)
+    return transform.PriceColumns(columns.epic, resolution, times, rolled, volume)
+
+def complete_buckets(buckets:np.ndarray, seconds:int, covered:list[tuple[int, int]]) -> np.ndarray:
+    '''Maschera dei bucket [inizio, inizio + seconds) contenuti per intero in un intervallo di `covered`'''
+    if not covered:
+        return np.zeros(len(buckets), dtype=bool)
+    covered_starts = np.array([start for start, _ in covered])
+    covered_ends = np.array([end for _, end in covered])
+    index = np.searchsorted(covered_starts, buckets, side='right') - 1
+    return (index >= 0) & (covered_ends[np.maximum(index, 0)] >= buckets + seconds - 1)
+
+
+
+class RollupEngine:
+    '''
+    Costruisce localmente le resolution superiori dalle barre MINUTE già salvate, invece di scaricarle.
+    Le barre vengono scritte con Database.save_data_array e ogni bucket costruito viene registrato
+    nell'indice di copertura della sua resolution, compresi quelli senza barre MINUTE (mercato chiuso).
+    '''
+
+    def __init__(self, db:Database, resolutions:list[str]=ROLLUP_RESOLUTIONS):
+        unknown = set(resolutions) - set(ROLLUP_RESOLUTIONS)
+        if unknown:
+            raise ValueError(f"Resolution non costruibili dalle barre MINUTE: {sorted(unknown)}")
+        self.db = db
+        self.resolutions = list(resolutions)
+
+    def rollup(self, epic:str, resolution:str, from_date:str, to_date:str) -> int:
+        '''Costruisce e salva le barre complete di `resolution` fra from_date e to_date. Restituisce le barre salvate'''
+        seconds = RESOLUTION_SECONDS[resolution]
+        start, end = (int(t) for t in to_epoch([from_date, to_date]))
+        start, end = start - start % seconds, end - end % seconds + seconds - 1
+        since, until = from_epoch([start, end])
+
+        covered = self.db.get_coverage([epic], ["MINUTE"], since, until).get((epic, "MINUTE"), [])
+        rows = self.db.get_bars(epic, "MINUTE", since=since, until=until)
+        columns = transform.columns_from_rows(rows)[0] if rows else transform.PriceColumns(
+            epic, "MINUTE", np.empty(0, dtype=object), np.empty((0, len(transform.PRICE_FIELDS))), np.empty(0, dtype=np.int64))
+        bars = aggregate(columns, resolution, covered)
+
+        # Anche i bucket senza barre ma interamente scaricati sono completi
+        buckets = np.arange(start, end + 1, seconds)
+        complete = buckets[complete_buckets(buckets, seconds, covered)]
+        with self.db.transaction():
+            saved = self.db.save_data_array(bars) if len(bars) else 0
+            for first, last in merge_intervals((bucket, bucket + seconds - 1) for bucket in complete.tolist()):
+                self.db.add_coverage(epic, resolution, *from_epoch([first, last]))
+        return saved
+
+    def fill(self, epics:list[str], since:str, until:str) -> int:
+        '''Costruisce le barre di tutte le resolution dove l'indice di copertura ha dei buchi fra since e until'''
+        saved = 0
+        missing = self.db.get_missing_intervals(epics, self.resolutions, since, until)
+        for (epic, resolution), gaps in missing.items():
+            for from_date, to_date in gaps:
+                saved += self.rollup(epic, resolution, from_date, to_date)
+        return saved
+
+
+
+if __name__ == "__main__":
+    # Un'ora di barre MINUTE con un buco: aggregazione vettoriale per bucket da 15 minuti
+    minutes = [m for m in range(60) if m not in range(20, 25)]
+    times = np.array([f"2024-01-02T10:{m:02d}:00" for m in minutes], dtype=object)
+    prices = np.array([[m, m + 0.5, m + 1, m + 1.5, m - 1, m - 0.5, m + 0.2, m + 0.7] for m in minutes], dtype=np.float64)
+    columns = transform.PriceColumns("GOLD", "MINUTE", times, prices, np.ones(len(minutes), dtype=np.int64))
+
+    bars = aggregate(columns, "MINUTE_15")
+    assert list(bars.times) == [f"2024-01-02T10:{m:02d}:00" for m in (0, 15, 30, 45)]
+    assert list(bars.column("openBid")) == [0, 15, 30, 45] and list(bars.column("openAsk")) == [0.5, 15.5, 30.5, 45.5]
+    assert list(bars.column("highAsk")) == [15.5, 30.5, 45.5, 60.5] and list(bars.column("lowBid")) == [-1, 14, 29, 44]
+    assert list(bars.column("closeBid")) == [14.2, 29.2, 44.2, 59.2] and list(bars.volume) == [15, 10, 15, 15]
+    hour = aggregate(columns, "HOUR")
+    assert len(hour) == 1 and hour.column("highBid")[0] == 60 and hour.column("closeAsk")[0] == 59.7 and hour.volume[0] == 55
+
+    # Solo i bucket interamente scaricati
+    covered = [(int(to_epoch(["2024-01-02T10:00:00"])[0]), int(to_epoch(["2024-01-02T10:29:59"])[0]))]
+    partial = aggregate(columns, "MINUTE_15", covered)
+    assert list(partial.times) == ["2024-01-02T10:00:00", "2024-01-02T10:15:00"]
+
+    # Dal database: barre e copertura delle resolution superiori
+    db = Database("sqlite:///:memory:")
+    db.save_window("GOLD", "MINUTE", "2024-01-02T10:00:00", "2024-01-02T10:59:59", columns)
+    engine = RollupEngine(db, ["MINUTE_15", "HOUR", "DAY"])
+    assert engine.fill(["GOLD"], "2024-01-02T00:00:00", "2024-01-02T23:59:59") == 5
+    assert db.get_bars("GOLD", "HOUR") == list(hour.rows())
+    assert db.get_missing_intervals(["GOLD"], ["HOUR"], "2024-01-02T10:00:00", "2024-01-02T10:59:59") == {}
+    assert ("GOLD", "DAY") in db.get_missing_intervals(["GOLD"], ["DAY"], "2024-01-02T00:00:00", "2024-01-02T23:59:59")
+    assert db.get_bars("GOLD", "DAY") == []
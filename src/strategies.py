@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from ta.trend import SMAIndicator
 
 def moving_average_crossover(df: pd.DataFrame, fast_period: int = 10, slow_period: int = 30) -> pd.DataFrame:
@@ -26,4 +28,33 @@ def moving_average_crossover(df: pd.DataFrame, fast_period: int = 10, slow_perio
     df.loc[crossover, 'signal'] = "BUY"
     df.loc[crossunder, 'signal'] = "SELL"
 
-    return df
\ No newline at end of file
+    return df
+
+
+def scan_sma_crossover(closes: np.ndarray, fast_period: int = 10, slow_period: int = 30) -> np.ndarray:
+    """
+    Versione vettoriale di moving_average_crossover limitata all'ultima barra, per molti epic insieme.
+    `closes` è una matrice (epic, barre) con le ultime chiusure di ogni epic in ordine crescente,
+    allineate a destra e con NaN a sinistra per gli epic con meno barre.
+    Bastano slow_period + 1 colonne. Restituisce un array di "BUY"/"SELL"/"HOLD", uno per riga.
+    """
+    # Medie mobili sull'ultima barra e su quella precedente; con barre mancanti il risultato è NaN
+    # e i confronti sono falsi, come per le prime barre di moving_average_crossover
+    fast_now = closes[:, -fast_period:].mean(axis=1)
+    fast_prev = closes[:, -fast_period - 1:-1].mean(axis=1)
+    slow_now = closes[:, -slow_period:].mean(axis=1)
+    slow_prev = closes[:, -slow_period - 1:-1].mean(axis=1)
+
+    crossover = (fast_now > slow_now) & (fast_prev < slow_prev)
+    crossunder = (fast_now < slow_now) & (fast_prev > slow_prev)
+    return np.select([crossover, crossunder], ["BUY", "SELL"], default="HOLD").astype(object)
+
+def scan_sma_crossover_parallel(closes: np.ndarray, fast_period: int = 10, slow_period: int = 30, workers: int = 4, chunk: int = 5000) -> np.ndarray:
+    """Come scan_sma_crossover, ma con i blocchi di righe distribuiti su un pool di processi"""
+    if workers <= 1 or len(closes) <= chunk:
+        return scan_sma_crossover(closes, fast_period, slow_period)
+
+    blocks = [closes[i:i + chunk] for i in range(0, len(closes), chunk)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(scan_sma_crossover, blocks, [fast_period] * len(blocks), [slow_period] * len(blocks))
+        return np.concatenate(list(results))
@@ -0,0 +1,431 @@
+import json
+import time
+import random
+import threading
+import numpy as np
+from abc import ABC, abstractmethod
+from queue import Queue, Empty
+
+import transform
+from database import Database, from_epoch
+from rollup import RESOLUTION_SECONDS
+
+# websockets è opzionale: serve solo per lo stream reale di Capital.com
+try:
+    from websockets.sync.client import connect as websocket_connect
+except ImportError:
+    websocket_connect = None
+
+CAPITAL_STREAM_URL = "wss://api-streaming-capital.backend-capital.com/connect"
+CAPITAL_STREAM_EPICS = 40       # Capital.com accetta al massimo 40 epic per sottoscrizione
+CAPITAL_PING_INTERVAL = 540     # la sessione di streaming scade dopo 10 minuti senza messaggi del client
+
+
+
+class TickRing:
+    '''
+    Buffer circolare di dimensione fissa degli ultimi tick (tempo in ms, bid, ask) di un epic.
+    Gli array sono allocati una volta sola: la memoria non cresce con il numero di tick ricevuti.
+    '''
+
+    def __init__(self, capacity:int):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.bids = np.zeros(capacity)
+        self.asks = np.zeros(capacity)
+        self.count = 0  # tick ricevuti in totale
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp:int, bid:float, ask:float):
+        with self.lock:
+            i = self.count % self.capacity
+            self.times[i] = timestamp
+            self.bids[i] = bid
+            self.asks[i] = ask
+            self.count += 1
+
+    def last(self, n:int=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Copie degli ultimi n tick (tutti quelli nel buffer se None) in ordine di tempo'''
+        with self.lock:
+            n = len(self) if n is None else min(n, len(self))
+            index = np.arange(self.count - n, self.count) % self.capacity
+            return self.times[index], self.bids[index], self.asks[index]
+
+    def latest(self) -> tuple[int, float, float]:
+        '''Ultimo tick (tempo in ms, bid, ask), None se il buffer è vuoto'''
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.count - 1) % self.capacity
+            return int(self.times[i]), float(self.bids[i]), float(self.asks[i])
+
+
+
+class BarBuilder:
+    '''
+    Costruisce al volo le barre bid/ask di più resolution dai tick, con bucket allineati all'epoch UTC
+    come rollup.aggregate. Il volume è il numero di tick, come lastTradedVolume di Capital.com.
+    Una barra è completata dal primo tick del bucket successivo o da expire() quando il bucket è finito.
+    La prima barra di ogni serie (e quelle interrotte da una riconnessione, vedi reset) è iniziata prima
+    dello stream, quindi è incompleta e non viene mai restituita.
+    '''
+
+    def __init__(self, resolutions:list[str]):
+        self.seconds = {resolution: RESOLUTION_SECONDS[resolution] for resolution in resolutions}
+        self.bars = {}       # (epic, resolution) -> [bucket, 8 prezzi, tick, parziale], None dopo expire
+        self.completed = {}  # (epic, resolution) -> barre completate non ancora restituite
+        self.pending = 0
+        self.clock = 0       # secondo epoch dell'ultimo tick, l'orologio del server
+
+    def update(self, epic:str, timestamp:int, bid:float, ask:float):
+        second = timestamp // 1000
+        if second > self.clock:
+            self.clock = second
+        for resolution, seconds in self.seconds.items():
+            key = (epic, resolution)
+            bucket = second - second % seconds
+            bar = self.bars.get(key)
+            if bar is None or bucket > bar[0]:
+                if bar is not None:
+                    self._complete(key, bar)
+                # Senza barra precedente (nemmeno chiusa da expire) il bucket è iniziato prima dello stream
+                self.bars[key] = [bucket, bid, ask, bid, ask, bid, ask, bid, ask, 1, key not in self.bars]
+            elif bucket == bar[0]:
+                if bid > bar[3]: bar[3] = bid
+                if ask > bar[4]: bar[4] = ask
+                if bid < bar[5]: bar[5] = bid
+                if ask < bar[6]: bar[6] = ask
+                bar[7] = bid
+                bar[8] = ask
+                bar[9] += 1
+            # Un tick in ritardo di un bucket già completato viene ignorato
+
+    def _complete(self, key:tuple, bar:list):
+        if not bar[10]:
+            self.completed.setdefault(key, []).append(bar[:10])
+            self.pending += 1
+
+    def expire(self, grace:int=2):
+        '''Completa le barre il cui bucket è finito da almeno `grace` secondi (sull'orologio dei tick) senza nuovi tick'''
+        for key, bar in self.bars.items():
+            if bar is not None and bar[0] + self.seconds[key[1]] + grace <= self.clock:
+                self._complete(key, bar)
+                self.bars[key] = None
+
+    def reset(self):
+        '''Dopo una riconnessione i tick persi rendono incomplete le barre in costruzione: vengono scartate'''
+        self.bars.clear()
+
+    def drain(self) -> list[transform.PriceColumns]:
+        '''Barre completate dall'ultima chiamata, un blocco PriceColumns per (epic, resolution)'''
+        blocks = []
+        for (epic, resolution), bars in self.completed.items():
+            bars = np.array(bars, dtype=np.float64)
+            times = np.array(from_epoch(bars[:, 0].astype(np.int64)), dtype=object)
+            blocks.append(transform.PriceColumns(epic, resolution, times, bars[:, 1:9], bars[:, 9].astype(np.int64)))
+        self.completed = {}
+        self.pending = 0
+        return blocks
+
+
+
+class QuoteStream(ABC):
+    '''
+    Sorgente di quotazioni: iterando si ottengono tick (epic, tempo in ms, bid, ask), oppure None
+    quando per un po' non arrivano messaggi, così chi consuma può fare i salvataggi a tempo.
+    `connections` conta le connessioni aperte: se cambia, alcuni tick possono essere andati persi.
+    Le sottoclassi implementano __iter__ e, se tengono risorse aperte, close.
+    '''
+    connections:int = 0
+
+    @abstractmethod
+    def __iter__(self):
+        '''Tick (epic, tempo in ms, bid, ask) o None, finché lo stream non viene chiuso'''
+
+    def close(self):
+        pass
+
+
+
+class CapitalQuoteStream(QuoteStream):
+    '''
+    Quotazioni in tempo reale dal WebSocket di Capital.com (marketData.subscribe), con ping periodico
+    e riconnessione con backoff esponenziale. `connect` apre la connessione (di default websockets,
+    per i test FakeQuoteServer.connect) e restituisce un oggetto con send, recv(timeout) e close.
+    '''
+
+    def __init__(self, cst:str, security_token:str, epics:list[str], url:str=CAPITAL_STREAM_URL, connect=None,
+                 reconnect_delay:float=1.0, max_reconnect_delay:float=60.0):
+        connect = connect or websocket_connect
+        if connect is None:
+            raise RuntimeError("Per lo streaming delle quotazioni installare websockets (pip install websockets)")
+        self.cst = cst
+        self.security_token = security_token
+        self.epics = list(epics)
+        self.url = url
+        self.connect = connect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.correlation = 0
+        self.closed = False
+        self.connections = 0
+
+    @classmethod
+    def from_downloader(cls, capital, epics:list[str], **options) -> "CapitalQuoteStream":
+        '''Stream che usa i token della sessione aperta da CapitalDownloader.start_new_session'''
+        headers = capital.session.headers
+        return cls(headers["CST"], headers["X-SECURITY-TOKEN"], epics, **options)
+
+    def _message(self, destination:str, payload:dict=None) -> str:
+        self.correlation += 1
+        message = {"destination": destination, "correlationId": str(self.correlation), "cst": self.cst, "securityToken": self.security_token}
+        if payload is not None:
+            message["payload"] = payload
+        return json.dumps(message)
+
+    def __iter__(self):
+        delay = self.reconnect_delay
+        while not self.closed:
+            try:
+                connection = self.connect(self.url)
+                try:
+                    for start in range(0, len(self.epics), CAPITAL_STREAM_EPICS):
+                        connection.send(self._message("marketData.subscribe", {"epics": self.epics[start:start + CAPITAL_STREAM_EPICS]}))
+                    self.connections += 1
+                    delay = self.reconnect_delay
+                    yield from self._quotes(connection)
+                finally:
+                    connection.close()
+            except Exception as e:
+                if self.closed:
+                    break
+                print(f"⚠️ Stream delle quotazioni interrotto ({e}). Nuova connessione tra {delay:.1f} secondi...")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _quotes(self, connection):
+        pinged = time.monotonic()
+        while not self.closed:
+            try:
+                message = connection.recv(timeout=1.0)
+            except TimeoutError:
+                message = None
+            if time.monotonic() - pinged > CAPITAL_PING_INTERVAL:
+                connection.send(self._message("ping"))
+                pinged = time.monotonic()
+            if message is None:
+                yield None
+                continue
+
+            data = json.loads(message)
+            if data.get("destination") == "quote":
+                quote = data["payload"]
+                yield quote["epic"], quote["timestamp"], quote["bid"], quote["ofr"]
+            elif data.get("status") not in (None, "OK"):
+                print(f"⚠️ Stream delle quotazioni: {data.get('destination')} {data.get('payload')}")
+
+    def close(self):
+        self.closed = True
+
+
+
+class FakeQuoteServer:
+    '''
+    Server Capital.com finto per i test, senza rete: parla lo stesso protocollo (sottoscrizione, ping,
+    messaggi quote) e genera una passeggiata casuale per ogni epic sottoscritto, un tick ogni `step`
+    millisecondi a rotazione fra gli epic, `ticks` in tutto. Con `drop_every` chiude la connessione
+    ogni tanti tick. I tick inviati restano in `sent` per confrontarli con le barre costruite.
+    '''
+
+    def __init__(self, ticks:int, step:int=100, start:int=1_704_067_200_000, drop_every:int=None, seed:int=0):
+        self.ticks = ticks
+        self.step = step
+        self.timestamp = start
+        self.drop_every = drop_every
+        self.random = random.Random(seed)
+        self.prices = {}
+        self.sent = []
+
+    def connect(self, url:str) -> "FakeQuoteServer._Connection":
+        return FakeQuoteServer._Connection(self)
+
+    def _quote(self, epic:str) -> str:
+        price = self.prices.setdefault(epic, 100.0) + self.random.gauss(0, 0.05)
+        self.prices[epic] = price
+        tick = (epic, self.timestamp, round(price, 5), round(price + 0.02, 5))
+        self.sent.append(tick)
+        self.timestamp += self.step
+        return json.dumps({"status": "OK", "destination": "quote", "payload": {
+            "epic": epic, "product": "CFD", "bid": tick[2], "bidQty": 1.0, "ofr": tick[3], "ofrQty": 1.0, "timestamp": tick[1]}})
+
+    class _Connection:
+        def __init__(self, server:"FakeQuoteServer"):
+            self.server = server
+            self.epics = []
+            self.replies = Queue()
+            self.received = 0
+
+        def send(self, message:str):
+            data = json.loads(message)
+            if data["destination"] == "marketData.subscribe":
+                self.epics += data["payload"]["epics"]
+                subscriptions = {epic: "PROCESSED" for epic in data["payload"]["epics"]}
+                self.replies.put(json.dumps({"status": "OK", "destination": "marketData.subscribe", "correlationId": data["correlationId"], "payload": {"subscriptions": subscriptions}}))
+            elif data["destination"] == "ping":
+                self.replies.put(json.dumps({"status": "OK", "destination": "ping", "correlationId": data["correlationId"], "payload": {}}))
+
+        def recv(self, timeout:float=None) -> str:
+            try:
+                return self.replies.get_nowait()
+            except Empty:
+                pass
+            server = self.server
+            if len(server.sent) >= server.ticks:
+                raise TimeoutError()
+            if server.drop_every and self.received and self.received % server.drop_every == 0:
+                raise ConnectionError("connessione chiusa dal server")
+            self.received += 1
+            return server._quote(self.epics[len(server.sent) % len(self.epics)])
+
+        def close(self):
+            pass
+
+
+
+class QuoteIngestor:
+    '''
+    Consuma uno stream di quotazioni: ogni tick va nel buffer circolare del suo epic e nel BarBuilder,
+    e le barre completate vengono salvate con Database.save_data_array a blocchi, quando sono almeno
+    `batch_size` o ogni `flush_interval` secondi. La memoria resta limitata: `capacity` tick per epic
+    e una barra in costruzione per (epic, resolution).
+    Le barre dello stream non vengono registrate nell'indice di copertura: i buchi lasciati da una
+    disconnessione restano da scaricare con il backfill o il daily update, e le barre scaricate
+    (Database.save_window) sostituiscono quelle costruite dallo stream, che invece non sovrascrivono nulla.
+    '''
+
+    def __init__(self, db:Database, stream:QuoteStream, resolutions:list[str]=("MINUTE",), capacity:int=4096,
+                 batch_size:int=500, flush_interval:float=5.0):
+        self.db = db
+        self.stream = stream
+        self.builder = BarBuilder(resolutions)
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rings = {}
+        self.ticks = 0
+        self.saved = 0
+
+    def ring(self, epic:str) -> TickRing:
+        '''Buffer dei tick di un epic, None se non ne sono ancora arrivati'''
+        return self.rings.get(epic)
+
+    def latest(self, epic:str) -> tuple[int, float, float]:
+        '''Ultimo tick (tempo in ms, bid, ask) di un epic, None se non ne sono ancora arrivati'''
+        ring = self.rings.get(epic)
+        return ring.latest() if ring is not None else None
+
+    def run(self, max_ticks:int=None) -> dict:
+        '''Riceve tick finché lo stream non viene chiuso o fino a max_ticks. Restituisce le statistiche'''
+        builder, rings = self.builder, self.rings
+        connections = self.stream.connections
+        flushed = time.monotonic()
+        start = time.perf_counter()
+        try:
+            for tick in self.stream:
+                if self.stream.connections != connections:
+                    connections = self.stream.connections
+                    builder.reset()
+                if tick is not None:
+                    epic, timestamp, bid, ask = tick
+                    ring = rings.get(epic)
+                    if ring is None:
+                        ring = rings[epic] = TickRing(self.capacity)
+                    ring.append(timestamp, bid, ask)
+                    builder.update(epic, timestamp, bid, ask)
+                    self.ticks += 1
+                now = time.monotonic()
+                if builder.pending >= self.batch_size or now - flushed >= self.flush_interval:
+                    self.flush()
+                    flushed = now
+                if max_ticks is not None and self.ticks >= max_ticks:
+                    break
+        finally:
+            self.flush()
+        seconds = time.perf_counter() - start
+        return {"ticks": self.ticks, "bars": self.saved, "seconds": seconds, "ticks_per_second": self.ticks / max(seconds, 1e-9)}
+
+    def flush(self) -> int:
+        '''Salva le barre completate (comprese quelle dei bucket finiti senza nuovi tick). Restituisce le barre salvate'''
+        self.builder.expire()
+        blocks = self.builder.drain()
+        if not blocks:
+            return 0
+        saved = 0
+        with self.db.connection():
+            for block in blocks:
+                saved += self.db.save_data_array(block)
+        self.saved += saved
+        return saved
+
+
+
+if __name__ == "__main__":
+    import io
+    import contextlib
+
+    # Buffer circolare: restano solo gli ultimi `capacity` tick
+    ring = TickRing(4)
+    for i in range(6):
+        ring.append(i, 100 + i, 101 + i)
+    times, bids, asks = ring.last()
+    assert list(times) == [2, 3, 4, 5] and list(bids) == [102, 103, 104, 105] and ring.latest() == (5, 105.0, 106.0)
+    assert list(ring.last(2)[0]) == [4, 5] and len(TickRing(3)) == 0 and TickRing(3).latest() is None
+
+    # Barre dai tick: la prima (iniziata prima dello stream) viene scartata
+    builder = BarBuilder(["MINUTE"])
+    base = 1_704_067_230_000  # 2024-01-01T00:00:30
+    for offset, bid in [(0, 1.0), (30_000, 2.0), (40_000, 5.0), (50_000, 1.5), (60_000, 3.0), (125_000, 4.0)]:
+        builder.update("GOLD", base + offset, bid, bid + 0.5)
+    blocks = builder.drain()
+    assert len(blocks) == 1 and list(blocks[0].times) == ["2024-01-01T00:01:00"]
+    assert blocks[0].prices.tolist() == [[2.0, 2.5, 5.0, 5.5, 1.5, 2.0, 3.0, 3.5]] and blocks[0].volume.tolist() == [4]
+    # Il bucket delle 00:02 è finito senza nuovi tick di GOLD: lo completa l'orologio degli altri epic
+    builder.update("SILVER", base + 182_000, 1.0, 1.0)
+    builder.expire()
+    assert [list(block.times) for block in builder.drain()] == [["2024-01-01T00:02:00"]]
+
+    # Stream finto con disconnessioni: tutte le barre salvate corrispondono ai tick inviati
+    server = FakeQuoteServer(ticks=30_000, step=50, drop_every=13_000)
+    stream = CapitalQuoteStream("cst", "token", ["GOLD", "SILVER", "OIL_CRUDE"], connect=server.connect, reconnect_delay=0)
+    db = Database("sqlite:///:memory:")
+    ingestor = QuoteIngestor(db, stream, ["MINUTE", "MINUTE_5"], capacity=1000, batch_size=20)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = ingestor.run(max_ticks=30_000)
+    assert stats["ticks"] == 30_000 and stream.connections == 3
+    assert all(len(ring) == 1000 for ring in ingestor.rings.values())
+    assert ingestor.latest("GOLD")[1:] == next(tick[2:] for tick in reversed(server.sent) if tick[0] == "GOLD")
+
+    ticks = np.array([(t, bid, ask) for epic, t, bid, ask in server.sent if epic == "GOLD"])
+    minutes = ticks[:, 0] // 60_000
+    bars = db.get_bars("GOLD", "MINUTE")
+    assert len(bars) >= 20 and len(db.get_bars("GOLD", "MINUTE_5")) >= 2
+    assert stats["bars"] == sum(len(db.get_bars(*series)) for series in db.get_series())
+    for bar in bars:
+        minute = ticks[minutes == np.datetime64(bar[2]).astype('datetime64[m]').astype(np.int64)]
+        assert bar[3:11] == (minute[0, 1], minute[0, 2], minute[:, 1].max(), minute[:, 2].max(),
+                             minute[:, 1].min(), minute[:, 2].min(), minute[-1, 1], minute[-1, 2]) and bar[11] == len(minute)
+
+    # Le barre scaricate dalla REST API sostituiscono quelle dello stream, non il contrario
+    downloaded = [bar[:3] + tuple(price + 1 for price in bar[3:11]) + (bar[11],) for bar in bars[:2]]
+    assert db.save_window("GOLD", "MINUTE", downloaded[0][2], downloaded[-1][2], downloaded) == 2
+    assert db.get_bars("GOLD", "MINUTE")[:2] == downloaded and db.save_data_array(bars[:2]) == 0
+
+    # QuoteStream è astratta: una sorgente senza __iter__ non può essere istanziata
+    try:
+        QuoteStream()
+        assert False
+    except TypeError:
+        pass
@@ -0,0 +1,287 @@
+import math
+import threading
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+from trading_strategies import TechnicalIndicators
+
+
+class RSIState:
+    """RSI con smoothing di Wilder, inizializzato come talib: media semplice dei primi `period` delta"""
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.prev_close = None
+        self.count = 0
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.value = math.nan
+
+    def update(self, close: float) -> float:
+        if self.prev_close is None:
+            self.prev_close = close
+            return self.value
+
+        delta = close - self.prev_close
+        self.prev_close = close
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+        self.count += 1
+
+        if self.count < self.period:
+            self.avg_gain += gain
+            self.avg_loss += loss
+            return self.value
+        if self.count == self.period:
+            self.avg_gain = (self.avg_gain + gain) / self.period
+            self.avg_loss = (self.avg_loss + loss) / self.period
+        else:
+            self.avg_gain = (self.avg_gain * (self.period - 1) + gain) / self.period
+            self.avg_loss = (self.avg_loss * (self.period - 1) + loss) / self.period
+
+        total = self.avg_gain + self.avg_loss
+        self.value = 100 * self.avg_gain / total if total != 0 else 0.0
+        return self.value
+
+
+class BollingerState:
+    """Bande di Bollinger con somme mobili: media semplice e deviazione standard di popolazione, come talib.BBANDS"""
+
+    def __init__(self, period: int = 20, std: float = 2):
+        self.period = period
+        self.std = std
+        self.window = deque()
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.upper = self.middle = self.lower = math.nan
+
+    def update(self, close: float) -> Tuple[float, float, float]:
+        self.window.append(close)
+        self.sum += close
+        self.sum_sq += close * close
+        if len(self.window) > self.period:
+            old = self.window.popleft()
+            self.sum -= old
+            self.sum_sq -= old * old
+
+        if len(self.window) == self.period:
+            mean = self.sum / self.period
+            deviation = math.sqrt(max(self.sum_sq / self.period - mean * mean, 0.0))
+            self.middle = mean
+            self.upper = mean + self.std * deviation
+            self.lower = mean - self.std * deviation
+        return self.upper, self.middle, self.lower
+
+
+class EMAState:
+    """EMA inizializzata con la media semplice dei primi `period` valori, come talib"""
+
+    def __init__(self, period: int):
+        self.period = period
+        self.k = 2 / (period + 1)
+        self.count = 0
+        self.value = math.nan
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        if self.count < self.period:
+            self.value = value if self.count == 1 else self.value + value
+            return math.nan
+        if self.count == self.period:
+            self.value = (self.value + value) / self.period if self.period > 1 else value
+        else:
+            self.value = (value - self.value) * self.k + self.value
+        return self.value
+
+
+class MACDState:
+    """
+    MACD incrementale con lo stesso allineamento di talib.MACD: entrambe le EMA producono il primo
+    valore sulla barra slow-1, quindi la EMA veloce parte dalla media delle `fast` chiusure che
+    terminano lì e non dalle prime `fast` della serie.
+    """
+
+    def __init__(self, fast: int = 12, slow: int = 26, signal: int = 9):
+        if slow < fast:
+            fast, slow = slow, fast
+        self.fast_period = fast
+        self.slow_period = slow
+        self.count = 0
+        self.recent = deque(maxlen=fast)
+        self.fast = EMAState(fast)
+        self.slow = EMAState(slow)
+        self.signal = EMAState(signal)
+        self.macd = self.macd_signal = self.macd_histogram = math.nan
+
+    def update(self, close: float) -> Tuple[float, float, float]:
+        self.count += 1
+        slow = self.slow.update(close)
+        if self.count < self.slow_period:
+            self.recent.append(close)
+            return self.macd, self.macd_signal, self.macd_histogram
+        if self.count == self.slow_period:
+            # Semina la EMA veloce con le ultime `fast` chiusure
+            for value in list(self.recent)[1:]:
+                self.fast.update(value)
+            fast = self.fast.update(close)
+        else:
+            fast = self.fast.update(close)
+
+        macd = fast - slow
+        signal = self.signal.update(macd)
+        if not math.isnan(signal):
+            self.macd = macd
+            self.macd_signal = signal
+            self.macd_histogram = macd - signal
+        return self.macd, self.macd_signal, self.macd_histogram
+
+
+class StreamingIndicators(TechnicalIndicators):
+    """
+    Sostituto di TechnicalIndicators per un singolo (epic, resolution) che mantiene lo stato degli indicatori.
+    Ogni chiamata aggiorna lo stato solo con le barre del DataFrame più recenti dell'ultima vista, in O(1)
+    per barra, e restituisce il valore sull'ultima barra (Series di un elemento, indice df.index[-1:]).
+    I valori coincidono con talib calcolato sulla serie a partire dalla prima barra vista.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.last_index = {}
+        self.lock = threading.Lock()
+
+    def _state(self, key: tuple, factory, df: pd.DataFrame):
+        with self.lock:
+            state = self.states.get(key)
+            last = self.last_index.get(key)
+            if state is None or (last is not None and len(df) and df.index[0] > last):
+                # Prima chiamata, o finestra che non si sovrappone più allo stato: si riparte da df
+                state = self.states[key] = factory()
+                last = None
+
+            closes = df['close'] if last is None else df['close'][df.index > last]
+            for close in closes.to_numpy(dtype=float):
+                state.update(close)
+            if len(df):
+                self.last_index[key] = df.index[-1]
+            return state
+
+    def calculate_rsi(self, df: pd.DataFrame, period: int = 14) -> pd.Series:
+        state = self._state(('rsi', period), lambda: RSIState(period), df)
+        return pd.Series([state.value], index=df.index[-1:])
+
+    def calculate_bollinger_bands(self, df: pd.DataFrame, period: int = 20, std: float = 2) -> Dict[str, pd.Series]:
+        state = self._state(('bollinger', period, std), lambda: BollingerState(period, std), df)
+        index = df.index[-1:]
+        return {
+            'bb_upper': pd.Series([state.upper], index=index),
+            'bb_middle': pd.Series([state.middle], index=index),
+            'bb_lower': pd.Series([state.lower], index=index)
+        }
+
+    def calculate_macd(self, df: pd.DataFrame, fast: int = 12, slow: int = 26, signal: int = 9) -> Dict[str, pd.Series]:
+        state = self._state(('macd', fast, slow, signal), lambda: MACDState(fast, slow, signal), df)
+        index = df.index[-1:]
+        return {
+            'macd': pd.Series([state.macd], index=index),
+            'macd_signal': pd.Series([state.macd_signal], index=index),
+            'macd_histogram': pd.Series([state.macd_histogram], index=index)
+        }
+
+
+class IndicatorEngine:
+    """Registro degli indicatori incrementali, uno per (epic, resolution)"""
+
+    def __init__(self):
+        self.indicators: Dict[Tuple[str, str], StreamingIndicators] = {}
+        self.generations: Dict[Tuple[str, str], int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, epic: str, resolution: str) -> StreamingIndicators:
+        with self.lock:
+            indicators = self.indicators.get((epic, resolution))
+            if indicators is None:
+                indicators = self.indicators[(epic, resolution)] = StreamingIndicators()
+            return indicators
+
+    def reset(self, epic: str, resolution: Optional[str] = None):
+        """Scarta lo stato, ad esempio dopo l'inserimento di barre più vecchie dell'ultima vista"""
+        with self.lock:
+            for key in [k for k in self.indicators if k[0] == epic and (resolution is None or k[1] == resolution)]:
+                del self.indicators[key]
+                self.generations[key] = self.generations.get(key, 0) + 1
+
+    def last_bar(self, epic: str, resolution: str) -> Optional[pd.Timestamp]:
+        """Ultima barra applicata agli indicatori di (epic, resolution), None se non ce ne sono"""
+        with self.lock:
+            indicators = self.indicators.get((epic, resolution))
+        if indicators is None:
+            return None
+        with indicators.lock:
+            return max(indicators.last_index.values(), default=None)
+
+    def invalidate(self, columns):
+        """
+        Listener di ingest del Database: un blocco di barre non tutte più recenti dell'ultima barra applicata
+        (backfill, buchi riempiti, correzioni) renderebbe lo stato diverso da talib sulla serie, quindi viene scartato
+        """
+        last = self.last_bar(columns.epic, columns.resolution)
+        if last is not None and len(columns) and pd.Timestamp(min(columns.times)) <= last:
+            self.reset(columns.epic, columns.resolution)
+
+    def generation(self, epic: str, resolution: str) -> int:
+        """Numero di reset dello stato di (epic, resolution): i risultati calcolati prima di un reset non valgono più"""
+        return self.generations.get((epic, resolution), 0)
+
+
+if __name__ == "__main__":
+    import numpy as np
+    import talib
+
+    rng = np.random.default_rng(42)
+    closes = 100 + np.cumsum(rng.normal(size=500))
+
+    rsi, bollinger, macd = RSIState(14), BollingerState(20, 2), MACDState(12, 26, 9)
+    streamed = np.array([(rsi.update(c), *bollinger.update(c), *macd.update(c)) for c in closes])
+    expected = np.column_stack([
+        talib.RSI(closes, timeperiod=14),
+        *talib.BBANDS(closes, timeperiod=20, nbdevup=2, nbdevdn=2),
+        *talib.MACD(closes, fastperiod=12, slowperiod=26, signalperiod=9)
+    ])
+    assert np.allclose(streamed, expected, equal_nan=True, rtol=1e-9, atol=1e-9)
+
+    # Drop-in: chiamate successive con una finestra che scorre aggiornano solo le barre nuove
+    df = pd.DataFrame({'close': closes}, index=pd.date_range("2024-01-01", periods=len(closes), freq="h"))
+    indicators = StreamingIndicators()
+    for end in (300, 301, 350, 400):
+        window = df.iloc[max(0, end - 100):end] if end > 300 else df.iloc[:end]
+        value = indicators.calculate_rsi(window).iloc[-1]
+        assert math.isclose(value, expected[end - 1, 0], rel_tol=1e-9)
+        bands = indicators.calculate_bollinger_bands(window)
+        assert math.isclose(bands['bb_upper'].iloc[-1], expected[end - 1, 1], rel_tol=1e-9)
+        assert math.isclose(indicators.calculate_macd(window)['macd'].iloc[-1], expected[end - 1, 4], rel_tol=1e-9)
+
+    # Una finestra staccata dallo stato riparte da zero, come talib sulla sola finestra
+    window = df.iloc[450:500]
+    assert math.isclose(indicators.calculate_rsi(window).iloc[-1], talib.RSI(window['close'].to_numpy(), timeperiod=14)[-1], rel_tol=1e-9)
+
+    # Il registro crea uno stato per (epic, resolution); un reset lo scarta e ne cambia la generazione
+    engine = IndicatorEngine()
+    assert engine.get("GOLD", "HOUR") is engine.get("GOLD", "HOUR") and engine.generation("GOLD", "HOUR") == 0
+    engine.get("GOLD", "DAY")
+    engine.reset("GOLD", "HOUR")
+    assert engine.generation("GOLD", "HOUR") == 1 and engine.generation("GOLD", "DAY") == 0
+    assert ("GOLD", "DAY") in engine.indicators and ("GOLD", "HOUR") not in engine.indicators
+
+    # Listener di ingest: solo un blocco non più recente dell'ultima barra applicata scarta lo stato
+    from transform import columns_from_rows
+    indicators = engine.get("GOLD", "HOUR")
+    indicators.calculate_rsi(df.iloc[:100])
+    bar = lambda i: ("GOLD", "HOUR", df.index[i].strftime("%Y-%m-%dT%H:%M:%S"), *[closes[i]] * 8, 1)
+    engine.invalidate(columns_from_rows([bar(100), bar(101)])[0])
+    assert engine.get("GOLD", "HOUR") is indicators and engine.last_bar("GOLD", "HOUR") == df.index[99]
+    engine.invalidate(columns_from_rows([bar(50), bar(120)])[0])
+    assert engine.get("GOLD", "HOUR") is not indicators and engine.generation("GOLD", "HOUR") == 2
+    engine.invalidate(columns_from_rows([bar(10)])[0])
+    assert engine.generation("GOLD", "HOUR") == 2  # nessuna barra applicata dopo il reset
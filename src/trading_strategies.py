@@ -9,7 +9,7 @@ class TechnicalIndicators:
     @staticmethod
     def calculate_rsi(df: pd.DataFrame, period: int = 14) -> pd.Series:
         """Calcola RSI"""
-        return talib.RSI(df['close'].values, timeperiod=period)
+        return pd.Series(talib.RSI(df['close'].values, timeperiod=period), index=df.index)
     
     @staticmethod
     def calculate_bollinger_bands(df: pd.DataFrame, period: int = 20, std: float = 2) -> Dict[str, pd.Series]:
@@ -76,12 +76,13 @@ class TechnicalIndicators:
 class TradingStrategies:
     """Implementazione delle strategie di trading"""
     
-    def __init__(self):
-        self.indicators = TechnicalIndicators()
+    def __init__(self, indicators: Optional[TechnicalIndicators] = None):
+        # Qualsiasi oggetto con l'interfaccia di TechnicalIndicators, ad esempio StreamingIndicators
+        self.indicators = indicators if indicators is not None else TechnicalIndicators()
     
-    def rsi_strategy(self, df: pd.DataFrame, rsi_oversold: int = 30, rsi_overbought: int = 70) -> Dict:
+    def rsi_strategy(self, df: pd.DataFrame, rsi_oversold: int = 30, rsi_overbought: int = 70, rsi_period: int = 14) -> Dict:
         """Strategia RSI"""
-        rsi = self.indicators.calculate_rsi(df)
+        rsi = self.indicators.calculate_rsi(df, rsi_period)
         current_rsi = rsi.iloc[-1]
         
         signal = "HOLD"
@@ -101,9 +102,9 @@ class TradingStrategies:
             'strategy': 'RSI'
         }
     
-    def bollinger_strategy(self, df: pd.DataFrame) -> Dict:
+    def bollinger_strategy(self, df: pd.DataFrame, bb_period: int = 20, bb_std: float = 2) -> Dict:
         """Strategia Bollinger Bands"""
-        bb = self.indicators.calculate_bollinger_bands(df)
+        bb = self.indicators.calculate_bollinger_bands(df, bb_period, bb_std)
         current_price = df['close'].iloc[-1]
         current_upper = bb['bb_upper'].iloc[-1]
         current_lower = bb['bb_lower'].iloc[-1]
@@ -133,19 +134,20 @@ class TradingStrategies:
             'strategy': 'BOLLINGER'
         }
     
-    def combined_strategy(self, df: pd.DataFrame) -> Dict:
+    def combined_strategy(self, df: pd.DataFrame, rsi_oversold: int = 30, rsi_overbought: int = 70, rsi_period: int = 14,
+                          bb_period: int = 20, bb_std: float = 2, macd_fast: int = 12, macd_slow: int = 26, macd_signal: int = 9) -> Dict:
         """Strategia combinata RSI + Bollinger + MACD"""
-        rsi_result = self.rsi_strategy(df)
-        bb_result = self.bollinger_strategy(df)
-        macd = self.indicators.calculate_macd(df)
+        rsi_result = self.rsi_strategy(df, rsi_oversold, rsi_overbought, rsi_period)
+        bb_result = self.bollinger_strategy(df, bb_period, bb_std)
+        macd = self.indicators.calculate_macd(df, macd_fast, macd_slow, macd_signal)
         
         # MACD Signal
         current_macd = macd['macd'].iloc[-1]
         current_signal = macd['macd_signal'].iloc[-1]
-        macd_signal = "BUY" if current_macd > current_signal else "SELL"
+        macd_vote = "BUY" if current_macd > current_signal else "SELL"
         
         # Combinazione dei segnali
-        signals = [rsi_result['signal'], bb_result['signal'], macd_signal]
+        signals = [rsi_result['signal'], bb_result['signal'], macd_vote]
         buy_votes = signals.count('BUY')
         sell_votes = signals.count('SELL')
         
@@ -171,6 +173,115 @@ class TradingStrategies:
             'support_level': support,
             'resistance_level': resistance,
             'volume_indicator': volume_indicator,
-            'macd_signal': macd_signal,
+            'macd_signal': macd_vote,
             'strategy': 'COMBINED'
-        }
\ No newline at end of file
+        }
+    
+    # ======= Serie storiche vettoriali =======
+    # Stessi campi delle strategie sopra, calcolati per ogni barra in un solo passaggio.
+    # Usano sempre gli indicatori talib sull'intera serie, anche se self.indicators è incrementale.
+
+    def rsi_strategy_series(self, df: pd.DataFrame, rsi_oversold: int = 30, rsi_overbought: int = 70, rsi_period: int = 14) -> pd.DataFrame:
+        """Strategia RSI su ogni barra"""
+        rsi = TechnicalIndicators.calculate_rsi(df, rsi_period).to_numpy()
+        buy = rsi < rsi_oversold
+        sell = rsi > rsi_overbought
+        
+        return pd.DataFrame({
+            'signal': np.select([buy, sell], ["BUY", "SELL"], default="HOLD"),
+            'probability': np.select(
+                [buy, sell],
+                [np.minimum(0.8, (rsi_oversold - rsi) / rsi_oversold + 0.5),
+                 np.minimum(0.8, (rsi - rsi_overbought) / (100 - rsi_overbought) + 0.5)],
+                default=0.5
+            ),
+            'rsi_value': rsi,
+            'strategy': 'RSI'
+        }, index=df.index)
+    
+    def bollinger_strategy_series(self, df: pd.DataFrame, bb_period: int = 20, bb_std: float = 2) -> pd.DataFrame:
+        """Strategia Bollinger Bands su ogni barra"""
+        bb = TechnicalIndicators.calculate_bollinger_bands(df, bb_period, bb_std)
+        price = df['close'].to_numpy()
+        lower = price <= bb['bb_lower'].to_numpy()
+        upper = price >= bb['bb_upper'].to_numpy()
+        middle = bb['bb_middle'].to_numpy()
+        conditions = [lower, upper, price < middle, price > middle]
+        
+        return pd.DataFrame({
+            'signal': np.select(conditions[:2], ["BUY", "SELL"], default="HOLD"),
+            'probability': np.where(lower | upper, 0.7, 0.5),
+            'bollinger_position': np.select(conditions, ["LOWER", "UPPER", "LOWER_MIDDLE", "UPPER_MIDDLE"], default="MIDDLE"),
+            'strategy': 'BOLLINGER'
+        }, index=df.index)
+    
+    def combined_strategy_series(self, df: pd.DataFrame, rsi_oversold: int = 30, rsi_overbought: int = 70, rsi_period: int = 14,
+                                 bb_period: int = 20, bb_std: float = 2, macd_fast: int = 12, macd_slow: int = 26, macd_signal: int = 9,
+                                 period: int = 20) -> pd.DataFrame:
+        """Strategia combinata RSI + Bollinger + MACD su ogni barra"""
+        rsi_result = self.rsi_strategy_series(df, rsi_oversold, rsi_overbought, rsi_period)
+        bb_result = self.bollinger_strategy_series(df, bb_period, bb_std)
+        macd = TechnicalIndicators.calculate_macd(df, macd_fast, macd_slow, macd_signal)
+        macd_vote = np.where(macd['macd'].to_numpy() > macd['macd_signal'].to_numpy(), "BUY", "SELL")
+        
+        signals = [rsi_result['signal'].to_numpy(), bb_result['signal'].to_numpy(), macd_vote]
+        buy = sum(s == "BUY" for s in signals) >= 2
+        sell = ~buy & (sum(s == "SELL" for s in signals) >= 2)
+        votes = (rsi_result['probability'].to_numpy() + bb_result['probability'].to_numpy()) / 2 + 0.1
+        
+        # Supporto e resistenza sulle ultime `period` barre, volume rispetto alla sua media mobile
+        support = df['low'].rolling(period, min_periods=1).min()
+        resistance = df['high'].rolling(period, min_periods=1).max()
+        if 'volume' in df.columns:
+            volume = df['volume'].astype(float)
+            avg_volume = volume.rolling(period, min_periods=1).mean().to_numpy()
+            volume_indicator = np.select(
+                [volume.notna().cumsum().to_numpy() == 0, volume.to_numpy() > avg_volume * 1.5, volume.to_numpy() < avg_volume * 0.5],
+                ["UNKNOWN", "HIGH", "LOW"],
+                default="NORMAL"
+            )
+        else:
+            volume_indicator = "UNKNOWN"
+        
+        return pd.DataFrame({
+            'signal': np.select([buy, sell], ["BUY", "SELL"], default="HOLD"),
+            'probability': np.minimum(0.9, np.where(buy | sell, votes, 0.4)),
+            'rsi_value': rsi_result['rsi_value'],
+            'bollinger_position': bb_result['bollinger_position'],
+            'support_level': support,
+            'resistance_level': resistance,
+            'volume_indicator': volume_indicator,
+            'macd_signal': macd_vote,
+            'strategy': 'COMBINED'
+        }, index=df.index)
+
+
+if __name__ == "__main__":
+    # Le serie vettoriali coincidono con le strategie calcolate barra per barra sui prefissi della serie
+    rng = np.random.default_rng(7)
+    n = 120
+    close = 100 + np.cumsum(rng.normal(scale=2, size=n))
+    volume = rng.integers(1, 1000, size=n).astype(float)
+    volume[:3] = np.nan
+    df = pd.DataFrame({
+        'close': close,
+        'high': close + rng.random(n),
+        'low': close - rng.random(n),
+        'volume': volume
+    }, index=pd.date_range("2024-01-01", periods=n, freq="h"))
+    
+    strategies = TradingStrategies()
+    series = {
+        'RSI': (strategies.rsi_strategy, strategies.rsi_strategy_series(df)),
+        'BOLLINGER': (strategies.bollinger_strategy, strategies.bollinger_strategy_series(df)),
+        'COMBINED': (strategies.combined_strategy, strategies.combined_strategy_series(df))
+    }
+    for name, (strategy, result) in series.items():
+        for i in range(1, n + 1):
+            expected = strategy(df.iloc[:i])
+            actual = result.iloc[i - 1]
+            for key, value in expected.items():
+                if isinstance(value, str):
+                    assert actual[key] == value, (name, i, key, actual[key], value)
+                else:
+                    assert np.isclose(actual[key], value, equal_nan=True), (name, i, key, actual[key], value)
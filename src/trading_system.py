@@ -1,20 +1,38 @@
 import pandas as pd
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import logging
+from peewee import fn, Case
 
-from database import Database, TradingPositions, TradingStrategies, PortfolioConfig, HistoricalData
-from advanced_strategies import TradingStrategies as Strategies
+from database import Database, TradingPositions, TradingStrategies, PortfolioConfig, PortfolioStats, HISTORICAL_FIELDS
+from columnar import ColumnStore, BarWindowCache, to_frame
+from trading_strategies import TradingStrategies as Strategies
+from streaming_indicators import IndicatorEngine
 
 logger = logging.getLogger(__name__)
 
 class TradingSystem:
     """Sistema di trading con backtesting e simulazione"""
     
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, column_store: Optional[ColumnStore] = None, running_totals: bool = True, bar_cache: Optional[BarWindowCache] = None):
         self.db = db
+        self.column_store = column_store
+        # Ultime barre degli epic analizzati in memoria, aggiornate a ogni salvataggio di nuove barre
+        if bar_cache is None:
+            bar_cache = BarWindowCache(db, column_store)
+            db.add_ingest_listener(bar_cache.append)
+        self.bar_cache = bar_cache
         self.strategies = Strategies()
+        # Stato incrementale degli indicatori, scartato quando vengono salvate barre non più recenti dell'ultima applicata:
+        # da questo processo (listener di ingest) o da un altro (la finestra in memoria viene riletta)
+        self.indicator_engine = IndicatorEngine()
+        db.add_ingest_listener(self.indicator_engine.invalidate)
+        self.bar_cache.add_reload_listener(self.indicator_engine.reset)
         self.portfolio = self.get_or_create_portfolio()
+        # Con i totali correnti il riepilogo del portfolio è una lettura di una riga, senza aggregare lo storico
+        self.running_totals = running_totals
+        if running_totals and not PortfolioStats.select().where(PortfolioStats.portfolio == self.portfolio).exists():
+            self.rebuild_portfolio_stats()
     
     def get_or_create_portfolio(self) -> PortfolioConfig:
         """Ottiene o crea il portfolio virtuale"""
@@ -30,56 +48,125 @@ class TradingSystem:
             )
     
     def get_market_data(self, epic: str, timeframe: str = "HOUR", limit: int = 100) -> pd.DataFrame:
-        """Ottiene dati di mercato dal database"""
-        query = HistoricalData.select().where(
-            (HistoricalData.epic == epic) &
-            (HistoricalData.resolution == timeframe)
-        ).order_by(HistoricalData.snapshotTimeUTC.desc()).limit(limit)
-        
-        if not query.exists():
+        """Ultime `limit` barre dalla cache delle finestre; oltre la sua dimensione dallo store colonnare o dal database"""
+        if limit <= self.bar_cache.size:
+            df = self.bar_cache.frame(epic, timeframe, limit)
+            if df is None:
+                raise ValueError(f"Nessun dato trovato per {epic} ({timeframe})")
+            return df
+
+        if self.column_store and self.column_store.covers(epic, timeframe):
+            return to_frame(self.column_store.tail(epic, timeframe, limit))
+
+        rows = self.db.get_last_bars([epic], timeframe, limit).get(epic)
+        if not rows:
             raise ValueError(f"Nessun dato trovato per {epic} ({timeframe})")
         
-        df = pd.DataFrame(list(query.dicts()))
-        df.rename(columns={
+        return self._bars_frame(rows)
+    
+    def get_current_price(self, epic: str, timeframe: str = "HOUR") -> float:
+        """Chiusura dell'ultima barra, letta dalla cache delle finestre"""
+        latest = self.bar_cache.latest(epic, timeframe)
+        if latest is None:
+            raise ValueError(f"Nessun dato trovato per {epic} ({timeframe})")
+        return latest[1]
+    
+    def _bars_frame(self, rows: List[tuple]) -> pd.DataFrame:
+        """DataFrame con colonne open/high/low/close/volume e indice temporale da righe di HistoricalData"""
+        df = pd.DataFrame(rows, columns=[field.name for field in HISTORICAL_FIELDS]).rename(columns={
             'openBid': 'open',
             'highBid': 'high',
             'lowBid': 'low',
             'closeBid': 'close',
             'lastTradedVolume': 'volume'
-        }, inplace=True)
-        
-        # Ordina per data crescente
-        df = df.sort_values('snapshotTimeUTC')
+        })
         df['snapshotTimeUTC'] = pd.to_datetime(df['snapshotTimeUTC'])
-        df.set_index('snapshotTimeUTC', inplace=True)
+        return df.set_index('snapshotTimeUTC')
+    
+    def get_market_data_batch(self, epics: List[str], timeframe: str = "HOUR", limit: int = 100) -> Dict[str, pd.DataFrame]:
+        """Ultime `limit` barre di più epic: dalla cache delle finestre (le serie mancanti lette con una sola query) o come get_market_data"""
+        if limit <= self.bar_cache.size:
+            return self.bar_cache.frames(epics, timeframe, limit)
         
-        return df
+        market_data = {}
+        missing = []
+        for epic in epics:
+            if self.column_store and self.column_store.covers(epic, timeframe):
+                market_data[epic] = to_frame(self.column_store.tail(epic, timeframe, limit))
+            else:
+                missing.append(epic)
+        
+        for epic, rows in self.db.get_last_bars(missing, timeframe, limit).items():
+            market_data[epic] = self._bars_frame(rows)
+        
+        return market_data
+    
+    def get_strategy_parameters(self, epic: str, strategy_type: str) -> Dict:
+        """Parametri della strategia attiva per l'epic (ad esempio scritti da optimizer.py), vuoti per usare i default"""
+        strategy = TradingStrategies.get_or_none(
+            (TradingStrategies.epic == epic) &
+            (TradingStrategies.strategy_type == strategy_type) &
+            (TradingStrategies.is_active == True)
+        )
+        return (strategy.parameters or {}) if strategy else {}
     
-    def analyze_epic(self, epic: str, strategy_type: str = "COMBINED") -> Dict:
-        """Analizza un epic con la strategia specificata"""
+    def get_or_create_strategy(self, epic: str, strategy_type: str) -> TradingStrategies:
+        """Strategia attiva dell'epic a cui collegare le posizioni, creata con i parametri di default se manca"""
+        strategy = TradingStrategies.get_or_none(
+            (TradingStrategies.epic == epic) &
+            (TradingStrategies.strategy_type == strategy_type) &
+            (TradingStrategies.is_active == True)
+        )
+        if strategy is None:
+            strategy = TradingStrategies.create(name=f"{strategy_type}_DEFAULT", epic=epic, strategy_type=strategy_type, parameters={})
+        return strategy
+    
+    def analyze_epic(self, epic: str, strategy_type: str = "COMBINED", timeframe: str = "HOUR") -> Dict:
+        """Analizza un epic con la strategia specificata, aggiornando gli indicatori solo con le barre nuove"""
         try:
-            df = self.get_market_data(epic)
-            
-            if strategy_type == "RSI":
-                result = self.strategies.rsi_strategy(df)
-            elif strategy_type == "BOLLINGER":
-                result = self.strategies.bollinger_strategy(df)
-            else:  # COMBINED
-                result = self.strategies.combined_strategy(df)
-            
-            result.update({
-                'epic': epic,
-                'current_price': df['close'].iloc[-1],
-                'timestamp': df.index[-1],
-                'analysis_time': datetime.now()
-            })
-            
-            return result
+            df = self.get_market_data(epic, timeframe)
+            return self.analyze_market_data(epic, df, strategy_type, timeframe)
             
         except Exception as e:
             logger.error(f"Errore nell'analisi di {epic}: {e}")
             return {'error': str(e)}
     
+    def analyze_market_data(self, epic: str, df: pd.DataFrame, strategy_type: str = "COMBINED", timeframe: str = "HOUR") -> Dict:
+        """Applica la strategia a dati di mercato già caricati"""
+        strategies = Strategies(self.indicator_engine.get(epic, timeframe))
+        parameters = self.get_strategy_parameters(epic, strategy_type)
+        
+        if strategy_type == "RSI":
+            result = strategies.rsi_strategy(df, **parameters)
+        elif strategy_type == "BOLLINGER":
+            result = strategies.bollinger_strategy(df, **parameters)
+        else:  # COMBINED
+            result = strategies.combined_strategy(df, **parameters)
+        
+        result.update({
+            'epic': epic,
+            'current_price': df['close'].iloc[-1],
+            'timestamp': df.index[-1],
+            'analysis_time': datetime.now()
+        })
+        
+        return result
+    
+    def get_signal_history(self, epic: str, strategy_type: str = "COMBINED", timeframe: str = "HOUR", limit: int = 500) -> pd.DataFrame:
+        """Segnali della strategia per ognuna delle ultime `limit` barre, calcolati in un solo passaggio vettoriale"""
+        df = self.get_market_data(epic, timeframe, limit)
+        parameters = self.get_strategy_parameters(epic, strategy_type)
+        
+        if strategy_type == "RSI":
+            signals = self.strategies.rsi_strategy_series(df, **parameters)
+        elif strategy_type == "BOLLINGER":
+            signals = self.strategies.bollinger_strategy_series(df, **parameters)
+        else:  # COMBINED
+            signals = self.strategies.combined_strategy_series(df, **parameters)
+        
+        signals.insert(0, 'price', df['close'])
+        return signals
+    
     def should_open_position(self, analysis: Dict) -> bool:
         """Determina se aprire una posizione basandosi sull'analisi"""
         if analysis.get('error'):
@@ -121,49 +208,69 @@ class TradingSystem:
             self.portfolio.current_capital * (self.portfolio.risk_percentage / 100)
         )
         
-        # Crea la posizione
-        position = TradingPositions.create(
-            epic=epic,
-            entry_time=analysis['timestamp'],
-            entry_price=analysis['current_price'],
-            position_type=analysis['signal'],
-            position_size=position_size,
-            rsi_value=analysis.get('rsi_value'),
-            bollinger_position=analysis.get('bollinger_position'),
-            support_level=analysis.get('support_level'),
-            resistance_level=analysis.get('resistance_level'),
-            volume_indicator=analysis.get('volume_indicator'),
-            success_probability=analysis['probability']
-        )
-        
-        # Aggiorna il capitale
-        self.portfolio.current_capital -= position_size
-        self.portfolio.save()
+        with self.db.db.atomic():
+            # Crea la posizione; il timestamp dell'analisi è un pd.Timestamp, che i driver del database non accettano
+            position = TradingPositions.create(
+                epic=epic,
+                strategy_id=self.get_or_create_strategy(epic, analysis.get('strategy', "COMBINED")),
+                entry_time=pd.Timestamp(analysis['timestamp']).to_pydatetime(),
+                entry_price=analysis['current_price'],
+                position_type=analysis['signal'],
+                position_size=position_size,
+                rsi_value=analysis.get('rsi_value'),
+                bollinger_position=analysis.get('bollinger_position'),
+                support_level=analysis.get('support_level'),
+                resistance_level=analysis.get('resistance_level'),
+                volume_indicator=analysis.get('volume_indicator'),
+                success_probability=analysis['probability']
+            )
+            
+            # Aggiorna il capitale e i totali
+            self.portfolio.current_capital -= position_size
+            self.portfolio.save()
+            self._update_stats(total_positions=1, open_positions=1)
         
         logger.info(f"Posizione aperta: {epic} {analysis['signal']} @ {analysis['current_price']}")
         return position
     
     def check_and_close_positions(self) -> List[TradingPositions]:
-        """Controlla e chiude le posizioni aperte se necessario"""
-        open_positions = TradingPositions.select().where(TradingPositions.is_open == True)
-        closed_positions = []
+        """
+        Controlla e chiude le posizioni aperte se necessario.
+        Le ultime barre di tutti gli epic aperti vengono lette insieme, ogni epic viene analizzato
+        una sola volta per ciclo e le posizioni da chiudere sono salvate in un'unica transazione.
+        """
+        open_positions = list(TradingPositions.select().where(TradingPositions.is_open == True))
+        if not open_positions:
+            return []
+        
+        epics = sorted({position.epic for position in open_positions})
+        market_data = self.get_market_data_batch(epics)
+        analyses = {}
         
+        to_close = []
         for position in open_positions:
-            should_close, reason = self.should_close_position(position)
+            df = market_data.get(position.epic)
+            if df is not None and position.epic not in analyses:
+                try:
+                    analyses[position.epic] = self.analyze_market_data(position.epic, df)
+                except Exception as e:
+                    logger.error(f"Errore nell'analisi di {position.epic}: {e}")
+                    analyses[position.epic] = {'error': str(e)}
             
+            should_close, reason = self.should_close_position(position, df, analyses.get(position.epic))
             if should_close:
-                closed_position = self.close_position(position, reason)
-                if closed_position:
-                    closed_positions.append(closed_position)
+                if df is None:
+                    logger.error(f"Errore nella chiusura posizione {position.id}: nessun dato per {position.epic}")
+                    continue
+                to_close.append((position, reason, df['close'].iloc[-1]))
         
-        return closed_positions
+        return self.close_positions(to_close)
     
-    def should_close_position(self, position: TradingPositions) -> Tuple[bool, str]:
-        """Determina se chiudere una posizione"""
+    def should_close_position(self, position: TradingPositions, df: Optional[pd.DataFrame] = None, analysis: Optional[Dict] = None) -> Tuple[bool, str]:
+        """Determina se chiudere una posizione; dati e analisi già calcolati evitano di rileggerli"""
         try:
             # Ottieni i dati attuali
-            df = self.get_market_data(position.epic, limit=10)
-            current_price = df['close'].iloc[-1]
+            current_price = self.get_current_price(position.epic) if df is None else df['close'].iloc[-1]
             
             # Calcola profit/loss attuale
             if position.position_type == "BUY":
@@ -180,7 +287,8 @@ class TradingSystem:
                 return True, "TAKE_PROFIT"
             
             # Controllo segnali di strategia
-            analysis = self.analyze_epic(position.epic)
+            if analysis is None:
+                analysis = self.analyze_epic(position.epic)
             if analysis.get('signal') == 'HOLD' or analysis.get('probability', 0) < 0.4:
                 return True, "STRATEGY_SIGNAL"
             
@@ -194,57 +302,202 @@ class TradingSystem:
             logger.error(f"Errore nel controllo posizione {position.id}: {e}")
             return True, "ERROR"
     
+    def _closed_copy(self, position: TradingPositions, reason: str, current_price: float) -> TradingPositions:
+        """Copia della posizione con i campi di chiusura e il profit/loss; la posizione originale non viene modificata"""
+        if position.position_type == "BUY":
+            pl_amount = (current_price - position.entry_price) * (position.position_size / position.entry_price)
+        else:  # SELL
+            pl_amount = (position.entry_price - current_price) * (position.position_size / position.entry_price)
+        
+        closed = TradingPositions(**position.__data__)
+        closed.exit_time = datetime.now()
+        closed.exit_price = current_price
+        closed.profit_loss = pl_amount
+        closed.profit_loss_percentage = (pl_amount / position.position_size) * 100
+        closed.is_open = False
+        closed.close_reason = reason
+        closed.updated_at = datetime.now()
+        return closed
+    
+    def close_positions(self, closures: List[Tuple[TradingPositions, str, float]]) -> List[TradingPositions]:
+        """
+        Chiude più posizioni (posizione, motivo, prezzo) con un solo aggiornamento e un solo salvataggio del portfolio.
+        Restituisce le posizioni chiuse come copie: se il salvataggio fallisce le posizioni passate e il portfolio restano come prima
+        """
+        if not closures:
+            return []
+        
+        positions = [self._closed_copy(position, reason, current_price) for position, reason, current_price in closures]
+        released = sum(position.position_size + position.profit_loss for position in positions)
+        
+        try:
+            with self.db.db.atomic():
+                TradingPositions.bulk_update(positions, fields=[
+                    TradingPositions.exit_time,
+                    TradingPositions.exit_price,
+                    TradingPositions.profit_loss,
+                    TradingPositions.profit_loss_percentage,
+                    TradingPositions.is_open,
+                    TradingPositions.close_reason,
+                    TradingPositions.updated_at
+                ], batch_size=500)
+                
+                # Aggiorna il capitale e i totali
+                self.portfolio.current_capital += released
+                self.portfolio.save()
+                self._update_stats(
+                    open_positions=-len(positions),
+                    closed_positions=len(positions),
+                    winning_trades=sum(1 for p in positions if p.profit_loss > 0),
+                    total_pl=sum(p.profit_loss for p in positions)
+                )
+        except Exception as e:
+            logger.error(f"Errore nella chiusura di {len(positions)} posizioni: {e}")
+            self.portfolio = PortfolioConfig.get_by_id(self.portfolio.id)
+            return []
+        
+        for position in positions:
+            logger.info(f"Posizione chiusa: {position.epic} P&L: {position.profit_loss:.2f} ({position.profit_loss_percentage:.2f}%)")
+        return positions
+    
     def close_position(self, position: TradingPositions, reason: str) -> Optional[TradingPositions]:
         """Chiude una posizione"""
         try:
-            df = self.get_market_data(position.epic, limit=1)
-            current_price = df['close'].iloc[-1]
-            
-            # Calcola profit/loss
-            if position.position_type == "BUY":
-                pl_amount = (current_price - position.entry_price) * (position.position_size / position.entry_price)
-            else:  # SELL
-                pl_amount = (position.entry_price - current_price) * (position.position_size / position.entry_price)
-            
-            pl_percentage = (pl_amount / position.position_size) * 100
-            
-            # Aggiorna la posizione
-            position.exit_time = datetime.now()
-            position.exit_price = current_price
-            position.profit_loss = pl_amount
-            position.profit_loss_percentage = pl_percentage
-            position.is_open = False
-            position.close_reason = reason
-            position.updated_at = datetime.now()
-            position.save()
-            
-            # Aggiorna il capitale
-            self.portfolio.current_capital += position.position_size + pl_amount
-            self.portfolio.save()
-            
-            logger.info(f"Posizione chiusa: {position.epic} P&L: {pl_amount:.2f} ({pl_percentage:.2f}%)")
-            return position
+            closed = self.close_positions([(position, reason, self.get_current_price(position.epic))])
+            return closed[0] if closed else None
             
         except Exception as e:
             logger.error(f"Errore nella chiusura posizione {position.id}: {e}")
             return None
     
-    def get_portfolio_summary(self) -> Dict:
-        """Ottiene il riepilogo del portfolio"""
-        total_positions = TradingPositions.select().count()
-        open_positions = TradingPositions.select().where(TradingPositions.is_open == True).count()
-        closed_positions = TradingPositions.select().where(TradingPositions.is_open == False)
+    def aggregate_positions(self) -> Dict:
+        """Totali delle posizioni calcolati dal database con una sola query di aggregazione"""
+        closed = TradingPositions.is_open == False
+        total, open_positions, closed_positions, winning_trades, total_pl = TradingPositions.select(
+            fn.COUNT(TradingPositions.id),
+            fn.SUM(Case(None, [(TradingPositions.is_open == True, 1)], 0)),
+            fn.SUM(Case(None, [(closed, 1)], 0)),
+            fn.SUM(Case(None, [(closed & (TradingPositions.profit_loss > 0), 1)], 0)),
+            fn.SUM(Case(None, [(closed, TradingPositions.profit_loss)], 0))
+        ).tuples().get()
         
-        total_pl = sum([p.profit_loss for p in closed_positions if p.profit_loss])
-        winning_trades = [p for p in closed_positions if p.profit_loss and p.profit_loss > 0]
+        return {
+            'total_positions': total or 0,
+            'open_positions': open_positions or 0,
+            'closed_positions': closed_positions or 0,
+            'winning_trades': winning_trades or 0,
+            'total_pl': total_pl or 0.0
+        }
+    
+    def rebuild_portfolio_stats(self) -> PortfolioStats:
+        """Ricalcola i totali correnti dallo storico delle posizioni"""
+        totals = self.aggregate_positions()
+        PortfolioStats.insert(portfolio=self.portfolio, updated_at=datetime.now(), **totals).on_conflict_replace().execute()
+        return PortfolioStats.get(PortfolioStats.portfolio == self.portfolio)
+    
+    def _update_stats(self, **deltas):
+        """Applica gli incrementi ai totali correnti con un UPDATE atomico (campo = campo + delta)"""
+        if not self.running_totals:
+            return
+        update = {getattr(PortfolioStats, field): getattr(PortfolioStats, field) + delta for field, delta in deltas.items()}
+        update[PortfolioStats.updated_at] = datetime.now()
+        PortfolioStats.update(update).where(PortfolioStats.portfolio == self.portfolio).execute()
+    
+    def get_portfolio_summary(self) -> Dict:
+        """Ottiene il riepilogo del portfolio dai totali correnti o, se disattivati, con una query di aggregazione"""
+        if self.running_totals:
+            stats = PortfolioStats.get(PortfolioStats.portfolio == self.portfolio)
+            totals = {
+                'total_positions': stats.total_positions,
+                'open_positions': stats.open_positions,
+                'closed_positions': stats.closed_positions,
+                'winning_trades': stats.winning_trades,
+                'total_pl': stats.total_pl
+            }
+        else:
+            totals = self.aggregate_positions()
         
         return {
             'initial_capital': self.portfolio.initial_capital,
             'current_capital': self.portfolio.current_capital,
-            'total_pl': total_pl,
-            'total_positions': total_positions,
-            'open_positions': open_positions,
-            'closed_positions': len(list(closed_positions)),
-            'winning_trades': len(winning_trades),
-            'win_rate': len(winning_trades) / len(list(closed_positions)) * 100 if closed_positions else 0
-        }
\ No newline at end of file
+            'total_pl': totals['total_pl'],
+            'total_positions': totals['total_positions'],
+            'open_positions': totals['open_positions'],
+            'closed_positions': totals['closed_positions'],
+            'winning_trades': totals['winning_trades'],
+            'win_rate': totals['winning_trades'] / totals['closed_positions'] * 100 if totals['closed_positions'] else 0
+        }
+
+
+if __name__ == "__main__":
+    import math
+
+    logging.disable(logging.CRITICAL)
+    db = Database("sqlite:///:memory:")
+    trading_system = TradingSystem(db)
+    strategy = TradingStrategies.create(name="COMBINED_DEFAULT", epic="GOLD", strategy_type="COMBINED", parameters={})
+    positions = [TradingPositions.create(epic=epic, strategy_id=strategy, entry_time=datetime(2024, 1, 1), entry_price=100.0,
+                                         position_type=position_type, position_size=100.0)
+                 for epic, position_type in (("GOLD", "BUY"), ("SILVER", "SELL"), ("OIL", "BUY"))]
+    trading_system.portfolio.current_capital -= 300
+    trading_system.portfolio.save()
+    trading_system.rebuild_portfolio_stats()
+    closures = [(positions[0], "TAKE_PROFIT", 110.0), (positions[1], "STOP_LOSS", 105.0)]
+
+    # Salvataggio fallito: né le posizioni passate né il portfolio né il database cambiano
+    def failing_update(**deltas):
+        raise RuntimeError("update fallito")
+    trading_system._update_stats = failing_update
+    assert trading_system.close_positions(closures) == []
+    assert all(position.is_open and position.exit_price is None for position in positions)
+    assert TradingPositions.select().where(TradingPositions.is_open == True).count() == 3
+    assert trading_system.portfolio.current_capital == 9700
+
+    # Chiusura in blocco: copie chiuse, un solo aggiornamento di capitale e totali
+    del trading_system._update_stats
+    closed = trading_system.close_positions(closures)
+    assert [(p.id, p.close_reason, p.profit_loss) for p in closed] == [(positions[0].id, "TAKE_PROFIT", 10.0), (positions[1].id, "STOP_LOSS", -5.0)]
+    assert positions[0].is_open and not TradingPositions.get_by_id(positions[0].id).is_open
+    assert TradingPositions.get_by_id(positions[2].id).is_open
+    summary = trading_system.get_portfolio_summary()
+    assert summary['current_capital'] == 9700 + 205 and PortfolioConfig.get_by_id(trading_system.portfolio.id).current_capital == 9905
+    assert {key: summary[key] for key in trading_system.aggregate_positions()} == {
+        'total_positions': 3, 'open_positions': 1, 'closed_positions': 2, 'winning_trades': 1, 'total_pl': 5.0
+    } == trading_system.aggregate_positions()
+
+    # Apertura da un'analisi reale (timestamp pd.Timestamp, valori numpy) e chiusura al prezzo corrente
+    times = pd.date_range("2024-01-01", periods=150, freq="h").strftime("%Y-%m-%dT%H:%M:%S")
+    db.save_data_array([("GOLD", "HOUR", time, *[100.0 + i % 7] * 8, 10) for i, time in enumerate(times)])
+    analysis = trading_system.analyze_epic("GOLD")
+    assert isinstance(analysis['timestamp'], pd.Timestamp) and not analysis.get('error')
+    analysis.update(signal="BUY", probability=0.7)
+    position = trading_system.open_position(analysis)
+    assert position is not None and trading_system.open_position(analysis) is None
+    position = TradingPositions.get_by_id(position.id)
+    assert position.entry_time == datetime(2024, 1, 7, 5) and position.strategy_id.id == strategy.id
+    assert trading_system.get_portfolio_summary()['open_positions'] == 2
+    closed = trading_system.close_position(position, "MANUAL")
+    assert closed.close_reason == "MANUAL" and closed.exit_price == trading_system.get_current_price("GOLD")
+    summary = trading_system.get_portfolio_summary()
+    assert {key: summary[key] for key in trading_system.aggregate_positions()} == trading_system.aggregate_positions() == {
+        'total_positions': 4, 'open_positions': 1, 'closed_positions': 3, 'winning_trades': 1, 'total_pl': 5.0 + closed.profit_loss
+    }
+    assert math.isclose(summary['current_capital'], 9905 + closed.profit_loss)
+
+    # Barre più vecchie salvate da un altro processo: la finestra in memoria viene riletta e lo stato degli indicatori scartato
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        url = f"sqlite:///{os.path.join(folder, 'bars.db')}"
+        trading_system = TradingSystem(Database(url))
+        trading_system.bar_cache.ttl = 0
+        writer = Database(url)
+        bars = [("GOLD", "HOUR", time, *[100.0 + i % 7] * 8, 10) for i, time in enumerate(times)]
+        writer.save_data_array(bars[:140] + bars[141:])
+        assert not trading_system.analyze_epic("GOLD").get('error')
+        engine = trading_system.indicator_engine
+        generation = engine.generation("GOLD", "HOUR")
+        assert engine.last_bar("GOLD", "HOUR") == pd.Timestamp(times[-1])
+        writer.save_data_array([bars[140]])
+        assert not trading_system.analyze_epic("GOLD").get('error')
+        assert engine.generation("GOLD", "HOUR") == generation + 1 and engine.last_bar("GOLD", "HOUR") == pd.Timestamp(times[-1])
@@ -1,4 +1,7 @@
+import numpy as np
 import pandas as pd
+from operator import itemgetter
+from itertools import chain, repeat
 
 def calculate_pivot_points(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -19,6 +22,88 @@ def calculate_pivot_points(df: pd.DataFrame) -> pd.DataFrame:
 
 
 
+PRICE_FIELDS = ('openBid', 'openAsk', 'highBid', 'highAsk', 'lowBid', 'lowAsk', 'closeBid', 'closeAsk')
+CAPITAL_PRICE_KEYS = ('openPrice', 'highPrice', 'lowPrice', 'closePrice')
+_capital_quotes = itemgetter(*CAPITAL_PRICE_KEYS)
+
+class PriceColumns:
+    '''
+    Barre di un epic/resolution in formato colonnare.
+    `prices` è una matrice (n, 8) con le colonne nell'ordine di HistoricalData (PRICE_FIELDS),
+    quindi ogni campo è una vista senza copie: prices[:, PRICE_FIELDS.index('closeBid')]
+    '''
+
+    def __init__(self, epic:str, resolution:str, times:np.ndarray, prices:np.ndarray, volume:np.ndarray):
+        self.epic = epic
+        self.resolution = resolution
+        self.times = times
+        self.prices = prices
+        self.volume = volume
+
+    def __len__(self):
+        return len(self.times)
+
+    def column(self, field:str) -> np.ndarray:
+        return self.prices[:, PRICE_FIELDS.index(field)]
+
+    def oldest(self) -> str:
+        return min(self.times)
+
+    def rows(self):
+        '''Righe nell'ordine dei campi di HistoricalData, generate pigramente per l'inserimento in blocco'''
+        return zip(repeat(self.epic), repeat(self.resolution), self.times.tolist(), *self.prices.T.tolist(), self.volume.tolist())
+
+def columns_from_rows(rows:list[tuple]) -> list[PriceColumns]:
+    '''Raggruppa righe nell'ordine dei campi di HistoricalData in un blocco PriceColumns per (epic, resolution)'''
+    groups = {}
+    for row in rows:
+        groups.setdefault((row[0], row[1]), []).append(row)
+    return [PriceColumns(
+        epic,
+        resolution,
+        np.array([r[2] for r in group], dtype=object),
+        np.array([r[3:11] for r in group], dtype=np.float64).reshape(len(group), len(PRICE_FIELDS)),
+        np.array([r[11] for r in group], dtype=np.int64)
+    ) for (epic, resolution), group in groups.items()]
+
+def from_capital_prices(epic:str, resolution:str, prices:list[dict]) -> PriceColumns:
+    '''
+    Trasforma la risposta `prices` di Capital.com direttamente in colonne NumPy.
+    Un prezzo può essere un dizionario bid/ask o un singolo valore; il lato mancante viene
+    copiato dall'altro in un unico passaggio vettoriale e le barre ancora incomplete vengono scartate.
+    '''
+    n = len(prices)
+    try:
+        quotes = list(chain.from_iterable(map(_capital_quotes, prices)))
+    except KeyError:
+        quotes = [p.get(key) for p in prices for key in CAPITAL_PRICE_KEYS]
+
+    raw = np.empty((n, len(PRICE_FIELDS)), dtype=np.float64)
+    try:
+        # Formato standard: ogni prezzo è un dizionario bid/ask, estratto senza cicli Python espliciti
+        bids = list(map(dict.get, quotes, repeat('bid')))
+        asks = list(map(dict.get, quotes, repeat('ask')))
+    except TypeError:
+        # Prezzi come valore singolo (o assenti)
+        bids = [q.get('bid') if isinstance(q, dict) else q for q in quotes]
+        asks = [q.get('ask') if isinstance(q, dict) else q for q in quotes]
+    # None diventa NaN nella conversione a float
+    raw[:, 0::2] = np.array(bids, dtype=np.float64).reshape(n, 4)
+    raw[:, 1::2] = np.array(asks, dtype=np.float64).reshape(n, 4)
+
+    bids, asks = raw[:, 0::2], raw[:, 1::2]
+    np.copyto(bids, asks, where=np.isnan(bids))
+    np.copyto(asks, bids, where=np.isnan(asks))
+    valid = ~np.isnan(raw).any(axis=1)
+
+    times = np.array(list(map(dict.get, prices, repeat('snapshotTimeUTC'))), dtype=object)
+    volume = np.array(list(map(dict.get, prices, repeat('lastTradedVolume'))), dtype=np.float64)
+    volume = np.nan_to_num(volume).astype(np.int64)
+
+    if not valid.all():
+        return PriceColumns(epic, resolution, times[valid], raw[valid], volume[valid])
+    return PriceColumns(epic, resolution, times, raw, volume)
+
 def from_capital_history(epic:str, resolution:str, data:list[dict]) -> dict:
     '''Trasforma i dati storici di Capital.com in tuple per il database'''
 
@@ -41,9 +126,9 @@ def from_capital_markets(data:list[dict]) -> dict:
     '''Trasforma i dati dei mercati di Capital.com in tuple per il database'''
     return [ (
         d["epic"],
-        d["symbol"],
+        d["instrumentName"],
         d["instrumentType"],
-        d["instrumentName"]
+        d["marketStatus"]
     ) for d in data ]
 
 def from_news_api(data:list[dict]) -> dict: